@@ -8,6 +8,8 @@ from dipy.tracking.local_tracking import (LocalTracking,
                                           ParticleFilteringTracking)
 from dipy.align.imaffine import AffineMap
 import random
+import threading
+from collections import OrderedDict
 
 import sys
 import math
@@ -220,6 +222,50 @@ def tensor_odf(evals, evecs, sphere, num_batches=100):
     return odf
 
 
+class _QPSolver(object):
+    """
+    A QP with fixed P, G and H, that is set up once and then solved for
+    different linear terms Q, warm-starting from the previous solution.
+    """
+
+    def __init__(self, P, G, H):
+        # Keep references, so that the ids used as cache keys stay valid:
+        self.P, self.G, self.H = P, G, H
+        self.x = cvx.Variable(P.shape[0])
+        self.Q = cvx.Parameter(P.shape[0])
+        objective = cvx.Minimize(
+            0.5 * cvx.quad_form(self.x, cvx.Constant(P)) + self.Q @ self.x)
+        constraints = [G @ self.x <= H]
+        self.prob = cvx.Problem(objective, constraints)
+
+    def __call__(self, Q):
+        self.Q.value = np.asarray(Q, dtype=float).reshape((-1,))
+        try:
+            self.prob.solve(warm_start=True)
+            if self.x.value is None:
+                raise cvx.error.SolverError("No solution was found")
+            opt = np.array(self.x.value).reshape((Q.shape[0],))
+        except cvx.error.SolverError:
+            opt = np.empty((Q.shape[0],))
+            opt[:] = np.NaN
+        return opt
+
+
+# Solvers hold the value of their linear term until they are solved, so
+# every thread gets its own solvers. Only those of the most recently used
+# models are kept:
+QP_SOLVER_CACHE_SIZE = 8
+_qp_solvers = threading.local()
+
+
+def _thread_qp_solvers():
+    """The QP solvers of the calling thread, most recently used last"""
+    solvers = getattr(_qp_solvers, 'solvers', None)
+    if solvers is None:
+        solvers = _qp_solvers.solvers = OrderedDict()
+    return solvers
+
+
 def solve_qp(P, Q, G, H):
     r"""
     Helper function to set up and solve the Quadratic Program (QP) in CVXPY.
@@ -227,6 +273,11 @@ def solve_qp(P, Q, G, H):
     minimize      1/2 x' P x + Q' x
     subject to    G x <= H
     Here the QP solver is based on CVXPY and uses OSQP.
+
+    The problem is only set up once for each set of P, G and H arrays (as
+    used by dipy's QpFitter for all the voxels of a model), and then only
+    the linear term Q is updated for each call.
+
     Parameters
     ----------
     P : ndarray
@@ -242,18 +293,12 @@ def solve_qp(P, Q, G, H):
     x : array
         Optimal solution to the QP problem.
     """
-    x = cvx.Variable(Q.shape[0])
-    P = cvx.Constant(P)
-    objective = cvx.Minimize(0.5 * cvx.quad_form(x, P) + Q * x)
-    constraints = [G * x <= H]
-
-    # setting up the problem
-    prob = cvx.Problem(objective, constraints)
-    try:
-        prob.solve()
-        opt = np.array(x.value).reshape((Q.shape[0],))
-    except cvx.error.SolverError:
-        opt = np.empty((Q.shape[0],))
-        opt[:] = np.NaN
-
-    return opt
+    solvers = _thread_qp_solvers()
+    key = (id(P), id(G), id(H))
+    if key in solvers:
+        solvers.move_to_end(key)
+    else:
+        solvers[key] = _QPSolver(P, G, H)
+        while len(solvers) > QP_SOLVER_CACHE_SIZE:
+            solvers.popitem(last=False)
+    return solvers[key](Q)
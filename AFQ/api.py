@@ -4,10 +4,18 @@ import dask.dataframe as ddf
 import os
 import os.path as op
 import json
+import multiprocessing
+import queue
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from time import time
 
 import numpy as np
 import nibabel as nib
+import s3fs
 
 import dipy.core.gradients as dpg
 import dipy.tracking.utils as dtu
@@ -35,12 +43,13 @@ import AFQ.registration as reg
 import AFQ.utils.volume as auv
 from AFQ.viz.utils import Viz, visualize_tract_profiles
 from AFQ.utils.bin import get_default_args
+from AFQ.utils.parallel import parfor
 from AFQ.mask import (B0Mask, ScalarMask, FullMask, check_mask_methods)
 import logging
 logging.basicConfig(level=logging.INFO)
 
 
-__all__ = ["AFQ", "make_bundle_dict"]
+__all__ = ["AFQ", "make_bundle_dict", "run_s3_study"]
 
 
 def do_preprocessing():
@@ -90,11 +99,22 @@ def make_bundle_dict(bundle_names=BUNDLES, seg_algo="afq", resample_to=False):
     resample_to : Nifti1Image, optional
         If set, templates will be resampled to the affine and shape of this
         image.
+
+    Returns
+    -------
+    dict with bundle names as keys. For "afq", the ROIs and probability maps
+    of each bundle are `AFQ.data.TemplateFile` references, whose data is
+    only read when first used.
     """
     if seg_algo == "afq":
-        templates = afd.read_templates(resample_to=resample_to)
-        callosal_templates = afd.read_callosum_templates(
-            resample_to=resample_to)
+        # Only keep references to the template files, so that their data is
+        # only read when a bundle is segmented:
+        templates = {
+            k: afd.TemplateFile(v.get_filename()) for k, v in
+            afd.read_templates(resample_to=resample_to).items()}
+        callosal_templates = {
+            k: afd.TemplateFile(v.get_filename()) for k, v in
+            afd.read_callosum_templates(resample_to=resample_to).items()}
         # For the arcuate, we need to rename a few of these and duplicate the
         # SLF ROI:
         templates['ARC_roi1_L'] = templates['SLF_roi1_L']
@@ -167,6 +187,17 @@ def make_bundle_dict(bundle_names=BUNDLES, seg_algo="afq", resample_to=False):
     return afq_bundles
 
 
+def _clean_bundle_idx(sl_idx, streamlines, reference, clean_params):
+    """
+    Clean one bundle, given the indices of its streamlines in `streamlines`,
+    and return the indices (into `sl_idx`) of the streamlines that are kept.
+    """
+    this_tg = StatefulTractogram(streamlines[sl_idx], reference, Space.VOX)
+    _, this_idx = seg.clean_bundle(
+        this_tg, **{**clean_params, 'return_idx': True})
+    return np.asarray(this_idx, dtype=int)
+
+
 class AFQ(object):
     """
     """
@@ -191,7 +222,9 @@ class AFQ(object):
                  viz_backend="plotly_no_gif",
                  tracking_params=None,
                  segmentation_params=None,
-                 clean_params=None):
+                 clean_params=None,
+                 parallel_params=None,
+                 csd_params=None):
         '''
         Initialize an AFQ object.
         Some special notes on parameters:
@@ -297,6 +330,19 @@ class AFQ(object):
             The parameters for cleaning.
             Default: use the default behavior of the seg.clean_bundle
             function.
+        parallel_params: dict, optional
+            The parameters for fitting the DTI, DKI and CSD models in blocks
+            of voxels, possibly in parallel (e.g. ``n_jobs``, ``block_size``).
+            Default: use the default behavior of the
+            AFQ.utils.models.fit_in_blocks function, which fits one block
+            at a time.
+        csd_params: dict, optional
+            The parameters for fitting the CSD and MSMT models used for
+            tracking (``response``, ``sh_order``, ``lambda_``, ``tau``).
+            If ``response`` is "group", the response function is estimated
+            once, from the first subject, for all the subjects with the same
+            acquisition scheme, and so is the model.
+            Default: estimate the response function of each subject.
         '''
         if not isinstance(bids_path, str):
             raise TypeError("bids_path must be a string")
@@ -348,6 +394,14 @@ class AFQ(object):
                 "scalars must be None or a list of strings")
         if not isinstance(use_prealign, bool):
             raise TypeError("use_prealign must be a bool")
+        if parallel_params is not None\
+                and not isinstance(parallel_params, dict):
+            raise TypeError(
+                "parallel_params must be None or a dict")
+        if csd_params is not None\
+                and not isinstance(csd_params, dict):
+            raise TypeError(
+                "csd_params must be None or a dict")
         if not isinstance(virtual_frame_buffer, bool):
             raise TypeError("virtual_frame_buffer must be a bool")
         if "fury" not in viz_backend and "plotly" not in viz_backend:
@@ -445,6 +499,17 @@ class AFQ(object):
 
         self.clean_params = default_clean_params
 
+        if parallel_params is None:
+            parallel_params = {}
+        self.parallel_params = parallel_params
+
+        if csd_params is None:
+            csd_params = {}
+        self.csd_params = csd_params
+
+        # Artifacts shared between steps, see `_export_session`:
+        self._session = None
+
         if bundle_info is None:
             if self.seg_algo == "reco" or self.seg_algo == "reco16":
                 bundle_info = RECO_BUNDLES_16
@@ -639,6 +704,79 @@ class AFQ(object):
     def log_and_save_trk(self, sft, fname):
         self.logger.info(f"Saving {fname}")
         save_tractogram(sft, fname, bbox_valid_check=False)
+        if 'bundle' in sft.data_per_streamline:
+            aus.write_bundle_index(fname, sft)
+
+    @contextmanager
+    def _export_session(self):
+        """
+        Within this context, the artifacts that the export steps read (the
+        mapping, the prealignment, scalar volumes and bundles) are read once
+        and shared between the steps. They are released on exit.
+        """
+        self._session = {}
+        try:
+            yield
+        finally:
+            self._session = None
+
+    def _session_get(self, key, read):
+        if self._session is None:
+            return read()
+        if key not in self._session:
+            self._session[key] = read()
+        return self._session[key]
+
+    def _read_prealign_inv(self, row):
+        if not self.use_prealign:
+            return None
+        prealign_file = self._reg_prealign(row)
+        return self._session_get(
+            ('prealign_inv', prealign_file),
+            lambda: np.linalg.inv(np.load(prealign_file)))
+
+    def _read_mapping(self, row, reference, fields):
+        mapping_file = self._mapping(row)
+        return self._session_get(
+            ('mapping', mapping_file, reference, fields),
+            lambda: reg.read_mapping(mapping_file,
+                                     reference,
+                                     self.reg_template_img,
+                                     prealign=self._read_prealign_inv(row),
+                                     fields=fields))
+
+    def _read_volume(self, fname):
+        return self._session_get(
+            ('volume', fname), lambda: nib.load(fname).get_fdata())
+
+    def _read_bundle_index(self, bundles_file):
+        return self._session_get(
+            ('bundle_index', bundles_file),
+            lambda: aus.read_bundle_index(bundles_file))
+
+    def _read_bundle(self, bundles_file, uid, index=None):
+        if index is None:
+            index = self._read_bundle_index(bundles_file)
+        return self._session_get(
+            ('bundle', bundles_file, uid),
+            lambda: aus.read_bundle(bundles_file, uid, index))
+
+    def _read_bundles_sft(self, row, bundles_file, uids):
+        """
+        Read the bundles with these uids from `bundles_file` into one
+        StatefulTractogram, in voxel space, for the visualizations.
+        """
+        index = self._read_bundle_index(bundles_file)
+        bundles = [self._read_bundle(bundles_file, uid, index)
+                   for uid in uids]
+        sft = StatefulTractogram(
+            aus.concatenate_streamlines(bundles),
+            row['dwi_img'],
+            Space.RASMM,
+            data_per_streamline={'bundle': np.repeat(
+                uids, [len(sl) for sl in bundles]).astype(int)})
+        sft.to_vox()
+        return sft
 
     def _get_data_gtab(self, row, filter_b=True):
         img = nib.load(row['dwi_file'])
@@ -681,13 +819,17 @@ class AFQ(object):
             brain_mask, brain_affine, meta = \
                 self.brain_mask_definition.get_mask(self, row)
             brain_mask_img = nib.Nifti1Image(
-                brain_mask.astype(int),
+                brain_mask.astype(np.uint8),
                 brain_affine)
             self.log_and_save_nii(brain_mask_img, brain_mask_file)
             meta_fname = self._get_fname(row, '_brain_mask.json')
             afd.write_json(meta_fname, meta)
         return brain_mask_file
 
+    def _brain_mask_data(self, row):
+        brain_mask_img = nib.load(self._brain_mask(row))
+        return np.asanyarray(brain_mask_img.dataobj) > 0
+
     def _dti_fit(self, row):
         dti_params_file = self._dti(row)
         dti_params = nib.load(dti_params_file).get_fdata()
@@ -699,18 +841,17 @@ class AFQ(object):
         dti_params_file = self._get_fname(row, '_model-DTI_diffmodel.nii.gz')
         if not op.exists(dti_params_file):
             data, gtab, _ = self._get_data_gtab(row)
-            brain_mask_file = self._brain_mask(row)
-            mask = nib.load(brain_mask_file).get_fdata()
+            mask = self._brain_mask_data(row)
 
             if self.robust_tensor_fitting:
-                bvals, bvecs = read_bvals_bvecs(
-                    row['bval_file'], row['bvec_file'])
+                # Use the b-values of the volumes in data, after filtering:
                 sigma = noise_from_b0(
-                    data, gtab, bvals, mask=mask,
+                    data, gtab, gtab.bvals, mask=mask,
                     b0_threshold=self.b0_threshold)
             else:
                 sigma = None
-            dtf = dti_fit(gtab, data, mask=mask, sigma=sigma)
+            dtf = dti_fit(gtab, data, mask=mask, sigma=sigma,
+                          **self.parallel_params)
             self.log_and_save_nii(nib.Nifti1Image(dtf.model_params,
                                                   row['dwi_affine']),
                                   dti_params_file)
@@ -734,9 +875,8 @@ class AFQ(object):
         dki_params_file = self._get_fname(row, '_model-DKI_diffmodel.nii.gz')
         if not op.exists(dki_params_file):
             data, gtab, _ = self._get_data_gtab(row)
-            brain_mask_file = self._brain_mask(row)
-            mask = nib.load(brain_mask_file).get_fdata()
-            dkf = dki_fit(gtab, data, mask=mask)
+            mask = self._brain_mask_data(row)
+            dkf = dki_fit(gtab, data, mask=mask, **self.parallel_params)
             nib.save(nib.Nifti1Image(dkf.model_params, row['dwi_affine']),
                      dki_params_file)
             meta_fname = self._get_fname(row, '_model-DKI_diffmodel.json')
@@ -761,11 +901,12 @@ class AFQ(object):
             f'_model-{model_str}_diffmodel.nii.gz')
         if not op.exists(csd_params_file):
             data, gtab, _ = self._get_data_gtab(row)
-            brain_mask_file = self._brain_mask(row)
-            mask = nib.load(brain_mask_file).get_fdata()
+            mask = self._brain_mask_data(row)
             csdf = csd_fit(gtab, data, mask=mask,
                            response=response, sh_order=sh_order,
-                           lambda_=lambda_, tau=tau, msmt=msmt)
+                           lambda_=lambda_, tau=tau, msmt=msmt,
+                           cache_dir=op.join(self.afq_path, 'csd_cache'),
+                           **self.parallel_params)
             self.log_and_save_nii(nib.Nifti1Image(csdf.shm_coeff,
                                                   row['dwi_affine']),
                                   csd_params_file)
@@ -786,9 +927,11 @@ class AFQ(object):
             row, '_model-CSD_APM.nii.gz')
         if not op.exists(pmap_file):
             dwi_data, gtab, img = self._get_data_gtab(row)
-            mask = self._brain_mask(row)
+            mask = self._brain_mask_data(row)
             pmap = fit_anisotropic_power_map(
-                dwi_data, gtab, mask)
+                dwi_data, gtab, mask,
+                cache_dir=op.join(self.afq_path, 'csd_cache'),
+                **self.parallel_params)
             pmap = nib.Nifti1Image(pmap, img.affine)
             self.log_and_save_nii(pmap, pmap_file)
             meta_fname = self._get_fname(row, '_model-CSD_APM.json')
@@ -925,26 +1068,13 @@ class AFQ(object):
                 tg.to_rasmm()
                 return img, tg.streamlines
             elif img_l == "hcp_atlas":
-                atlas_fname = op.join(
-                    afd.afq_home,
-                    'hcp_atlas_16_bundles',
-                    'Atlas_in_MNI_Space_16_bundles',
-                    'whole_brain',
-                    'whole_brain_MNI.trk')
-                if not op.exists(atlas_fname):
-                    afd.fetch_hcp_atlas_16_bundles()
                 img = afd.read_mni_template(mask=self.mask_template)
-                hcp_atlas = load_tractogram(
-                    atlas_fname,
-                    'same', bbox_valid_check=False)
-
-                return img, hcp_atlas.streamlines
+                return img, afd.read_hcp_whole_brain(16)
             else:
                 img = nib.load(img)
 
         if mask:
-            brain_mask_file = self._brain_mask(row)
-            brain_mask = nib.load(brain_mask_file).get_fdata().astype(bool)
+            brain_mask = self._brain_mask_data(row)
 
             masked_data = img.get_fdata()
             masked_data[~brain_mask] = 0
@@ -979,18 +1109,8 @@ class AFQ(object):
 
         if not op.exists(b0_warped_file):
             b0_file = self._b0(row)
-            mean_b0 = nib.load(b0_file).get_fdata()
-
-            if self.use_prealign:
-                reg_prealign = np.load(self._reg_prealign(row))
-                reg_prealign_inv = np.linalg.inv(reg_prealign)
-            else:
-                reg_prealign_inv = None
-
-            mapping_file = self._mapping(row)
-            mapping = reg.read_mapping(mapping_file, b0_file,
-                                       self.reg_template_img,
-                                       prealign=reg_prealign_inv)
+            mean_b0 = self._read_volume(b0_file)
+            mapping = self._read_mapping(row, b0_file, "backward")
 
             warped_b0 = mapping.transform(mean_b0)
 
@@ -1009,8 +1129,11 @@ class AFQ(object):
             meta_fname = meta_fname + '_without_prealign'
         if self.reg_algo == "slr":
             mapping_file = mapping_file + '.npy'
-        else:
+        elif op.exists(mapping_file + '.nii.gz'):
+            # Mappings written by earlier versions are stacked in one nifti:
             mapping_file = mapping_file + '.nii.gz'
+        else:
+            mapping_file = mapping_file + '.npz'
         meta_fname = meta_fname + '.json'
 
         if not op.exists(mapping_file):
@@ -1026,12 +1149,20 @@ class AFQ(object):
 
             start_time = time()
             if self.reg_algo == "slr":
+                cluster_kwargs = dict(
+                    greater_than=self.segmentation_params["greater_than"],
+                    rm_small_clusters=self.segmentation_params[
+                        "rm_small_clusters"])
                 mapping = reg.slr_registration(
                     reg_subject_sls, reg_template_sls,
+                    static_centroids=afd.read_slr_centroids(
+                        reg_template_sls, **cluster_kwargs),
                     moving_affine=reg_subject_img.affine,
                     moving_shape=reg_subject_img.shape,
                     static_affine=reg_template_img.affine,
-                    static_shape=reg_template_img.shape)
+                    static_shape=reg_template_img.shape,
+                    select_random=self.segmentation_params["select_random"],
+                    **cluster_kwargs)
             else:
                 _, mapping = reg.syn_registration(
                     reg_subject_img.get_fdata(),
@@ -1066,9 +1197,9 @@ class AFQ(object):
             if odf_model == "DTI":
                 params_file = self._dti(row)
             elif odf_model == "CSD":
-                params_file = self._csd(row)
+                params_file = self._csd(row, **self.csd_params)
             elif odf_model == "MSMT":
-                params_file = self._csd(row, msmt=True)
+                params_file = self._csd(row, msmt=True, **self.csd_params)
             elif odf_model == "DKI":
                 params_file = self._dki(row)
 
@@ -1183,39 +1314,51 @@ class AFQ(object):
                                   Space.VOX)
 
             start_time = time()
-            tgram = nib.streamlines.Tractogram([], {'bundle': []})
+            bundle_names = [b for b in self.bundle_dict.keys()
+                            if b != "whole_brain"]
+            uids = np.array([self.bundle_dict[b]['uid']
+                             for b in bundle_names])
+            # Group the streamlines by bundle with one sort, instead of
+            # searching for each bundle's streamlines separately:
+            sl_bundle = np.asarray(sft.data_per_streamline['bundle']).ravel()
+            order = np.argsort(sl_bundle, kind='stable')
+            sorted_bundle = sl_bundle[order]
+            bundle_idx = [
+                order[np.searchsorted(sorted_bundle, uid, side='left'):
+                      np.searchsorted(sorted_bundle, uid, side='right')]
+                for uid in uids]
+
+            # Bundles are cleaned independently of each other:
+            kept_idx = parfor(
+                _clean_bundle_idx, bundle_idx,
+                n_jobs=max(min(len(bundle_idx),
+                               multiprocessing.cpu_count() - 1), 1),
+                engine="joblib", backend="threading",
+                func_args=[sft.streamlines, row['dwi_img'],
+                           self.clean_params])
+
             if self.clean_params['return_idx']:
-                return_idx = {}
-
-            for b in self.bundle_dict.keys():
-                if b != "whole_brain":
-                    idx = np.where(sft.data_per_streamline['bundle']
-                                   == self.bundle_dict[b]['uid'])[0]
-                    this_tg = StatefulTractogram(
-                        sft.streamlines[idx],
-                        row['dwi_img'],
-                        Space.VOX)
-                    this_tg = seg.clean_bundle(this_tg, **self.clean_params)
-                    if self.clean_params['return_idx']:
-                        this_tg, this_idx = this_tg
-                        idx_file = bundles_file.split('.')[0] + '_idx.json'
-                        with open(idx_file) as ff:
-                            bundle_idx = json.load(ff)[b]
-                        return_idx[b] = \
-                            np.array(bundle_idx)[this_idx].tolist()
-                    this_tgram = nib.streamlines.Tractogram(
-                        this_tg.streamlines,
-                        data_per_streamline={
-                            'bundle': (len(this_tg)
-                                       * [self.bundle_dict[b]['uid']])},
-                            affine_to_rasmm=row['dwi_affine'])
-                    tgram = aus.add_bundles(tgram, this_tgram)
+                idx_file = bundles_file.split('.')[0] + '_idx.json'
+                with open(idx_file) as ff:
+                    seg_idx = json.load(ff)
+                return_idx = {
+                    b: np.array(seg_idx[b])[this_idx].tolist()
+                    for b, this_idx in zip(bundle_names, kept_idx)}
+
+            # Gather all the kept streamlines into one contiguous buffer:
+            counts = np.array([len(this_idx) for this_idx in kept_idx],
+                              dtype=int)
+            sl_idx = np.concatenate(
+                [np.zeros(0, dtype=int)]
+                + [this_sl_idx[this_idx] for this_sl_idx, this_idx
+                   in zip(bundle_idx, kept_idx)])
             self.log_and_save_trk(
                 StatefulTractogram(
-                    tgram.streamlines,
+                    sft.streamlines[sl_idx].copy(),
                     sft,
                     Space.VOX,
-                    data_per_streamline=tgram.data_per_streamline),
+                    data_per_streamline={
+                        'bundle': np.repeat(uids, counts)}),
                 clean_bundles_file)
 
             seg_args = get_default_args(seg.clean_bundle)
@@ -1253,16 +1396,13 @@ class AFQ(object):
             profiles = np.empty((len(self.scalars), 0)).tolist()
             this_profile = np.zeros((len(self.scalars), 100))
 
-            trk = nib.streamlines.load(bundles_file)
-            for b in np.unique(
-                    trk.tractogram.data_per_streamline['bundle']):
-                idx = np.where(
-                    trk.tractogram.data_per_streamline['bundle'] == b)[0]
-                this_sl = trk.streamlines[idx]
+            bundle_index = self._read_bundle_index(bundles_file)
+            for b in np.sort(bundle_index['uids']):
+                this_sl = self._read_bundle(bundles_file, b)
                 bundle_name = reverse_dict[b]
                 for ii, scalar in enumerate(self.scalars):
                     scalar_file = self._scalar_dict[scalar](self, row)
-                    scalar_data = nib.load(scalar_file).get_fdata()
+                    scalar_data = self._read_volume(scalar_file)
                     this_profile[ii] = afq_profile(
                         scalar_data,
                         this_sl,
@@ -1291,18 +1431,7 @@ class AFQ(object):
     def _template_xform(self, row):
         template_xform_file = self._get_fname(row, "_template_xform.nii.gz")
         if not op.exists(template_xform_file):
-            if self.use_prealign:
-                reg_prealign_inv = np.linalg.inv(
-                    np.load(self._reg_prealign(row))
-                )
-            else:
-                reg_prealign_inv = None
-
-            mapping = reg.read_mapping(self._mapping(row),
-                                       row['dwi_file'],
-                                       self.reg_template_img,
-                                       prealign=reg_prealign_inv)
-
+            mapping = self._read_mapping(row, row['dwi_file'], "forward")
             template_xform = mapping.transform_inverse(
                 self.reg_template_img.get_fdata())
             self.log_and_save_nii(nib.Nifti1Image(template_xform,
@@ -1312,17 +1441,8 @@ class AFQ(object):
         return template_xform_file
 
     def _export_rois(self, row):
-        if self.use_prealign:
-            reg_prealign = np.load(self._reg_prealign(row))
-            reg_prealign_inv = np.linalg.inv(reg_prealign)
-        else:
-            reg_prealign_inv = None
-
-        mapping = reg.read_mapping(self._mapping(row),
-                                   row['dwi_file'],
-                                   self.reg_template_img,
-                                   prealign=reg_prealign_inv)
-
+        # The mapping is only read if some ROI still needs to be warped:
+        mapping = None
         rois_dir = op.join(row['results_dir'], 'ROIs')
         os.makedirs(rois_dir, exist_ok=True)
         roi_files = {}
@@ -1342,10 +1462,13 @@ class AFQ(object):
 
                 fname = op.join(rois_dir, fname[1])
                 if not op.exists(fname):
+                    if mapping is None:
+                        mapping = self._read_mapping(
+                            row, row['dwi_file'], "forward")
 
                     warped_roi = auv.patch_up_roi(
                         (mapping.transform_inverse(
-                            roi.get_fdata(),
+                            roi.get_fdata().astype(np.float32),
                             interpolation='linear')) > 0,
                         bundle_name=bundle).astype(int)
 
@@ -1367,15 +1490,11 @@ class AFQ(object):
 
             bundles_dir = op.join(row['results_dir'], folder)
             os.makedirs(bundles_dir, exist_ok=True)
-            trk = nib.streamlines.load(bundles_file)
-            tg = trk.tractogram
-            streamlines = tg.streamlines
             for bundle in self.bundle_dict:
                 if bundle != "whole_brain":
                     uid = self.bundle_dict[bundle]['uid']
-                    idx = np.where(tg.data_per_streamline['bundle'] == uid)[0]
                     this_sl = dtu.transform_tracking_output(
-                        streamlines[idx],
+                        self._read_bundle(bundles_file, uid),
                         np.linalg.inv(row['dwi_affine']))
 
                     this_tgm = StatefulTractogram(this_sl, row['dwi_img'],
@@ -1395,31 +1514,17 @@ class AFQ(object):
 
     def _export_sl_counts(self, row):
         total_file = self._streamlines(row)
-        total_sl = len(nib.streamlines.load(total_file).tractogram.streamlines)
-        sl_counts = []
-        for func, folder in zip([self._clean_bundles, self._segment],
-                                ['clean_bundles', 'bundles']):
-            sl_counts.append([])
-            bundles_file = func(row)
-            trk = nib.streamlines.load(bundles_file)
-            tg = trk.tractogram
-            streamlines = tg.streamlines
-            for bundle in self.bundle_dict:
-                if bundle != "whole_brain":
-                    uid = self.bundle_dict[bundle]['uid']
-                    idx = np.where(tg.data_per_streamline['bundle'] == uid)[0]
-                    this_sl = dtu.transform_tracking_output(
-                        streamlines[idx],
-                        np.linalg.inv(row['dwi_affine']))
-
-                    this_tgm = StatefulTractogram(this_sl, row['dwi_img'],
-                                                  Space.VOX)
-                    sl_counts[-1].append(len(this_tgm.streamlines))
-            sl_counts[-1].append(total_sl)
-
+        total_sl = aus.count_streamlines(total_file)
         bundle_list = list(self.bundle_dict.keys())
         if 'whole_brain' in bundle_list:
             bundle_list.remove('whole_brain')
+        uids = [self.bundle_dict[bundle]['uid'] for bundle in bundle_list]
+
+        sl_counts = []
+        for func in [self._clean_bundles, self._segment]:
+            sl_counts.append(
+                aus.count_bundle_streamlines(func(row), uids).tolist()
+                + [total_sl])
         bundle_list.append("Total")
 
         sl_counts = pd.DataFrame(
@@ -1437,10 +1542,9 @@ class AFQ(object):
 
     def _viz_prepare_vol(self, row, vol, xform, mapping):
         if vol in self.scalars:
-            vol = nib.load(
-                self._scalar_dict[vol](self, row)).get_fdata()
+            vol = self._read_volume(self._scalar_dict[vol](self, row))
         if isinstance(vol, str):
-            vol = nib.load(vol).get_fdata()
+            vol = self._read_volume(vol)
         if xform:
             vol = mapping.transform_inverse(vol)
         return vol
@@ -1456,16 +1560,7 @@ class AFQ(object):
             color_by_volume = self._get_best_scalar()
 
         if xform_volume or xform_color_by_volume:
-            if self.use_prealign:
-                reg_prealign = np.load(self._reg_prealign(row))
-                reg_prealign_inv = np.linalg.inv(reg_prealign)
-            else:
-                reg_prealign_inv = None
-
-            mapping = reg.read_mapping(self._mapping(row),
-                                       row['dwi_file'],
-                                       self.reg_template_img,
-                                       prealign=reg_prealign_inv)
+            mapping = self._read_mapping(row, row['dwi_file'], "forward")
         else:
             mapping = None
 
@@ -1507,7 +1602,11 @@ class AFQ(object):
                                            interact=False,
                                            inline=False)
 
-        figure = self.viz.visualize_bundles(bundles_file,
+        sft = self._read_bundles_sft(
+            row, bundles_file,
+            [self.bundle_dict[b]['uid'] for b in self.bundle_dict
+             if b != "whole_brain"])
+        figure = self.viz.visualize_bundles(sft,
                                             color_by_volume=color_by_volume,
                                             bundle_dict=self.bundle_dict,
                                             n_points=n_points,
@@ -1560,6 +1659,7 @@ class AFQ(object):
         if bundle_names is None:
             bundle_names = self.bundle_dict.keys()
 
+        roi_files = self._export_rois(row)
         for bundle_name in bundle_names:
             self.logger.info(f"Generating {bundle_name} visualization...")
             uid = self.bundle_dict[bundle_name]['uid']
@@ -1568,7 +1668,7 @@ class AFQ(object):
                                                inline=False)
             try:
                 figure = self.viz.visualize_bundles(
-                    bundles_file,
+                    self._read_bundles_sft(row, bundles_file, [uid]),
                     color_by_volume=color_by_volume,
                     bundle_dict=self.bundle_dict,
                     bundle=uid,
@@ -1580,7 +1680,6 @@ class AFQ(object):
                 self.logger.info("No streamlines found to visualize for "
                                  + bundle_name)
 
-            roi_files = self._export_rois(row)
             for i, roi in enumerate(roi_files[bundle_name]):
                 if i == len(roi_files[bundle_name]) - 1:  # show on last ROI
                     figure = self.viz.visualize_roi(
@@ -1972,15 +2071,22 @@ class AFQ(object):
 
     def export_all(self):
         """ Exports all the possible outputs"""
-        self.export_registered_b0()
-        self.get_template_xform()
-        self.export_bundles()
-        self.export_sl_counts()
-        self.get_tract_profiles()
-        self.viz_bundles(export=True)
-        if self.seg_algo == "afq":
-            self.viz_ROIs(export=True)
-            self.export_rois()
+        # Run all the exports of one subject before moving on to the next,
+        # so that what they read is read once, and kept only while needed:
+        for _, row in self.data_frame.iterrows():
+            with self._export_session():
+                self._export_registered_b0(row)
+                self._template_xform(row)
+                self._export_bundles(row)
+                self._export_sl_counts(row)
+                self._tract_profiles(row)
+                self._viz_bundles(row, export=True)
+                if self.seg_algo == "afq":
+                    self._viz_ROIs(row, export=True)
+                    self._export_rois(row)
+        # The outputs exist now, so this just records their file names:
+        self.set_template_xform()
+        self.set_tract_profiles()
         if len(self.tract_profiles) > 1:
             self.combine_profiles()
         self.export_timing()
@@ -1990,6 +2096,166 @@ class AFQ(object):
         s3fs.put(self.afq_path, remote_path, recursive=True)
 
 
+def _upload_new_files(afq_path, remote_path, fs, uploaded, executor):
+    """
+    Upload the files in `afq_path` that are new or changed since they were
+    recorded in `uploaded`, and return the upload futures.
+    """
+    futures = []
+    for dirpath, _, fnames in os.walk(afq_path):
+        for fname in fnames:
+            local = op.join(dirpath, fname)
+            stat = os.stat(local)
+            version = (stat.st_mtime_ns, stat.st_size)
+            if uploaded.get(local, (None,))[0] == version:
+                continue
+            # Keep uploads of the same file in order:
+            if local in uploaded:
+                uploaded[local][1].result()
+            remote = '/'.join([remote_path.rstrip('/'),
+                               op.relpath(local, afq_path)])
+            future = executor.submit(fs.put_file, local, remote)
+            uploaded[local] = (version, future)
+            futures.append(future)
+    return futures
+
+
+def run_s3_study(study, remote_path, fs=None, afq_kwargs=None,
+                 steps=("dti", "mapping", "streamlines", "clean_bundles",
+                        "tract_profiles", "export_all"),
+                 include_derivs="dmriprep", n_prefetch=2, scratch_dir=None,
+                 _afq_class=None):
+    """
+    Run pyAFQ on each subject of a study on S3, without staging the whole
+    study locally.
+
+    Subjects are downloaded into a scratch directory by a background
+    thread, which keeps up to `n_prefetch` subjects ready ahead of the
+    subject being processed. The derivatives of each subject are uploaded
+    as each step completes, and its scratch directory is removed once they
+    are uploaded.
+
+    Parameters
+    ----------
+    study : AFQ.data.S3BIDSStudy
+        The study, with the subjects to process.
+    remote_path : str
+        S3 location (including the bucket name) of the AFQ derivatives,
+        e.g. "bucket/study/derivatives/afq".
+    fs : s3fs.S3FileSystem, optional
+        File-system used for the uploads. Default: a new file-system.
+    afq_kwargs : dict, optional
+        Keyword arguments used to initialize the AFQ object of each subject
+        (except for `bids_path`). Default: {}
+    steps : sequence of str
+        Names of the AFQ attributes computed, in order. Callables (e.g.
+        "export_all") are called. Default: ("dti", "mapping",
+        "streamlines", "clean_bundles", "tract_profiles", "export_all")
+    include_derivs : bool or str
+        Which derivatives of each subject to download (see
+        AFQ.data.S3BIDSSubject.download). Default: "dmriprep"
+    n_prefetch : int
+        Number of subjects downloaded ahead. Default: 2
+    scratch_dir : str, optional
+        Directory in which the temporary subject directories are created.
+        Default: the system's temporary directory.
+    _afq_class : object
+        The class used to process each subject. This parameter has a leading
+        underscore because you probably don't want to change it.
+        Default: AFQ
+
+    Returns
+    -------
+    list of the subject IDs that were processed.
+    """
+    if not isinstance(n_prefetch, int) or n_prefetch < 1:
+        raise ValueError("n_prefetch must be a positive integer.")
+    if fs is None:
+        fs = s3fs.S3FileSystem()
+    if afq_kwargs is None:
+        afq_kwargs = {}
+    if _afq_class is None:
+        _afq_class = AFQ
+    logger = logging.getLogger('AFQ.api')
+
+    processed = []
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as t_dir:
+        prefetched = queue.Queue(maxsize=n_prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    prefetched.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+
+        def prefetch():
+            for sub in study.subjects:
+                if stop.is_set():
+                    return
+                sub_dir = op.join(t_dir, sub.subject_id)
+                try:
+                    study._download_non_sub_keys(sub_dir)
+                    if include_derivs is not False:
+                        study._download_derivative_descriptions(
+                            include_derivs, sub_dir)
+                    sub.download(sub_dir, include_derivs=include_derivs,
+                                 pbar=False)
+                except Exception as e:
+                    put(e)
+                    return
+                put((sub, sub_dir))
+            put(None)
+
+        producer = threading.Thread(target=prefetch, daemon=True)
+        producer.start()
+        # Subject directories whose derivatives are being uploaded:
+        pending = []
+        with ThreadPoolExecutor(
+                max_workers=afd.S3_MAX_CONCURRENCY) as executor:
+            try:
+                while True:
+                    item = prefetched.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    sub, sub_dir = item
+                    logger.info(f"Processing {sub.subject_id}")
+
+                    myafq = _afq_class(bids_path=sub_dir, **afq_kwargs)
+                    uploaded = {}
+                    futures = []
+                    for step in steps:
+                        result = getattr(myafq, step)
+                        if callable(result):
+                            result()
+                        futures += _upload_new_files(
+                            myafq.afq_path, remote_path, fs, uploaded,
+                            executor)
+                    pending.append((futures, sub_dir))
+                    processed.append(sub.subject_id)
+
+                    # Clean up the subjects that are done uploading:
+                    for sub_futures, done_dir in list(pending):
+                        if all(future.done() for future in sub_futures):
+                            for future in sub_futures:
+                                future.result()
+                            shutil.rmtree(done_dir)
+                            pending.remove((sub_futures, done_dir))
+                for sub_futures, done_dir in pending:
+                    for future in sub_futures:
+                        future.result()
+                    shutil.rmtree(done_dir)
+            finally:
+                stop.set()
+                producer.join()
+
+    return processed
+
+
 def download_and_combine_afq_profiles(out_file, bucket, study_s3_prefix,
                                       upload=None, session=None):
     """
@@ -1,10 +1,16 @@
-from io import BytesIO
+import functools
 import gzip
+import hashlib
 import os
 import os.path as op
 import json
+import re
 from glob import glob
 import shutil
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
 import s3fs
@@ -14,7 +20,6 @@ import pandas as pd
 import logging
 import time
 
-from bids import BIDSLayout
 from botocore import UNSIGNED
 from botocore.client import Config
 from dask import compute, delayed
@@ -22,6 +27,8 @@ from dask.diagnostics import ProgressBar
 from pathlib import Path
 from tqdm.auto import tqdm
 import nibabel as nib
+from nibabel.fileslice import canonical_slicers, is_fancy
+from nibabel.volumeutils import apply_read_scaling
 
 # capture templateflow resource warning and log
 import warnings
@@ -46,6 +53,7 @@ finally:
 import dipy.data as dpd
 from dipy.data.fetcher import _make_fetcher
 from dipy.io.streamline import load_tractogram, load_trk
+from dipy.tracking.streamline import Streamlines
 from dipy.segment.metric import (AveragePointwiseEuclideanMetric,
                                  ResampleFeature)
 
@@ -53,6 +61,7 @@ from dipy.segment.metric import (AveragePointwiseEuclideanMetric,
 from dipy.segment.clustering import QuickBundles
 
 import AFQ.registration as reg
+from AFQ.utils.parallel import parfor
 
 __all__ = ["fetch_callosum_templates", "read_callosum_templates",
            "fetch_templates", "read_templates", "fetch_hcp",
@@ -141,6 +150,12 @@ fetch_callosum_templates = _make_fetcher("fetch_callosum_templates",
 def read_callosum_templates(resample_to=False):
     """Load AFQ callosum templates from file
 
+    Parameters
+    ----------
+    resample_to : str or Nifti1Image, optional
+        If set, templates are resampled to the affine and shape of this
+        image (see `read_templates`).
+
     Returns
     -------
     dict with: keys: names of template ROIs and values: nibabel Nifti1Image
@@ -153,18 +168,8 @@ def read_callosum_templates(resample_to=False):
     logger.debug('loading callosum templates')
     tic = time.perf_counter()
 
-    template_dict = {}
-    for f in files:
-        img = nib.load(op.join(folder, f))
-        if resample_to:
-            if isinstance(resample_to, str):
-                resample_to = nib.load(resample_to)
-            img = nib.Nifti1Image(reg.resample(img.get_fdata(),
-                                               resample_to,
-                                               img.affine,
-                                               resample_to.affine),
-                                  resample_to.affine)
-        template_dict[f.split('.')[0]] = img
+    template_dict = _read_template_files(
+        files, folder, resample_to, 'callosum_templates')
 
     toc = time.perf_counter()
     logger.debug(f'callosum templates loaded in {toc - tic:0.4f} seconds')
@@ -172,6 +177,120 @@ def read_callosum_templates(resample_to=False):
     return template_dict
 
 
+def _resample_key(img):
+    """
+    A key for caching data resampled to the affine and shape of `img`
+    """
+    hasher = hashlib.sha1()
+    hasher.update(np.asarray(img.affine, dtype=np.float64).tobytes())
+    hasher.update(np.asarray(img.shape[:3], dtype=np.int64).tobytes())
+    return hasher.hexdigest()
+
+
+def _resample_template_file(in_fname, cache_dir, affine, shape):
+    out_fname = op.join(cache_dir, op.basename(in_fname))
+    img = nib.load(in_fname)
+    resampled = reg.resample(img.get_fdata(), np.empty(shape, dtype=bool),
+                             img.affine, affine)
+    # Write to a temporary file first, so that a cached template is never
+    # read half-written:
+    tmp_fname = out_fname.replace('.nii.gz', f'_{os.getpid()}.nii.gz')
+    nib.save(nib.Nifti1Image(resampled.astype(np.float32), affine),
+             tmp_fname)
+    os.replace(tmp_fname, out_fname)
+
+
+def _read_template_files(files, folder, resample_to, name):
+    """
+    Load template files as nibabel images, whose data is only read on
+    first access. If `resample_to` is given, the templates are resampled
+    to it once and cached under afq_home, keyed by its affine and shape;
+    missing templates are resampled in parallel.
+    """
+    if not resample_to:
+        return {f.split('.')[0]: nib.load(op.join(folder, f))
+                for f in files}
+
+    if isinstance(resample_to, str):
+        resample_to = nib.load(resample_to)
+    affine = resample_to.affine
+    shape = resample_to.shape[:3]
+    cache_dir = op.join(afq_home, 'resampled_templates', name,
+                        _resample_key(resample_to))
+    os.makedirs(cache_dir, exist_ok=True)
+
+    cached = {f: op.join(cache_dir, f) for f in files}
+    missing = [f for f in files if not op.exists(cached[f])]
+    if len(missing):
+        n_jobs = min(len(missing), max(multiprocessing.cpu_count() - 1, 1))
+        parfor(_resample_template_file,
+               [op.join(folder, f) for f in missing],
+               n_jobs=n_jobs, engine="joblib", backend="loky",
+               func_args=[cache_dir, affine, shape])
+    return {f.split('.')[0]: nib.load(cached[f]) for f in files}
+
+
+# Number of decoded templates kept in memory in each process:
+TEMPLATE_CACHE_SIZE = 32
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _read_template_data(fname):
+    """Decode the data of a template file, as a read-only array"""
+    data = nib.load(fname).get_fdata()
+    data.flags.writeable = False
+    return data
+
+
+class TemplateFile:
+    """A lazy reference to a template nifti file
+
+    Only the file name is stored (and pickled), so bundle dictionaries
+    made of these are cheap to send to parallel workers. The data is read
+    on first access and shared, read-only, between all references to the
+    same file in a process. The `TEMPLATE_CACHE_SIZE` most recently used
+    templates are kept in memory.
+    """
+
+    def __init__(self, fname):
+        """Initialize a TemplateFile instance
+
+        Parameters
+        ----------
+        fname : str
+            Path to a nifti file.
+        """
+        if not isinstance(fname, str):
+            raise TypeError('fname must be a string.')
+
+        self._fname = fname
+
+    @property
+    def fname(self):
+        """The path to the nifti file"""
+        return self._fname
+
+    @property
+    def affine(self):
+        """The affine of the template, read from the file header"""
+        return nib.load(self._fname).affine
+
+    @property
+    def shape(self):
+        """The shape of the template, read from the file header"""
+        return nib.load(self._fname).shape
+
+    def get_filename(self):
+        return self._fname
+
+    def get_fdata(self):
+        """Read-only template data, decoded on first access"""
+        return _read_template_data(self._fname)
+
+    def __repr__(self):
+        return f'{type(self).__name__}(fname={self._fname})'
+
+
 def read_resample_roi(roi, resample_to=None, threshold=False):
     """
     Reads an roi from file-name/img and resamples it to conform with
@@ -379,10 +498,18 @@ fetch_templates = _make_fetcher("fetch_templates",
 def read_templates(resample_to=False):
     """Load AFQ templates from file
 
+    Parameters
+    ----------
+    resample_to : str or Nifti1Image, optional
+        If set, templates are resampled to the affine and shape of this
+        image. Resampled templates are cached under `afq_home`, so they are
+        only resampled once for each affine and shape.
+
     Returns
     -------
     dict with: keys: names of template ROIs and values: nibabel Nifti1Image
-    objects from each of the ROI nifti files.
+    objects from each of the ROI nifti files. The data of each image is
+    only read when it is first accessed.
     """
     logger = logging.getLogger('AFQ.data')
 
@@ -391,18 +518,8 @@ def read_templates(resample_to=False):
     logger.debug('loading AFQ templates')
     tic = time.perf_counter()
 
-    template_dict = {}
-    for f in files:
-        img = nib.load(op.join(folder, f))
-        if resample_to:
-            if isinstance(resample_to, str):
-                resample_to = nib.load(resample_to)
-            img = nib.Nifti1Image(reg.resample(img.get_fdata(),
-                                               resample_to,
-                                               img.affine,
-                                               resample_to.affine),
-                                  resample_to.affine)
-        template_dict[f.split('.')[0]] = img
+    template_dict = _read_template_files(files, folder, resample_to,
+                                         'templates')
 
     toc = time.perf_counter()
     logger.debug(f'AFQ templates loaded in {toc - tic:0.4f} seconds')
@@ -468,22 +585,12 @@ def _ls_s3fs(s3_prefix, anon=True):
     fs = s3fs.S3FileSystem(anon=anon)
     site_files = fs.ls(s3_prefix, detail=False)
 
-    # Just need BIDSLayout for the `parse_file_entities` method
-    # so we can pass dev/null as the argument
-    layout = BIDSLayout(os.devnull, validate=False)
-
-    entities = [
-        layout.parse_file_entities(f) for f in site_files
-    ]
-
     files = {
         'subjects': [
-            f for f, e in zip(site_files, entities)
-            if e.get('subject') is not None
+            f for f in site_files if _subject_pattern.search(f)
         ],
         'other': [
-            f for f, e in zip(site_files, entities)
-            if e.get('subject') is None
+            f for f in site_files if not _subject_pattern.search(f)
         ]
     }
 
@@ -547,9 +654,83 @@ def _get_matching_s3_keys(bucket, prefix='', suffix='', anon=True):
             break
 
 
-def _download_from_s3(fname, bucket, key, overwrite=False, anon=True):
+# Maximum number of concurrent S3 GET requests, across all downloads in this
+# process:
+S3_MAX_CONCURRENCY = 16
+_s3_slots = threading.BoundedSemaphore(S3_MAX_CONCURRENCY)
+
+# Objects larger than this are downloaded in ranged parts of this size:
+S3_PART_SIZE = 16 * 1024 ** 2
+
+# boto3 clients are not thread safe, so every thread gets its own client:
+_thread_s3_clients = threading.local()
+
+
+def _get_thread_s3_client(anon=True):
+    """Return the S3 client of the calling thread, creating it if needed"""
+    clients = getattr(_thread_s3_clients, 'clients', None)
+    if clients is None:
+        clients = _thread_s3_clients.clients = {}
+    if anon not in clients:
+        clients[anon] = get_s3_client(anon=anon)
+    return clients[anon]
+
+
+def _etag_fname(fname):
+    """Return the hidden file that records the ETag of a downloaded file"""
+    return op.join(op.dirname(fname), '.' + op.basename(fname) + '.etag')
+
+
+def _record_etag(fname, etag):
+    """Record that `fname`, as it is now, matches the S3 ETag `etag`"""
+    stat = os.stat(fname)
+    write_json(_etag_fname(fname), {'etag': etag.strip('"'),
+                                    'size': stat.st_size,
+                                    'mtime_ns': stat.st_mtime_ns})
+
+
+def _is_downloaded(fname, size, etag):
+    """Check whether a local file matches an S3 object's size and ETag
+
+    The size is compared first. The content is only hashed if the ETag is
+    the MD5 of a single-part upload and the file was not already verified
+    against this ETag, since it was last modified.
+    """
+    if not op.exists(fname) or op.getsize(fname) != size:
+        return False
+    etag = etag.strip('"')
+    if '-' in etag:
+        # ETags of multipart uploads are not the MD5 of the content, so we
+        # can only rely on the size:
+        return True
+    try:
+        record = read_json(_etag_fname(fname))
+    except (OSError, ValueError):
+        record = {}
+    stat = os.stat(fname)
+    if record == {'etag': etag, 'size': stat.st_size,
+                  'mtime_ns': stat.st_mtime_ns}:
+        return True
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as ff:
+        for chunk in iter(lambda: ff.read(S3_PART_SIZE), b''):
+            md5.update(chunk)
+    if md5.hexdigest() != etag:
+        return False
+    _record_etag(fname, etag)
+    return True
+
+
+def _download_from_s3(fname, bucket, key, overwrite=False, anon=True,
+                      size=None, etag=None, part_size=S3_PART_SIZE):
     """Download object from S3 to local file
 
+    Objects larger than `part_size` are downloaded with concurrent ranged
+    GET requests. The object is first written to `fname` + '.part', and the
+    parts that were completed are recorded next to it, so an interrupted
+    download resumes where it stopped. At most `S3_MAX_CONCURRENCY`
+    requests are made at the same time, across all downloads.
+
     Parameters
     ----------
     fname : str
@@ -563,19 +744,257 @@ def _download_from_s3(fname, bucket, key, overwrite=False, anon=True):
 
     overwrite : bool
         If True, overwrite file if it already exists.
-        If False, skip download and return. Default: False
+        If False, skip download if the local file has the same size and
+        ETag as the object. Default: False
 
     anon : bool
         Whether to use anonymous connection (public buckets only).
         If False, uses the key/secret given, or boto’s credential
         resolver (client_kwargs, environment, variables, config files,
         EC2 IAM server, in that order). Default: True
+
+    size : int, optional
+        Size of the object, e.g. from `read_s3_key_index`. If given with
+        `etag`, an existing local file is checked against these values,
+        without requesting the object's metadata from S3. Default: None
+
+    etag : str, optional
+        ETag of the object, e.g. from `read_s3_key_index`. Default: None
+
+    part_size : int, optional
+        Size, in bytes, of the ranged requests. Default: S3_PART_SIZE
     """
+    checked = None
+    if not overwrite and size is not None and etag is not None:
+        if _is_downloaded(fname, size, etag):
+            return
+        checked = (size, etag.strip('"'))
+
+    client = _get_thread_s3_client(anon=anon)
+    head = client.head_object(Bucket=bucket, Key=key)
+    size = head['ContentLength']
+    etag = head['ETag']
+    if (not overwrite and (size, etag.strip('"')) != checked
+            and _is_downloaded(fname, size, etag)):
+        return
+
     # Create the directory and file if necessary
-    fs = s3fs.S3FileSystem(anon=anon)
-    if overwrite or not op.exists(fname):
-        Path(op.dirname(fname)).mkdir(parents=True, exist_ok=True)
-        fs.get("/".join([bucket, key]), fname)
+    Path(op.dirname(fname)).mkdir(parents=True, exist_ok=True)
+    part_fname = fname + '.part'
+    state_fname = fname + '.part.json'
+    parts = [(start, min(start + part_size, size) - 1)
+             for start in range(0, size, part_size)]
+
+    done = set()
+    if not overwrite and op.exists(part_fname) and op.exists(state_fname):
+        try:
+            state = read_json(state_fname)
+        except ValueError:
+            state = {}
+        if (state.get('etag') == etag
+                and state.get('part_size') == part_size
+                and op.getsize(part_fname) == size):
+            done = set(state['done'])
+    if not done:
+        with open(part_fname, 'wb') as ff:
+            ff.truncate(size)
+
+    lock = threading.Lock()
+
+    def get_part(idx):
+        start, end = parts[idx]
+        with _s3_slots:
+            response = _get_thread_s3_client(anon=anon).get_object(
+                Bucket=bucket, Key=key,
+                Range=f'bytes={start}-{end}', IfMatch=etag)
+            body = response['Body'].read()
+        with open(part_fname, 'r+b') as ff:
+            ff.seek(start)
+            ff.write(body)
+        if len(parts) > 1:
+            with lock:
+                done.add(idx)
+                write_json(state_fname, {'etag': etag,
+                                         'part_size': part_size,
+                                         'done': sorted(done)})
+
+    todo = [idx for idx in range(len(parts)) if idx not in done]
+    if len(todo) == 1:
+        get_part(todo[0])
+    elif len(todo) > 1:
+        with ThreadPoolExecutor(
+                max_workers=min(len(todo), S3_MAX_CONCURRENCY)) as executor:
+            for future in as_completed(
+                    [executor.submit(get_part, idx) for idx in todo]):
+                future.result()
+
+    os.replace(part_fname, fname)
+    if op.exists(state_fname):
+        os.remove(state_fname)
+    _record_etag(fname, etag)
+
+
+# The BIDS subject entity, as parsed by `BIDSLayout.parse_file_entities`:
+_subject_pattern = re.compile(r'[/\\]+sub-([a-zA-Z0-9]+)')
+
+
+def _list_s3_objects(client, bucket, prefix, delimiter=None):
+    """List all objects under an S3 prefix, following pagination
+
+    Returns
+    -------
+    objects : list of (key, size, etag) tuples
+    prefixes : list of common prefixes (only if `delimiter` is set)
+    """
+    kwargs = {'Bucket': bucket, 'Prefix': prefix, 'MaxKeys': 1000}
+    if delimiter is not None:
+        kwargs['Delimiter'] = delimiter
+
+    objects = []
+    prefixes = []
+    while True:
+        with _s3_slots:
+            resp = client.list_objects_v2(**kwargs)
+        objects += [(obj['Key'], obj['Size'], obj['ETag'].strip('"'))
+                    for obj in resp.get('Contents', [])]
+        prefixes += [pp['Prefix'] for pp in resp.get('CommonPrefixes', [])]
+        if not resp.get('IsTruncated'):
+            return objects, prefixes
+        kwargs['ContinuationToken'] = resp['NextContinuationToken']
+
+
+def read_s3_key_index(bucket, s3_prefix, anon=True, use_stored=False,
+                      refresh=False, max_depth=3):
+    """Read the index of all S3 keys of a study
+
+    The study is walked "directory" by "directory" down to the subject
+    folders (or `max_depth` levels). The index is stored under `afq_home`,
+    and updated by listing the subject folders in parallel:
+
+    - Subject folders that are not in the stored index are listed.
+    - For the other subject folders, only their top level is listed. The
+      whole folder is only listed again if this finds objects that were
+      added, removed, or changed (by size or ETag), or folders that were
+      added or removed.
+
+    Objects added to or changed in the folders of a subject folder that
+    were already indexed (e.g. in its "dwi" folder) are only found with
+    `refresh`.
+
+    Parameters
+    ----------
+    bucket : str
+        S3 bucket name
+
+    s3_prefix : str
+        The S3 prefix common to all of the study objects on S3
+
+    anon : bool
+        Whether to use anonymous connection (public buckets only).
+        If False, uses the key/secret given, or boto’s credential
+        resolver (client_kwargs, environment, variables, config files,
+        EC2 IAM server, in that order). Default: True
+
+    use_stored : bool
+        If True, and the study was indexed before, return the stored index
+        without listing the study. Objects that were added or changed since
+        then are missing from it. Default: False
+
+    refresh : bool
+        If True, list all of the subject folders again, instead of only the
+        new or changed ones. Default: False
+
+    max_depth : int
+        Maximum number of folder levels walked to look for subject folders.
+        Default: 3
+
+    Returns
+    -------
+    pandas.DataFrame with columns "key", "size", "etag" and "prefix" (the
+    folder through which the key was listed), sorted by key.
+    """
+    root = s3_prefix.strip('/')
+    if root:
+        root = root + '/'
+    index_dir = op.join(afq_home, 's3_key_index')
+    os.makedirs(index_dir, exist_ok=True)
+    index_fname = op.join(
+        index_dir,
+        f'{bucket}_{hashlib.sha1(root.encode()).hexdigest()[:16]}.csv.gz')
+
+    columns = ['key', 'size', 'etag', 'prefix']
+    stored = {}
+    if op.exists(index_fname):
+        stored_index = pd.read_csv(index_fname, dtype={'key': str,
+                                                       'etag': str,
+                                                       'prefix': str},
+                                   keep_default_na=False)
+        if use_stored:
+            return stored_index
+        if not refresh:
+            stored = dict(tuple(stored_index.groupby('prefix')))
+
+    # boto3 clients are not thread safe, so each thread uses its own:
+    def list_folder(prefix):
+        return _list_s3_objects(_get_thread_s3_client(anon=anon), bucket,
+                                prefix, delimiter='/')
+
+    def list_all(prefix):
+        return _list_s3_objects(_get_thread_s3_client(anon=anon), bucket,
+                                prefix)[0]
+
+    def is_unchanged(prefix, objects, prefixes):
+        """Compare the top level of a folder with its stored index"""
+        rows = stored[prefix]
+        names = rows['key'].str.slice(len(prefix))
+        top = ~names.str.contains('/', regex=False)
+        return (
+            set(objects) == {(k, int(n), e) for k, n, e in zip(
+                rows['key'][top], rows['size'][top], rows['etag'][top])}
+            and set(prefixes) == {
+                prefix + name.split('/')[0] + '/' for name in names[~top]})
+
+    rows = []
+    leaves = []
+    level = [root]
+    with ThreadPoolExecutor(max_workers=S3_MAX_CONCURRENCY) as executor:
+        # Walk the folders that are not subject folders:
+        for depth in range(max_depth):
+            next_level = []
+            for prefix, (objects, prefixes) in zip(
+                    level, executor.map(list_folder, level)):
+                rows += [(*obj, prefix) for obj in objects]
+                for sub_prefix in prefixes:
+                    if (op.basename(sub_prefix.rstrip('/')).startswith('sub-')
+                            or depth == max_depth - 1):
+                        leaves.append(sub_prefix)
+                    else:
+                        next_level.append(sub_prefix)
+            level = next_level
+            if not level:
+                break
+
+        # Keep the stored index of the subject folders that did not change:
+        known = [prefix for prefix in leaves if prefix in stored]
+        to_list = [prefix for prefix in leaves if prefix not in stored]
+        for prefix, (objects, prefixes) in zip(
+                known, executor.map(list_folder, known)):
+            if is_unchanged(prefix, objects, prefixes):
+                rows += list(stored[prefix][columns].itertuples(
+                    index=False, name=None))
+            else:
+                to_list.append(prefix)
+
+        for prefix, objects in zip(to_list, executor.map(list_all, to_list)):
+            rows += [(*obj, prefix) for obj in objects]
+
+    index = pd.DataFrame(rows, columns=columns)
+    index = index.sort_values('key').reset_index(drop=True)
+
+    tmp_fname = index_fname.replace('.csv.gz', f'_{os.getpid()}.csv.gz')
+    index.to_csv(tmp_fname, index=False)
+    os.replace(tmp_fname, index_fname)
+    return index
 
 
 class S3BIDSSubject:
@@ -656,17 +1075,11 @@ class S3BIDSSubject:
         }
 
         s3_keys = {
-            'raw': list(set(_get_matching_s3_keys(
-                bucket=self.study.bucket,
-                prefix=prefixes['raw'],
-                anon=self.study.anon,
-            ))),
+            'raw': self.study._get_indexed_s3_keys(prefixes['raw']),
             'derivatives': {
-                dt: list(set(_get_matching_s3_keys(
-                    bucket=self.study.bucket,
-                    prefix=prefixes['derivatives'][dt],
-                    anon=self.study.anon,
-                ))) for dt in self.study.derivative_types
+                dt: self.study._get_indexed_s3_keys(
+                    prefixes['derivatives'][dt]
+                ) for dt in self.study.derivative_types
             }
         }
 
@@ -810,15 +1223,34 @@ class S3BIDSSubject:
                             position=pbar_idx,
                             total=len(download_pairs) + 1)
 
-        for (key, fname) in download_pairs:
-            _download_from_s3(fname=fname,
-                              bucket=self.study.bucket,
-                              key=key,
-                              overwrite=overwrite,
-                              anon=self.study.anon)
-
-            if pbar:
-                progress.update()
+        # The sizes and ETags in the key index are used to skip files that
+        # were already downloaded, without a request to S3:
+        index = self.study._key_index
+        keys = [key for (key, fname) in download_pairs]
+        rows = np.searchsorted(self.study._index_keys, keys)
+        rows = np.minimum(rows, max(len(index) - 1, 0))
+        indexed = {key: (int(index['size'].iat[row]), index['etag'].iat[row])
+                   for key, row in zip(keys, rows)
+                   if len(index) and self.study._index_keys[row] == key}
+
+        # Download files concurrently. The number of requests in flight is
+        # bounded by S3_MAX_CONCURRENCY across all subjects:
+        with ThreadPoolExecutor(max_workers=S3_MAX_CONCURRENCY) as executor:
+            futures = []
+            for (key, fname) in download_pairs:
+                size, etag = indexed.get(key, (None, None))
+                futures.append(executor.submit(_download_from_s3,
+                                               fname=fname,
+                                               bucket=self.study.bucket,
+                                               key=key,
+                                               overwrite=overwrite,
+                                               anon=self.study.anon,
+                                               size=size,
+                                               etag=etag))
+            for future in as_completed(futures):
+                future.result()
+                if pbar:
+                    progress.update()
 
         if pbar:
             progress.update()
@@ -885,11 +1317,8 @@ class HBNSubject(S3BIDSSubject):
         }
 
         s3_keys = {
-            datatype: list(set(_get_matching_s3_keys(
-                bucket=self.study.bucket,
-                prefix=prefix,
-                anon=self.study.anon,
-            ))) for datatype, prefix in prefixes.items()
+            datatype: self.study._get_indexed_s3_keys(prefix)
+            for datatype, prefix in prefixes.items()
         }
 
         def get_deriv_type(s3_key):
@@ -912,6 +1341,7 @@ class S3BIDSStudy:
 
     def __init__(self, study_id, bucket, s3_prefix, subjects=None,
                  anon=True, use_participants_tsv=False, random_seed=None,
+                 use_stored_key_index=False, refresh_key_index=False,
                  _subject_class=S3BIDSSubject):
         """Initialize an S3BIDSStudy instance
 
@@ -949,6 +1379,17 @@ class S3BIDSStudy:
             integer. Use the same random seed for reproducibility.
             Default: None
 
+        use_stored_key_index : bool
+            The S3 keys of the study are indexed once, when the study is
+            instantiated (see `read_s3_key_index`). If True, and the study
+            was indexed before, use that index instead of listing the
+            study again. Default: False
+
+        refresh_key_index : bool
+            If True, list all of the subject folders of the study again,
+            instead of only those that are new or changed at their top
+            level. Default: False
+
         _subject_class : object
             The subject class to be used for this study. This parameter
             has a leading underscore because you probably don't want
@@ -986,6 +1427,12 @@ class S3BIDSStudy:
         if not (random_seed is None or isinstance(random_seed, int)):
             raise TypeError("`random_seed` must be an integer.")
 
+        if not isinstance(use_stored_key_index, bool):
+            raise TypeError('`use_stored_key_index` must be boolean.')
+
+        if not isinstance(refresh_key_index, bool):
+            raise TypeError('`refresh_key_index` must be boolean.')
+
         self._study_id = study_id
         self._bucket = bucket
         self._s3_prefix = s3_prefix
@@ -995,7 +1442,14 @@ class S3BIDSStudy:
         self._subject_class = _subject_class
         self._local_directories = []
 
-        # Get a list of all subjects in the study
+        # Index all of the study's keys, and get a list of all subjects in
+        # the study
+        self._key_index = read_s3_key_index(bucket=bucket,
+                                            s3_prefix=s3_prefix,
+                                            anon=anon,
+                                            use_stored=use_stored_key_index,
+                                            refresh=refresh_key_index)
+        self._index_keys = self._key_index['key'].to_numpy(dtype=object)
         self._all_subjects = self._list_all_subjects()
         self._derivative_types = self._get_derivative_types()
         self._non_subject_s3_keys = self._get_non_subject_s3_keys()
@@ -1102,6 +1556,14 @@ class S3BIDSStudy:
         return self._subject_class(subject_id=subject_id,
                                    study=self)
 
+    def _get_indexed_s3_keys(self, prefix):
+        """Return the indexed S3 keys in the folder `prefix`"""
+        prefix = prefix.rstrip('/') + '/'
+        # The index is sorted, so all keys with this prefix are contiguous:
+        start, stop = np.searchsorted(
+            self._index_keys, [prefix, prefix[:-1] + chr(ord('/') + 1)])
+        return self._index_keys[start:stop].tolist()
+
     def _get_derivative_types(self):
         """Return a list of available derivatives pipelines
 
@@ -1183,17 +1645,16 @@ class S3BIDSStudy:
             subject_set = get_subs_from_tsv_key(tsv_key)
             subjects = list(subject_set)
         else:
-            s3_prefix = '/'.join([self.bucket, self.s3_prefix]).rstrip("/")
-            sub_keys = _ls_s3fs(s3_prefix=s3_prefix,
-                                anon=self.anon)['subjects']
-
-            # Just need BIDSLayout for the `parse_file_entities`
-            # method so we can pass dev/null as the argument
-            layout = BIDSLayout(os.devnull, validate=False)
-            subjects = []
-            for key in sub_keys:
-                entities = layout.parse_file_entities(key)
-                subjects.append('sub-' + entities.get('subject'))
+            # The first "folder" of each key in the study:
+            root = self.s3_prefix.strip('/')
+            root = root + '/' if root else ''
+            top_level = self._key_index['key'].str.slice(
+                len(root)).str.split('/').str[0]
+            subjects = [
+                'sub-' + match.group(1) for match in
+                map(_subject_pattern.match, '/' + top_level.unique())
+                if match is not None
+            ]
 
         return list(set(subjects))
 
@@ -1319,7 +1780,8 @@ class HBNSite(S3BIDSStudy):
     def __init__(self, site, study_id='HBN', bucket='fcp-indi',
                  s3_prefix='data/Projects/HBN/MRI',
                  subjects=None, use_participants_tsv=False,
-                 random_seed=None):
+                 random_seed=None, use_stored_key_index=False,
+                 refresh_key_index=False):
         """Initialize the HBN site
 
         Parameters
@@ -1351,6 +1813,15 @@ class HBNSite(S3BIDSStudy):
             Random seed for selection of subjects if `subjects` is an
             integer. Use the same random seed for reproducibility.
             Default: None
+
+        use_stored_key_index : bool
+            If True, and the site was indexed before, use that index instead
+            of listing the site's S3 keys again. Default: False
+
+        refresh_key_index : bool
+            If True, list all of the subject folders of the site again,
+            instead of only those that are new or changed at their top
+            level. Default: False
         """
         valid_sites = ["Site-SI", "Site-RU", "Site-CBIC", "Site-CUNY"]
         if site not in valid_sites:
@@ -1367,6 +1838,8 @@ class HBNSite(S3BIDSStudy):
             subjects=subjects,
             use_participants_tsv=use_participants_tsv,
             random_seed=random_seed,
+            use_stored_key_index=use_stored_key_index,
+            refresh_key_index=refresh_key_index,
             _subject_class=HBNSubject
         )
 
@@ -1829,6 +2302,110 @@ fetch_hcp_atlas_80_bundles = _make_fetcher(
     unzip=True)
 
 
+def _hcp_atlas_folder(n_bundles):
+    if n_bundles == 16:
+        _, folder = fetch_hcp_atlas_16_bundles()
+        atlas_folder = "Atlas_in_MNI_Space_16_bundles"
+    elif n_bundles == 80:
+        _, folder = fetch_hcp_atlas_80_bundles()
+        atlas_folder = "Atlas_80_Bundles"
+    return folder, atlas_folder
+
+
+_hcp_whole_brain = {}
+
+
+def read_hcp_whole_brain(n_bundles=16):
+    """
+    Read the whole-brain tractogram of an HCP atlas, in MNI space
+
+    The streamlines are only read from disk once per process.
+
+    Parameters
+    ----------
+    n_bundles : int
+        16 or 80, see `read_hcp_atlas`.
+
+    Returns
+    -------
+    Streamlines
+    """
+    if n_bundles not in _hcp_whole_brain:
+        folder, atlas_folder = _hcp_atlas_folder(n_bundles)
+        _hcp_whole_brain[n_bundles] = load_tractogram(
+            op.join(
+                folder,
+                atlas_folder,
+                'whole_brain',
+                'whole_brain_MNI.trk'),
+            'same', bbox_valid_check=False).streamlines
+    return _hcp_whole_brain[n_bundles]
+
+
+# Number of atlases whose centroids are kept in memory:
+SLR_CENTROIDS_CACHE_SIZE = 4
+_slr_centroids = OrderedDict()
+
+
+def read_slr_centroids(streamlines, greater_than=50, less_than=250,
+                       qbx_thr=[40, 30, 20, 15], nb_pts=20,
+                       rm_small_clusters=50):
+    """
+    Get the whole-brain SLR centroids of an atlas tractogram
+
+    Clustering an atlas is the same for every subject registered to it, so
+    the centroids (see `AFQ.registration.slr_centroids`) are kept in memory
+    for the same atlas object (e.g. from `read_hcp_whole_brain`) and
+    clustering parameters. They are also stored in `afq_home`, keyed by
+    the content of the streamlines and the clustering parameters, which is
+    only hashed when they are not in memory.
+
+    Parameters
+    ----------
+    streamlines : Streamlines
+        The atlas tractogram, for example from `read_hcp_whole_brain`.
+    greater_than, less_than, qbx_thr, nb_pts, rm_small_clusters :
+        Passed to `AFQ.registration.slr_centroids`.
+
+    Returns
+    -------
+    Streamlines : the centroids.
+    """
+    params = [greater_than, less_than, list(qbx_thr), nb_pts,
+              rm_small_clusters]
+    # The atlas is kept with its centroids, so its id is not reused while
+    # they are in memory:
+    key = (id(streamlines), str(params))
+    if key in _slr_centroids:
+        _slr_centroids.move_to_end(key)
+        return _slr_centroids[key][1]
+
+    atlas = Streamlines(streamlines)
+    hasher = hashlib.sha1()
+    hasher.update(np.ascontiguousarray(atlas._lengths).tobytes())
+    hasher.update(np.ascontiguousarray(atlas._data).tobytes())
+    hasher.update(str(params).encode())
+    fname = op.join(afq_home, 'slr_centroids', f'{hasher.hexdigest()}.npy')
+    if op.exists(fname):
+        centroids = Streamlines(list(np.load(fname)))
+    else:
+        centroids = reg.slr_centroids(
+            atlas, greater_than=greater_than, less_than=less_than,
+            qbx_thr=qbx_thr, nb_pts=nb_pts,
+            rm_small_clusters=rm_small_clusters)
+        os.makedirs(op.dirname(fname), exist_ok=True)
+        tmp_fname = fname.replace('.npy', f'_{os.getpid()}.npy')
+        np.save(tmp_fname, np.asarray(list(centroids),
+                                      dtype=np.float32).reshape(
+                                          (-1, nb_pts, 3)))
+        os.replace(tmp_fname, fname)
+
+    _slr_centroids[key] = (streamlines, centroids)
+    while len(_slr_centroids) > SLR_CENTROIDS_CACHE_SIZE:
+        _slr_centroids.popitem(last=False)
+    return centroids
+
+
 def read_hcp_atlas(n_bundles=16):
     """
     n_bundles : int
@@ -1840,22 +2417,8 @@ def read_hcp_atlas(n_bundles=16):
         https://figshare.com/articles/Advanced_Atlas_of_80_Bundles_in_MNI_space/7375883  #noqa
     """
     bundle_dict = {}
-    if n_bundles == 16:
-        _, folder = fetch_hcp_atlas_16_bundles()
-        atlas_folder = "Atlas_in_MNI_Space_16_bundles"
-    elif n_bundles == 80:
-        _, folder = fetch_hcp_atlas_80_bundles()
-        atlas_folder = "Atlas_80_Bundles"
-
-    whole_brain = load_tractogram(
-        op.join(
-            folder,
-            atlas_folder,
-            'whole_brain',
-            'whole_brain_MNI.trk'),
-            'same', bbox_valid_check=False).streamlines
-
-    bundle_dict['whole_brain'] = whole_brain
+    folder, atlas_folder = _hcp_atlas_folder(n_bundles)
+    bundle_dict['whole_brain'] = read_hcp_whole_brain(n_bundles)
     bundle_files = glob(
         op.join(
             folder,
@@ -1900,15 +2463,24 @@ fetch_aal_atlas = _make_fetcher(
     unzip=False)
 
 
+# AAL atlases read so far in this process, keyed by the affine and shape of
+# the image they were resampled to (None for the original atlas):
+_aal_atlas = {}
+# Boolean AAL endpoint target masks, keyed by (atlas key, regions):
+_aal_targets = {}
+
+
 def read_aal_atlas(resample_to=None):
     """
     Reads the AAL atlas [1]_.
 
     Parameters
     ----------
-    template : nib.Nifti1Image class instance, optional
+    resample_to : nib.Nifti1Image class instance, optional
         If provided, this is the template used and AAL atlas should be
-        registered and aligned to this template
+        registered and aligned to this template. The resampled atlas is
+        cached under `afq_home`, so it is only resampled once for each
+        affine and shape.
 
 
     .. [1] Tzourio-Mazoyer N, Landeau B, Papathanassiou D, Crivello F, Etard O,
@@ -1917,6 +2489,10 @@ def read_aal_atlas(resample_to=None):
            parcellation of the MNI MRI single-subject brain. Neuroimage. 2002;
            15(1):273-89.
     """
+    key = None if resample_to is None else _resample_key(resample_to)
+    if key in _aal_atlas:
+        return dict(_aal_atlas[key])
+
     file_dict, folder = fetch_aal_atlas()
     out_dict = {}
     for f in file_dict:
@@ -1925,16 +2501,81 @@ def read_aal_atlas(resample_to=None):
         else:
             out_dict['atlas'] = nib.load(op.join(folder, f))
     if resample_to is not None:
-        data = out_dict['atlas'].get_fdata()
-        oo = []
-        for ii in range(data.shape[-1]):
-            oo.append(reg.resample(data[..., ii],
-                                   resample_to,
-                                   out_dict['atlas'].affine,
-                                   resample_to.affine))
-        out_dict['atlas'] = nib.Nifti1Image(np.stack(oo, -1),
-                                            resample_to.affine)
-    return out_dict
+        cache_dir = op.join(afq_home, 'resampled_aal_atlas')
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_fname = op.join(cache_dir, f'{key}.nii.gz')
+        if not op.exists(cache_fname):
+            data = out_dict['atlas'].get_fdata()
+            oo = []
+            for ii in range(data.shape[-1]):
+                oo.append(reg.resample(data[..., ii],
+                                       resample_to,
+                                       out_dict['atlas'].affine,
+                                       resample_to.affine))
+            tmp_fname = op.join(cache_dir, f'{key}_{os.getpid()}.nii.gz')
+            nib.save(nib.Nifti1Image(np.stack(oo, -1), resample_to.affine),
+                     tmp_fname)
+            os.replace(tmp_fname, cache_fname)
+        out_dict['atlas'] = nib.load(cache_fname)
+    _aal_atlas[key] = out_dict
+    return dict(out_dict)
+
+
+_aal_vals = {'leftfrontal': np.arange(1, 26, 2),
+             # Occipital regions do not include fusiform:
+             'leftoccipital': np.arange(43, 54, 2),
+             # Temporal regions include fusiform:
+             'lefttemporal': np.concatenate([np.arange(37, 42, 2),
+                                             np.array([55]),
+                                             np.arange(79, 90, 2)]),
+             'leftparietal': np.array([57, 67, 2]),
+             'leftanttemporal': np.array([41, 83, 87]),
+             'leftuncinatefront': np.array([5, 9, 15, 25]),
+             'leftifoffront': np.array([3, 5, 7, 9, 13, 15, 25]),
+             'leftinfparietal': np.array([61, 63, 65]),
+             'cerebellum': np.arange(91, 117),
+             'leftarcfrontal': np.array([1, 11, 13]),
+             'leftarctemp': np.array([79, 81, 85, 89]),
+             }
+
+# Right symmetrical is off by one:
+for _region in ['frontal', 'occipital', 'temporal', 'parietal',
+                'anttemporal', 'uncinatefront', 'ifoffront', 'infparietal',
+                'arcfrontal', 'arctemp']:
+    _aal_vals['right' + _region] = _aal_vals['left' + _region] + 1
+
+# Multiply named regions:
+_aal_vals['leftuncinatetemp'] = _aal_vals['leftilftemp'] =\
+    _aal_vals['leftanttemporal']
+_aal_vals['rightuncinatetemp'] = _aal_vals['rightilftemp'] =\
+    _aal_vals['rightanttemporal']
+_aal_vals['leftslfpar'] = _aal_vals['leftinfparietal']
+_aal_vals['rightslfpar'] = _aal_vals['rightinfparietal']
+_aal_vals['leftslffrontal'] = _aal_vals['leftarcfrontal']
+_aal_vals['rightslffrontal'] = _aal_vals['rightarcfrontal']
+
+# Bilateral regions:
+_aal_vals['occipital'] = np.union1d(_aal_vals['leftoccipital'],
+                                    _aal_vals['rightoccipital'])
+_aal_vals['temporal'] = np.union1d(_aal_vals['lefttemporal'],
+                                   _aal_vals['righttemporal'])
+
+# Regions defined by the additional volumes of "AAL and more":
+_aal_extra_vols = {'cstinferior': 1, 'cstsuperior': 2,
+                   'leftcingpost': 3, 'rightcingpost': 4}
+
+
+def _aal_region_mask(region, atlas):
+    """
+    3D boolean mask of an AAL region (see `aal_to_regions`)
+    """
+    region = region.lower()  # Just to be sure
+    if region in _aal_vals:
+        return np.isin(atlas[..., 0], _aal_vals[region])
+    elif region in _aal_extra_vols:
+        return atlas[..., _aal_extra_vols[region]] == 1
+    else:
+        raise ValueError(f"{region} is not a recognized AAL region")
 
 
 def aal_to_regions(regions, atlas=None):
@@ -1974,83 +2615,41 @@ def aal_to_regions(regions, atlas=None):
            'rightslffrontal' = 'rightarcfrontal'
     """
     if atlas is None:
-        atlas = read_aal_atlas()['atlas']
-    atlas_vals = {'leftfrontal': np.arange(1, 26, 2),
-                  # Occipital regions do not include fusiform:
-                  'leftoccipital': np.arange(43, 54, 2),
-                  # Temporal regions include fusiform:
-                  'lefttemporal': np.concatenate([np.arange(37, 42, 2),
-                                                  np.array([55]),
-                                                  np.arange(79, 90, 2)]),
-                  'leftparietal': np.array([57, 67, 2]),
-                  'leftanttemporal': np.array([41, 83, 87]),
-                  'leftuncinatefront': np.array([5, 9, 15, 25]),
-                  'leftifoffront': np.array([3, 5, 7, 9, 13, 15, 25]),
-                  'leftinfparietal': np.array([61, 63, 65]),
-                  'cerebellum': np.arange(91, 117),
-                  'leftarcfrontal': np.array([1, 11, 13]),
-                  'leftarctemp': np.array([79, 81, 85, 89]),
-                  }
-
-    # Right symmetrical is off by one:
-    atlas_vals['rightfrontal'] = atlas_vals['leftfrontal'] + 1
-    atlas_vals['rightoccipital'] = atlas_vals['leftoccipital'] + 1
-    atlas_vals['righttemporal'] = atlas_vals['lefttemporal'] + 1
-    atlas_vals['rightparietal'] = atlas_vals['leftparietal'] + 1
-    atlas_vals['rightanttemporal'] = atlas_vals['leftanttemporal'] + 1
-    atlas_vals['rightuncinatefront'] = atlas_vals['leftuncinatefront'] + 1
-    atlas_vals['rightifoffront'] = atlas_vals['leftifoffront'] + 1
-    atlas_vals['rightinfparietal'] = atlas_vals['leftinfparietal'] + 1
-    atlas_vals['rightarcfrontal'] = atlas_vals['leftarcfrontal'] + 1
-    atlas_vals['rightarctemp'] = atlas_vals['leftarctemp'] + 1
-
-    # Multiply named regions:
-    atlas_vals['leftuncinatetemp'] = atlas_vals['leftilftemp'] =\
-        atlas_vals['leftanttemporal']
-    atlas_vals['rightuncinatetemp'] = atlas_vals['rightilftemp'] =\
-        atlas_vals['rightanttemporal']
-    atlas_vals['leftslfpar'] = atlas_vals['leftinfparietal']
-    atlas_vals['rightslfpar'] = atlas_vals['rightinfparietal']
-    atlas_vals['leftslffrontal'] = atlas_vals['leftarcfrontal']
-    atlas_vals['rightslffrontal'] = atlas_vals['rightarcfrontal']
-
-    # Bilateral regions:
-    atlas_vals['occipital'] = np.union1d(atlas_vals['leftoccipital'],
-                                         atlas_vals['rightoccipital'])
-    atlas_vals['temporal'] = np.union1d(atlas_vals['lefttemporal'],
-                                        atlas_vals['righttemporal'])
+        atlas = read_aal_atlas()['atlas'].get_fdata()
 
     if isinstance(regions, str):
         regions = [regions]
 
     idxes = []
     for region in regions:
-        region = region.lower()  # Just to be sure
-        if region in atlas_vals.keys():
-            vol_idx = 0
-            vals = atlas_vals[region]
-        elif region == 'cstinferior':
-            vol_idx = 1
-            vals = np.array([1])
-        elif region == 'cstsuperior':
-            vol_idx = 2
-            vals = np.array([1])
-        elif region == 'leftcingpost':
-            vol_idx = 3
-            vals = np.array([1])
-        elif region == 'rightcingpost':
-            vol_idx = 4
-            vals = np.array([1])
-
-        # Broadcast vals, to test for equality over all three dimensions:
-        is_in = atlas[..., vol_idx] == vals[:, None, None, None]
-        # Then collapse the 4th dimension (each val), to get the 3D array:
-        is_in = np.sum(is_in, 0)
-        idxes.append(np.array(np.where(is_in)).T)
+        idxes.append(np.array(np.where(_aal_region_mask(region, atlas))).T)
 
     return np.concatenate(idxes, axis=0)
 
 
+_aal_endpoints = {
+    "ATR_L": [['leftfrontal'], None],
+    "ATR_R": [['rightfrontal'], None],
+    "CST_L": [['cstinferior'], ['cstsuperior']],
+    "CST_R": [['cstinferior'], ['cstsuperior']],
+    "CGC_L": [['leftcingpost'], None],
+    "CGC_R": [['rightcingpost'], None],
+    "HCC_L": [None, None],
+    "HCC_R": [None, None],
+    "FP": [['rightoccipital'], ['leftoccipital']],
+    "FA": [['rightfrontal'], ['leftfrontal']],
+    "IFO_L": [['leftoccipital'], ['leftifoffront']],
+    "IFO_R": [['rightoccipital'], ['rightifoffront']],
+    "ILF_L": [['leftoccipital'], ['leftilftemp']],
+    "ILF_R": [['rightoccipital'], ['rightilftemp']],
+    "SLF_L": [['leftslffrontal'], ['leftinfparietal']],
+    "SLF_R": [['rightslffrontal'], ['rightinfparietal']],
+    "UNC_L": [['leftanttemporal'], ['leftuncinatefront']],
+    "UNC_R": [['rightanttemporal'], ['rightuncinatefront']],
+    "ARC_L": [['leftfrontal'], ['leftarctemp']],
+    "ARC_R": [['rightfrontal'], ['rightarctemp']]}
+
+
 def bundles_to_aal(bundles, atlas=None):
     """
     Given a sequence of AFQ bundle names, give back a sequence of lists
@@ -2058,34 +2657,12 @@ def bundles_to_aal(bundles, atlas=None):
     for the first and last node of the streamlines in this bundle.
     """
     if atlas is None:
-        atlas = read_aal_atlas()['atlas']
-
-    endpoint_dict = {
-        "ATR_L": [['leftfrontal'], None],
-        "ATR_R": [['rightfrontal'], None],
-        "CST_L": [['cstinferior'], ['cstsuperior']],
-        "CST_R": [['cstinferior'], ['cstsuperior']],
-        "CGC_L": [['leftcingpost'], None],
-        "CGC_R": [['rightcingpost'], None],
-        "HCC_L": [None, None],
-        "HCC_R": [None, None],
-        "FP": [['rightoccipital'], ['leftoccipital']],
-        "FA": [['rightfrontal'], ['leftfrontal']],
-        "IFO_L": [['leftoccipital'], ['leftifoffront']],
-        "IFO_R": [['rightoccipital'], ['rightifoffront']],
-        "ILF_L": [['leftoccipital'], ['leftilftemp']],
-        "ILF_R": [['rightoccipital'], ['rightilftemp']],
-        "SLF_L": [['leftslffrontal'], ['leftinfparietal']],
-        "SLF_R": [['rightslffrontal'], ['rightinfparietal']],
-        "UNC_L": [['leftanttemporal'], ['leftuncinatefront']],
-        "UNC_R": [['rightanttemporal'], ['rightuncinatefront']],
-        "ARC_L": [['leftfrontal'], ['leftarctemp']],
-        "ARC_R": [['rightfrontal'], ['rightarctemp']]}
+        atlas = read_aal_atlas()['atlas'].get_fdata()
 
     targets = []
     for bundle in bundles:
         targets.append([])
-        for region in endpoint_dict[bundle]:
+        for region in _aal_endpoints[bundle]:
             if region is None:
                 targets[-1].append(None)
             else:
@@ -2094,10 +2671,54 @@ def bundles_to_aal(bundles, atlas=None):
     return targets
 
 
+def read_aal_targets(bundles, resample_to=None):
+    """
+    Given a sequence of AFQ bundle names, give back a sequence of lists
+    with [target0, target1] being each a boolean mask of the AAL regions in
+    which the first and last node of the streamlines in this bundle should
+    end, or None if there is no such constraint.
+
+    The masks are computed once for each combination of regions and
+    `resample_to` affine and shape, and are read-only.
+
+    Parameters
+    ----------
+    bundles : list of str
+        AFQ bundle names.
+    resample_to : nib.Nifti1Image class instance, optional
+        The template the AAL atlas is resampled to (see `read_aal_atlas`).
+    """
+    key = None if resample_to is None else _resample_key(resample_to)
+    atlas = None
+    targets = []
+    for bundle in bundles:
+        targets.append([])
+        for regions in _aal_endpoints[bundle]:
+            if regions is None:
+                targets[-1].append(None)
+                continue
+            target_key = (key, tuple(regions))
+            if target_key not in _aal_targets:
+                if atlas is None:
+                    atlas = read_aal_atlas(resample_to)['atlas'].get_fdata()
+                mask = np.zeros(atlas.shape[:3], dtype=bool)
+                for region in regions:
+                    mask |= _aal_region_mask(region, atlas)
+                mask.flags.writeable = False
+                _aal_targets[target_key] = mask
+            targets[-1].append(_aal_targets[target_key])
+
+    return targets
+
+
 def s3fs_nifti_write(img, fname, fs=None):
     """
     Write a nifti file straight to S3
 
+    The image is gzip-compressed as it is serialized, and uploaded in parts
+    as the compressed stream grows, so no full copy of the file is held in
+    memory.
+
     Paramters
     ---------
     img : nib.Nifti1Image class instance
@@ -2111,12 +2732,93 @@ def s3fs_nifti_write(img, fname, fs=None):
     if fs is None:
         fs = s3fs.S3FileSystem()
 
-    bio = BytesIO()
-    file_map = img.make_file_map({'image': bio, 'header': bio})
-    img.to_file_map(file_map)
-    data = gzip.compress(bio.getvalue())
     with fs.open(fname, 'wb') as ff:
-        ff.write(data)
+        with gzip.GzipFile(fileobj=ff, mode='wb') as zz:
+            file_map = img.make_file_map({'image': zz, 'header': zz})
+            img.to_file_map(file_map)
+
+
+class _S3NiftiProxy:
+    """
+    Array proxy for the data of a gzipped nifti file on S3
+
+    The data is decompressed straight from S3 into a preallocated array
+    each time it is accessed, so every access transfers the file again.
+    Nifti data is stored with the last axis varying slowest, so slicing
+    only the first elements along the last axis (e.g. ``dataobj[..., 0]``
+    for the first volume of a 4D image) only transfers and decompresses
+    the file up to the end of the requested elements.
+    """
+    is_proxy = True
+
+    def __init__(self, fname, fs, header):
+        self.fname = fname
+        self._fs = fs
+        self._shape = header.get_data_shape()
+        self._dtype = header.get_data_dtype()
+        self._offset = header.get_data_offset()
+        self._slope, self._inter = header.get_slope_inter()
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def ndim(self):
+        return len(self._shape)
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def _read(self, n_last=None):
+        """Read the first `n_last` elements along the last axis"""
+        shape = self._shape
+        if n_last is not None:
+            shape = shape[:-1] + (n_last, )
+        arr = np.empty(shape, dtype=self._dtype, order='F')
+        # Nifti data is stored in Fortran order, so fill the bytes of the
+        # C-ordered transpose:
+        buffer = memoryview(arr.T).cast('B')
+        with self._fs.open(self.fname) as ff:
+            with gzip.GzipFile(fileobj=ff, mode='rb') as zz:
+                zz.seek(self._offset)
+                pos = 0
+                while pos < len(buffer):
+                    n_read = zz.readinto(buffer[pos:pos + 2 ** 20])
+                    if n_read == 0:
+                        raise ValueError(f'{self.fname} is truncated')
+                    pos += n_read
+        return apply_read_scaling(arr, self._slope, self._inter)
+
+    def __array__(self, dtype=None, copy=None):
+        # The data is read into a new array, whatever `copy` is:
+        arr = self._read()
+        if dtype is not None:
+            arr = arr.astype(dtype, copy=False)
+        return arr
+
+    def __getitem__(self, slicer):
+        if is_fancy(slicer) or not len(self._shape):
+            return self._read()[slicer]
+        slicer = canonical_slicers(slicer, self._shape)
+        if None in slicer:
+            return self._read()[slicer]
+
+        # Only read up to the last element needed along the last axis:
+        last = slicer[-1]
+        if isinstance(last, slice):
+            start, stop, step = last.indices(self._shape[-1])
+            if step > 0:
+                n_last = max(stop, start)
+            else:
+                n_last = start + 1
+                stop = None if stop < 0 else stop
+            last = slice(start, stop, step)
+        else:
+            n_last = last + 1
+        n_last = min(max(n_last, 1), self._shape[-1])
+        return self._read(n_last)[slicer[:-1] + (last, )]
 
 
 def s3fs_nifti_read(fname, fs=None, anon=False):
@@ -2142,19 +2844,19 @@ def s3fs_nifti_read(fname, fs=None, anon=False):
 
     Notes
     -----
-    Because the image is lazily loaded, data stored in the file
-    is not transferred until `get_fdata` is called.
+    Because the image is lazily loaded, only the header is read when this
+    is called. The data stored in the file is not transferred until
+    `get_fdata` is called, and is then decompressed in chunks straight into
+    the array that holds it.
 
     """
     if fs is None:
         fs = s3fs.S3FileSystem(anon=anon)
     with fs.open(fname) as ff:
-        zz = gzip.open(ff)
-        rr = zz.read()
-        bb = BytesIO(rr)
-        fh = nib.FileHolder(fileobj=bb)
-        img = nib.Nifti1Image.from_file_map({'header': fh, 'image': fh})
-    return img
+        with gzip.GzipFile(fileobj=ff, mode='rb') as zz:
+            header = nib.Nifti1Header.from_fileobj(zz)
+    return nib.Nifti1Image(_S3NiftiProxy(fname, fs, header),
+                           header.get_best_affine(), header=header)
 
 
 def write_json(fname, data):
@@ -2190,7 +2892,7 @@ def read_json(fname):
     -------
     dict
     """
-    with open(fname, 'w') as ff:
+    with open(fname, 'r') as ff:
         out = json.load(ff)
     return out
 
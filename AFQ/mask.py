@@ -1,7 +1,12 @@
+import functools
+import os.path as op
+from collections import OrderedDict
+
 import numpy as np
 
 import nibabel as nib
 from dipy.segment.mask import median_otsu
+from dipy.align.imaffine import AffineMap
 
 import AFQ.registration as reg
 import AFQ.utils.volume as auv
@@ -42,20 +47,68 @@ def check_mask_methods(mask, mask_name=False):
 def _resample_mask(mask_data, dwi_data, mask_affine, dwi_affine):
     '''
     Helper function
-    Resamples mask to dwi if necessary
+    Resamples mask to dwi if necessary.
+    Only the shape of dwi_data is used, so this can also be
+    a nibabel image whose data is not loaded.
     '''
     mask_type = mask_data.dtype
     if ((dwi_data is not None)
         and (dwi_affine is not None)
-            and (dwi_data[..., 0].shape != mask_data.shape)):
-        return np.round(reg.resample(mask_data.astype(float),
-                                     dwi_data[..., 0],
-                                     mask_affine,
-                                     dwi_affine)).astype(mask_type)
+            and (dwi_data.shape[:3] != mask_data.shape)):
+        affine_map = AffineMap(np.eye(4),
+                               dwi_data.shape[:3], dwi_affine,
+                               mask_data.shape, mask_affine)
+        return np.round(affine_map.transform(
+            mask_data.astype(float))).astype(mask_type)
     else:
         return mask_data
 
 
+def _dwi_reference(row):
+    '''
+    Helper function
+    The DWI image of a subject, with only its header read,
+    for its shape and affine
+    '''
+    return nib.load(row['dwi_file'])
+
+
+# Number of resolved masks kept by each mask definition:
+MASK_CACHE_SIZE = 4
+
+
+def _cache_mask(get_mask):
+    '''
+    Helper decorator
+    Caches the masks resolved by get_mask on the mask definition, by the
+    DWI file and outputs of the subject and session and the parameters
+    of the mask. Only the MASK_CACHE_SIZE most recently used masks are kept
+    '''
+    @functools.wraps(get_mask)
+    def cached_get_mask(self, afq_object, row):
+        if not hasattr(self, "_resolved_masks"):
+            self._resolved_masks = OrderedDict()
+        key = (op.realpath(row['dwi_file']), row.get('results_dir'),
+               row['subject'], row['ses'], self.str_for_toml())
+        if key in self._resolved_masks:
+            self._resolved_masks.move_to_end(key)
+        else:
+            mask_data, affine, meta = get_mask(self, afq_object, row)
+            # Boolean masks are kept bit-packed:
+            if isinstance(mask_data, np.ndarray) and mask_data.dtype == bool:
+                mask_data = (np.packbits(mask_data), mask_data.shape)
+            self._resolved_masks[key] = (mask_data, affine, meta)
+            while len(self._resolved_masks) > MASK_CACHE_SIZE:
+                self._resolved_masks.popitem(last=False)
+        mask_data, affine, meta = self._resolved_masks[key]
+        if isinstance(mask_data, tuple):
+            packed, shape = mask_data
+            mask_data = np.unpackbits(
+                packed, count=np.prod(shape)).reshape(shape).astype(bool)
+        return mask_data, affine, meta
+    return cached_get_mask
+
+
 def _arglist_to_string(args, get_attr=None):
     '''
     Helper function
@@ -97,6 +150,12 @@ class StrInstantiatesMixin(object):
                 get_attr=self)\
             + ')'
 
+    def __getstate__(self):
+        # Resolved masks are not part of the mask definition:
+        state = self.__dict__.copy()
+        state.pop('_resolved_masks', None)
+        return state
+
 
 class CombineMaskMixin(object):
     """
@@ -116,10 +175,13 @@ class CombineMaskMixin(object):
             self.combine_illdefined()
 
     def __mul__(self, other_mask):
+        # Combine in place, into the boolean mask draft:
         if self.combine == "or":
-            return np.logical_or(self.mask_draft, other_mask)
+            return np.logical_or(self.mask_draft, other_mask,
+                                 out=self.mask_draft)
         elif self.combine == "and":
-            return np.logical_and(self.mask_draft, other_mask)
+            return np.logical_and(self.mask_draft, other_mask,
+                                  out=self.mask_draft)
         else:
             self.combine_illdefined()
 
@@ -211,9 +273,10 @@ class MaskFile(StrInstantiatesMixin):
     def apply_conditions(self, mask_data_orig, mask_file):
         return mask_data_orig, dict(source=mask_file)
 
+    @_cache_mask
     def get_mask(self, afq_object, row):
-        # Load data
-        dwi_data, _, dwi_img = afq_object._get_data_gtab(row)
+        # Only the header of the DWI data is needed:
+        dwi_img = _dwi_reference(row)
         mask_file, mask_data_orig, mask_affine = \
             self.get_path_data_affine(afq_object, row)
 
@@ -223,7 +286,7 @@ class MaskFile(StrInstantiatesMixin):
         # Resample to DWI data:
         mask_data = _resample_mask(
             mask_data,
-            dwi_data,
+            dwi_img,
             mask_affine,
             dwi_img.affine)
 
@@ -245,11 +308,12 @@ class FullMask(StrInstantiatesMixin):
     def find_path(self, bids_layout, from_path, subject, session):
         pass
 
+    @_cache_mask
     def get_mask(self, afq_object, row):
-        # Load data to get shape, affine
-        dwi_data, _, dwi_img = afq_object._get_data_gtab(row)
+        # Read the header only, to get shape, affine
+        dwi_img = _dwi_reference(row)
 
-        return np.ones(dwi_data.shape),\
+        return np.ones(dwi_img.shape[:3], dtype=bool),\
             dwi_img.affine,\
             dict(source="Entire Volume")
 
@@ -270,6 +334,7 @@ class RoiMask(StrInstantiatesMixin):
     def find_path(self, bids_layout, from_path, subject, session):
         pass
 
+    @_cache_mask
     def get_mask(self, afq_object, row):
         if afq_object.use_prealign:
             reg_prealign = np.load(afq_object._reg_prealign(row))
@@ -280,7 +345,8 @@ class RoiMask(StrInstantiatesMixin):
             afq_object._mapping(row),
             row['dwi_file'],
             afq_object.reg_template_img,
-            prealign=reg_prealign_inv)
+            prealign=reg_prealign_inv,
+            fields="forward")
 
         mask_data = None
         for bundle_name, bundle_info in afq_object.bundle_dict.items():
@@ -293,11 +359,9 @@ class RoiMask(StrInstantiatesMixin):
                         bundle_name=bundle_name)
 
                     if mask_data is None:
-                        mask_data = np.zeros(warped_roi.shape)
-                    mask_data = np.logical_or(
-                        mask_data,
-                        warped_roi.astype(bool))
-        return mask_data, afq_object["dwi_affine"], dict(source="ROIs")
+                        mask_data = np.zeros(warped_roi.shape, dtype=bool)
+                    np.logical_or(mask_data, warped_roi, out=mask_data)
+        return mask_data, row["dwi_affine"], dict(source="ROIs")
 
 
 class B0Mask(StrInstantiatesMixin):
@@ -322,6 +386,7 @@ class B0Mask(StrInstantiatesMixin):
     def find_path(self, bids_layout, from_path, subject, session):
         pass
 
+    @_cache_mask
     def get_mask(self, afq_object, row):
         b0_file = afq_object._b0(row)
         mean_b0_img = nib.load(b0_file)
@@ -567,12 +632,16 @@ class PFTMask(StrInstantiatesMixin):
             "stop_threshold": "CMC",
             "tracker": "pft"})
         """
+        self.WM_probseg = WM_probseg
+        self.GM_probseg = GM_probseg
+        self.CSF_probseg = CSF_probseg
         self.probsegs = (WM_probseg, GM_probseg, CSF_probseg)
 
     def find_path(self, bids_layout, from_path, subject, session):
         for probseg in self.probsegs:
             probseg.find_path(bids_layout, from_path, subject, session)
 
+    @_cache_mask
     def get_mask(self, afq_object, row):
         probseg_imgs = []
         probseg_metas = []
@@ -618,6 +687,7 @@ class CombinedMask(StrInstantiatesMixin, CombineMaskMixin):
         for mask in self.mask_list:
             mask.find_path(bids_layout, from_path, subject, session)
 
+    @_cache_mask
     def get_mask(self, afq_object, row):
         self.mask_draft = None
         metas = []
@@ -625,8 +695,7 @@ class CombinedMask(StrInstantiatesMixin, CombineMaskMixin):
             next_mask, next_affine, next_meta = mask.get_mask(afq_object, row)
             if self.mask_draft is None:
                 self.reset_mask_draft(next_mask.shape)
-            else:
-                self.mask_draft = self * (next_mask)
+            self.mask_draft = self * (next_mask)
             metas.append(next_meta)
 
         meta = dict(sources=metas,
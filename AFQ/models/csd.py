@@ -1,13 +1,17 @@
 import os
 import os.path as op
+import copy
+import hashlib
+import pickle
+from collections import OrderedDict
 
 import numpy as np
 import nibabel as nib
 
+from dipy.core.gradients import unique_bvals_tolerance
 from dipy.reconst import csdeconv as csd
 from dipy.reconst import mcsd
 from dipy.reconst import shm
-import dipy.data as dpd
 import AFQ.utils.models as ut
 
 # Monkey patch fixed spherical harmonics for conda and fixed solve_qp from
@@ -19,9 +23,136 @@ mcsd.solve_qp = solve_qp
 __all__ = ["fit_csd"]
 
 
-def _model(gtab, data, response=None, sh_order=None, msmt=False):
+# Models hold their design matrices and sphere projection matrices, so only
+# the most recently used ones are kept in memory:
+MODEL_CACHE_SIZE = 8
+_model_cache = OrderedDict()
+
+
+def gtab_fingerprint(gtab, decimals=4):
+    """
+    A key identifying an acquisition scheme
+
+    b-values are rounded to integers and b-vectors to `decimals` decimals,
+    so that subjects with the same scheme get the same key.
+
+    Parameters
+    ----------
+    gtab : GradientTable
+    decimals : int, optional
+        Default: 4
+
+    Returns
+    -------
+    str
+    """
+    hasher = hashlib.sha1()
+    hasher.update(np.round(gtab.bvals).astype(np.int64).tobytes())
+    # Adding 0 turns -0. into 0.:
+    hasher.update((np.round(gtab.bvecs, decimals) + 0.).tobytes())
+    hasher.update(gtab.b0s_mask.tobytes())
+    return hasher.hexdigest()
+
+
+def _cached(key, make, cache_dir=None):
+    """
+    Get an object from the in-process cache, or from `cache_dir`,
+    or make it with `make()` and store it in both.
+    """
+    if key in _model_cache:
+        _model_cache.move_to_end(key)
+        return _model_cache[key]
+
+    fname = None
+    if cache_dir is not None:
+        fname = op.join(cache_dir, f"{key}.pkl")
+    if fname is not None and op.exists(fname):
+        with open(fname, 'rb') as f:
+            obj = pickle.load(f)
+    else:
+        obj = make()
+        if fname is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Other processes only ever see a complete file:
+            tmp_fname = op.join(cache_dir, f"{key}_{os.getpid()}.pkl")
+            with open(tmp_fname, 'wb') as f:
+                pickle.dump(obj, f)
+            os.replace(tmp_fname, fname)
+
+    _model_cache[key] = obj
+    while len(_model_cache) > MODEL_CACHE_SIZE:
+        _model_cache.popitem(last=False)
+    return obj
+
+
+def _response(gtab, data, msmt=False):
+    """
+    Helper function that estimates the response function(s) from data.
+    """
+    if msmt:
+        mask_wm, mask_gm, mask_csf =\
+            mcsd.mask_for_response_msmt(gtab, data)
+        response_wm, response_gm, response_csf =\
+            mcsd.response_from_mask_msmt(gtab, data,
+                                         mask_wm, mask_gm, mask_csf)
+        return np.array([response_wm, response_gm, response_csf])
+    else:
+        response, _ = csd.auto_response_ssst(gtab, data, roi_radii=10,
+                                             fa_thr=0.7)
+        return response
+
+
+def _with_response(basis, gtab, response, sh_order, msmt=False):
+    """
+    Helper function that makes a model for `response` from `basis`, a model
+    for the same acquisition scheme and sh_order, computing only the parts
+    of the model that depend on the response. The SH design matrices, the
+    regularization matrices and the cache of sphere projection matrices are
+    shared with `basis`.
+    """
+    model = copy.copy(basis)
+    model.gtab = gtab
+    model.response = response
+    m_values, l_values = shm.sph_harm_ind_list(sh_order)
+    if msmt:
+        if not isinstance(response, mcsd.MultiShellResponse):
+            response = mcsd.multi_shell_fiber_response(
+                sh_order, bvals=unique_bvals_tolerance(gtab.bvals),
+                wm_rf=response[0], gm_rf=response[1], csf_rf=response[2])
+        model.response = response
+        model._X = X = basis.B_dwi * mcsd._inflate_response(
+            response, gtab, l_values, basis.delta)
+        model.fitter = mcsd.QpFitter(X, basis.fitter._reg)
+    else:
+        model.S_r = csd.estimate_response(gtab, response[0], response[1])
+        r_sh = np.linalg.lstsq(basis.B_dwi, model.S_r[basis._where_dwi],
+                               rcond=-1)[0]
+        r_rh = shm.sh_to_rh(r_sh, m_values, l_values)
+        model.R = csd.forward_sdeconv_mat(r_rh, l_values)
+        model.response_scaling = response[1]
+        # The regularization is scaled by r_rh[0], which is R[0, 0]:
+        model.B_reg = basis.B_reg * (model.R[0, 0] / basis.R[0, 0])
+        model._X = X = model.R.diagonal() * basis.B_dwi
+        model._P = np.dot(X.T, X)
+    return model
+
+
+def _model(gtab, data, response=None, sh_order=None, msmt=False,
+           cache_dir=None):
     """
     Helper function that defines a CSD model.
+
+    The parts of the model that do not depend on the response (the SH
+    design matrices, the regularization matrices and the sphere projection
+    matrices computed while the models are used) are cached by
+    `gtab_fingerprint` and sh_order, so that they are built once for all
+    subjects with the same acquisition scheme. Models are also cached by
+    response, unless the response is estimated from this subject
+    (`response` is None). If `response` is "group", the response estimated
+    from the first subject with a given acquisition scheme is used for all
+    of them. If `cache_dir` is given, these are also stored there, to be
+    reused across processes. Only the `MODEL_CACHE_SIZE` most recently used
+    ones are kept in memory.
     """
     if sh_order is None:
         ndata = np.sum(~gtab.b0s_mask)
@@ -33,31 +164,67 @@ def _model(gtab, data, response=None, sh_order=None, msmt=False):
         if sh_order > 8:
             sh_order = 8
 
+    fingerprint = gtab_fingerprint(gtab)
+    if isinstance(response, str):
+        if response != "group":
+            raise ValueError(
+                "response must be None, 'group', or a response function")
+        response = _cached(
+            f"response_{'msmt' if msmt else 'ssst'}_{fingerprint}",
+            lambda: _response(gtab, data, msmt), cache_dir)
+
     if msmt:
         my_model = mcsd.MultiShellDeconvModel
-        if response is None:
-            mask_wm, mask_gm, mask_csf =\
-                mcsd.mask_for_response_msmt(gtab, data)
-            response_wm, response_gm, response_csf =\
-                mcsd.response_from_mask_msmt(gtab, data,
-                                             mask_wm, mask_gm, mask_csf)
-            response = np.array([response_wm, response_gm, response_csf])
     else:
         my_model = csd.ConstrainedSphericalDeconvModel
-        if response is None:
-            response, _ = csd.auto_response_ssst(gtab, data, roi_radii=10,
-                                                 fa_thr=0.7)
 
-    csdmodel = my_model(gtab, response, sh_order=sh_order)
-    return csdmodel
+    from_subject = response is None
+    if from_subject:
+        response = _response(gtab, data, msmt)
+
+    def make_basis():
+        basis = my_model(gtab, response, sh_order=sh_order)
+        # Set up the cache of sphere projection matrices now, so that it is
+        # shared by all the models made from this one:
+        basis._cache
+        return basis
+
+    basis = _cached(
+        f"basis_{my_model.__name__}_{fingerprint}_{sh_order}",
+        make_basis, cache_dir)
+
+    if from_subject:
+        # A model for a response that was estimated from this subject only
+        # is not worth storing:
+        return _with_response(basis, gtab, response, sh_order, msmt)
+
+    response_hash = hashlib.sha1(pickle.dumps(response)).hexdigest()
+    return _cached(
+        f"model_{my_model.__name__}_{fingerprint}_{sh_order}_{response_hash}",
+        lambda: _with_response(basis, gtab, response, sh_order, msmt),
+        cache_dir)
 
 
 def _fit(gtab, data, mask, response=None, sh_order=None, lambda_=1, tau=0.1,
-         msmt=False):
+         msmt=False, cache_dir=None, **kwargs):
     """
     Helper function that does the core of fitting a model to data.
+    The model is fit in blocks of voxels, kwargs are passed to
+    `AFQ.utils.models.fit_in_blocks`.
     """
-    return _model(gtab, data, response, sh_order, msmt).fit(data, mask=mask)
+    model = _model(gtab, data, response, sh_order, msmt, cache_dir=cache_dir)
+    if mask is None:
+        mask = np.ones(data.shape[:-1], dtype=bool)
+    else:
+        mask = (mask > 0)
+    if msmt:
+        coeff = ut.fit_in_blocks(model, data, mask=mask,
+                                 params_attr="all_shm_coeff", **kwargs)
+        return mcsd.MSDeconvFit(model, coeff, mask)
+    else:
+        coeff = ut.fit_in_blocks(model, data, mask=mask,
+                                 params_attr="shm_coeff", **kwargs)
+        return shm.SphHarmFit(model, coeff, mask)
 
 
 def fit_csd(data_files, bval_files, bvec_files, mask=None, response=None,
@@ -83,7 +250,8 @@ def fit_csd(data_files, bval_files, bvec_files, mask=None, response=None,
         The first is the eigen-values as an (3,) ndarray and the second is
         the signal value for the response function without diffusion-weighting
         (i.e. S0). If not provided, auto_response will be used to calculate
-        these values.
+        these values. If "group", the response is calculated once for all
+        data with the same acquisition scheme.
     b0_threshold : float,optional.
       The value of diffusion-weighting under which we consider it to be
       equivalent to 0. Default:50
@@ -129,10 +297,13 @@ def fit_csd(data_files, bval_files, bvec_files, mask=None, response=None,
     return fname
 
 
-def fit_anisotropic_power_map(dwi, gtab, mask=None):
+def fit_anisotropic_power_map(dwi, gtab, mask=None, **kwargs):
     """
     Fits an anisotropic power map.
 
+    The map is computed directly from the SH coefficients of a CSD fit,
+    without evaluating ODFs on a sphere or extracting peaks.
+
     Parameters
     ----------
     dwi : str, ndarray, or nifti1image
@@ -145,6 +316,10 @@ def fit_anisotropic_power_map(dwi, gtab, mask=None):
         mask to mask the data with.
         Default: None.
 
+    kwargs :
+        Passed to `_fit`, e.g. `cache_dir`, or the arguments of
+        `AFQ.utils.models.fit_in_blocks`.
+
     Returns
     -------
     ndarray containing an anisotropic power map.
@@ -159,17 +334,10 @@ def fit_anisotropic_power_map(dwi, gtab, mask=None):
 
     if isinstance(mask, str):
         mask = nib.load(mask)
-    mask = mask.get_fdata()
-
-    model = _model(gtab, dwi_data)
-    sphere = dpd.get_sphere('symmetric724')
-    peaks = csd.peaks_from_model(
-        model=model,
-        data=dwi_data,
-        sphere=sphere,
-        relative_peak_threshold=.5,
-        min_separation_angle=25,
-        mask=mask)
-    ap = shm.anisotropic_power(peaks.shm_coeff)
+    if isinstance(mask, nib.Nifti1Image):
+        mask = mask.get_fdata()
+
+    csdf = _fit(gtab, dwi_data, mask, **kwargs)
+    ap = shm.anisotropic_power(csdf.shm_coeff)
 
     return ap
@@ -6,7 +6,6 @@ import nibabel as nib
 
 from dipy.reconst import dki
 from dipy.reconst import dki_micro
-from dipy.core.ndindex import ndindex
 
 import AFQ.utils.models as ut
 
@@ -14,9 +13,14 @@ import AFQ.utils.models as ut
 __all__ = ["fit_dki", "predict"]
 
 
-def _fit(gtab, data, mask=None):
+def _fit(gtab, data, mask=None, **kwargs):
+    """
+    Helper function that fits the DKI model, in blocks of voxels.
+    kwargs are passed to `AFQ.utils.models.fit_in_blocks`.
+    """
     dkimodel = dki.DiffusionKurtosisModel(gtab)
-    return dkimodel.fit(data, mask=mask)
+    params = ut.fit_in_blocks(dkimodel, data, mask=mask, **kwargs)
+    return dki.DiffusionKurtosisFit(dkimodel, params)
 
 
 def fit_dki(data_files, bval_files, bvec_files, mask=None,
@@ -94,7 +98,7 @@ def fit_dki(data_files, bval_files, bvec_files, mask=None,
     return file_paths
 
 
-def avs_dki_df(gtab, data, mask=None, min_signal=1.0e-6):
+def avs_dki_df(gtab, data, mask=None, min_signal=1.0e-6, chunk_size=None):
     r""" Computes mean diffusion kurtosis
 
     Parameters
@@ -110,6 +114,9 @@ def avs_dki_df(gtab, data, mask=None, min_signal=1.0e-6):
     min_signal : float
         The minimum signal value. Needs to be a strictly positive
         number. Default: 1.0e-6.
+    chunk_size : int, optional
+        Number of voxels that are fit at once, which bounds the memory used.
+        Default: all of the voxels in the mask.
 
     Returns
     -------
@@ -139,9 +146,10 @@ def avs_dki_df(gtab, data, mask=None, min_signal=1.0e-6):
     B[:, 1] = 1.0 / 6.0 * uniqueb ** 2
     B[:, 2] = np.ones(nb)
 
-    ng = np.zeros(nb)
-    for bi in range(nb):
-        ng[bi] = np.sum(b == uniqueb[bi])
+    # Averaging over each shell is done as a product with this matrix:
+    shells = (b[:, None] == uniqueb[None, :]).astype(float)
+    ng = shells.sum(0)
+    shell_means = shells / ng
     ng = np.sqrt(ng)
 
     # Prepare mask
@@ -152,23 +160,23 @@ def avs_dki_df(gtab, data, mask=None, min_signal=1.0e-6):
             raise ValueError("Mask is not the same shape as data.")
         mask = np.array(mask, dtype=bool, copy=False)
 
-    index = ndindex(mask.shape)
-    sig = np.zeros(nb)
-    for v in index:
-        if mask[v]:
-            for bi in range(nb):
-                sig[bi] = np.mean(data[v][b == uniqueb[bi]])
-
-            # Define weights as diag(sqrt(ng) * yn**2)
-            W = np.diag(ng * sig**2)
-
-            BTW = np.dot(B.T, W)
-            inv_BT_W_B = np.linalg.pinv(np.dot(BTW, B))
-            invBTWB_BTW = np.dot(inv_BT_W_B, BTW)
-            p = np.dot(invBTWB_BTW, np.log(sig))
-            p[1] = p[1] / (p[0]**2)
-            p[2] = np.exp(p[2])
-            params[v] = p
+    vox_inds = np.nonzero(mask)
+    n_vox = len(vox_inds[0])
+    if chunk_size is None:
+        chunk_size = max(n_vox, 1)
+
+    for start in range(0, n_vox, chunk_size):
+        chunk_inds = tuple(ii[start:start + chunk_size] for ii in vox_inds)
+        sig = np.dot(data[chunk_inds], shell_means)
+
+        # Define weights as diag(sqrt(ng) * yn**2), for each voxel
+        W = ng * sig**2
+        BTWB = np.einsum('ki,vk,kj->vij', B, W, B)
+        BTWy = np.einsum('ki,vk->vi', B, W * np.log(sig))
+        p = np.einsum('vij,vj->vi', np.linalg.pinv(BTWB), BTWy)
+        p[:, 1] = p[:, 1] / (p[:, 0]**2)
+        p[:, 2] = np.exp(p[:, 2])
+        params[chunk_inds] = p
     return params
 
 
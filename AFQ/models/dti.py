@@ -13,7 +13,8 @@ import AFQ.utils.models as ut
 __all__ = ["fit_dti", "predict"]
 
 
-def noise_from_b0(data, gtab, bvals, mask=None, b0_threshold=50):
+def noise_from_b0(data, gtab, bvals, mask=None, b0_threshold=50,
+                  chunk_size=10):
     """
     Coped from vistasoft's dtiComputeImageNoise
     https://github.com/vistalab/vistasoft
@@ -21,45 +22,47 @@ def noise_from_b0(data, gtab, bvals, mask=None, b0_threshold=50):
 
     Parameters
     ----------
-    data_files : str or list
-        Files containing DWI data. If this is a str, that's the full path to a
-        single file. If it's a list, each entry is a full path.
-    bval_files : str or list
-        Equivalent to `data_files`.
+    data : ndarray
+        4D DWI data.
+    gtab : GradientTable
+        The gradient table of the data.
+    bvals : ndarray
+        The b-values of the volumes in `data`.
     mask : ndarray, optional
         Binary mask, set to True or 1 in voxels to be processed.
         Default: Process all voxels.
     b0_threshold : float
+    chunk_size : int, optional
+        Number of volumes gathered at a time, which bounds the memory used
+        to `chunk_size` volumes of the voxels in the mask, in float32.
+        Default: 10
     """
-    # make all-inclusive mask if None is provided
-    if mask is None:
-        mask = np.ones(data.shape[:3])
-
-    # Number of volumes in the dw dataset
-    num_vols = data.shape[3]
-
     # Get brainmask indices
-    brain_inds = (mask > 0)
-
-    # preallocate a 2d array
-    # The first dimension is the number of volumes
-    # and the 2nd is each voxel (within the brain mask)
-    masked_data = np.zeros((num_vols, np.sum(brain_inds)))
-    # Loop over the volumes and assign the voxels within the brain mask
-    # to masked_data
-    for i in range(num_vols):
-        tmp = data[:, :, :, i]
-        masked_data[i, :] = tmp[brain_inds]
+    if mask is None:
+        brain_inds = np.ones(data.shape[:3], dtype=bool)
+    else:
+        brain_inds = (mask > 0)
 
     # Find which volumes are b=0
     b0_inds = (bvals > b0_threshold)
     n = len(b0_inds)
-    # Pull out the b=0 volumes
-    b0_data = masked_data[b0_inds, :]
+
+    # Only gather the voxels within the brain mask of the volumes that are
+    # used, a few volumes at a time, instead of copying all of the data.
+    # The std of each volume is accumulated in double precision:
+    vol_inds = np.flatnonzero(b0_inds)
+    vol_stds = np.zeros(len(vol_inds))
+    for start in range(0, len(vol_inds), chunk_size):
+        chunk = vol_inds[start:start + chunk_size]
+        b0_data = np.take(data, chunk, axis=3)[brain_inds].astype(
+            np.float32, copy=False)
+        vol_stds[start:start + chunk_size] = np.std(
+            b0_data, axis=0, ddof=1, dtype=np.float64)
+
     # Calculate the median of the standard deviation. We do not think that
     # this needs to be rescaled. Henkelman et al. (1985) suggest that this
     # aproaches the true noise as the signal increases.
-    sigma = np.median(np.std(b0_data, axis=1, ddof=1))
+    sigma = np.median(vol_stds)
 
     # std of a sample underestimates sigma
     # (see http://nbviewer.ipython.org/4287207/)
@@ -72,7 +75,11 @@ def noise_from_b0(data, gtab, bvals, mask=None, b0_threshold=50):
     return sigma + bias
 
 
-def _fit(gtab, data, mask=None, sigma=None):
+def _fit(gtab, data, mask=None, sigma=None, **kwargs):
+    """
+    Helper function that fits the DTI model, in blocks of voxels.
+    kwargs are passed to `AFQ.utils.models.fit_in_blocks`.
+    """
     if sigma is None:
         dtimodel = dti.TensorModel(gtab)
     else:
@@ -80,7 +87,8 @@ def _fit(gtab, data, mask=None, sigma=None):
             gtab,
             fit_method="RT",
             sigma=sigma)
-    return dtimodel.fit(data, mask=mask)
+    params = ut.fit_in_blocks(dtimodel, data, mask=mask, **kwargs)
+    return dti.TensorFit(dtimodel, params)
 
 
 def fit_dti(data_files, bval_files, bvec_files, mask=None,
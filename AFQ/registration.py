@@ -19,9 +19,12 @@ from dipy.align.transforms import (TranslationTransform3D,
 
 import dipy.core.gradients as dpg
 import dipy.data as dpd
-from dipy.align.streamlinear import \
-    StreamlineLinearRegistration, whole_brain_slr
-from dipy.tracking.streamline import set_number_of_points
+from dipy.align.streamlinear import (StreamlineLinearRegistration,
+                                     progressive_slr, DEFAULT_BOUNDS)
+from dipy.segment.bundles import qbx_and_merge
+from dipy.tracking.streamline import (set_number_of_points, length,
+                                      select_random_set_of_streamlines,
+                                      Streamlines)
 from dipy.tracking.utils import transform_tracking_output
 from dipy.io.streamline import load_tractogram, load_trk
 
@@ -36,7 +39,8 @@ syn_metric_dict = {'CC': CCMetric,
 __all__ = ["syn_registration", "syn_register_dwi", "write_mapping",
            "read_mapping", "resample", "c_of_mass", "translation", "rigid",
            "affine", "affine_registration", "register_series", "register_dwi",
-           "streamline_registration"]
+           "streamline_registration", "slr_centroids", "centroid_slr",
+           "slr_registration"]
 
 
 def syn_registration(moving, static,
@@ -142,7 +146,7 @@ def syn_register_dwi(dwi, gtab, template=None, **syn_kwargs):
     return warped_b0, mapping
 
 
-def write_mapping(mapping, fname):
+def write_mapping(mapping, fname, dtype=np.float32):
     """
     Write out a syn registration mapping to file
 
@@ -150,25 +154,81 @@ def write_mapping(mapping, fname):
     ----------
     mapping : a DiffeomorphicMap object derived from :func:`syn_registration`
     fname : str
-        Full path to the nifti file storing the mapping
+        Full path to the file storing the mapping. If this ends with
+        '.npz', the forward and backward fields are stored as separate,
+        uncompressed arrays, so that each direction can be read on its own
+        (see :func:`read_mapping`). Otherwise, they are stacked into one
+        nifti file.
+    dtype : dtype or str, optional
+        Only used for '.npz' files. The precision in which the fields are
+        stored. One of np.float32, np.float16, or np.int16. If np.int16,
+        each field is linearly quantized, with its scale stored alongside
+        it. Default: np.float32
 
     """
     if isinstance(mapping, DiffeomorphicMap):
-        mapping_data = np.array([mapping.forward.T, mapping.backward.T]).T
-        nib.save(nib.Nifti1Image(mapping_data, mapping.codomain_world2grid),
-                 fname)
+        if fname.endswith('.npz'):
+            fields = {}
+            for direction in ['forward', 'backward']:
+                field, scale = _encode_field(
+                    getattr(mapping, direction), dtype)
+                fields[direction] = field
+                fields[direction + '_scale'] = scale
+            np.savez(fname,
+                     disp_affine=mapping.codomain_world2grid,
+                     **fields)
+        else:
+            mapping_data = np.array([mapping.forward.T,
+                                     mapping.backward.T]).T
+            nib.save(nib.Nifti1Image(mapping_data,
+                                     mapping.codomain_world2grid),
+                     fname)
     else:
         np.save(fname, mapping.affine)
 
 
-def read_mapping(disp, domain_img, codomain_img, prealign=None):
+def _encode_field(field, dtype):
+    """
+    Helper function that casts a displacement field to the storage dtype
+    """
+    dtype = np.dtype(dtype)
+    if dtype == np.int16:
+        scale = np.max(np.abs(field)) / np.iinfo(np.int16).max
+        if scale == 0:
+            scale = 1.
+        field = np.round(field / scale).astype(np.int16)
+    elif dtype in (np.float32, np.float16):
+        scale = 1.
+        field = np.asarray(field).astype(dtype)
+    else:
+        raise ValueError((
+            "dtype should be one of float32, float16, int16,"
+            f" you input {dtype}"))
+    return field, np.float32(scale)
+
+
+def _decode_field(npz, direction):
+    """
+    Helper function that reads one field from a '.npz' mapping file
+    """
+    field = npz[direction]
+    if field.dtype == np.int16:
+        field = field.astype(np.float32)
+        field *= npz[direction + '_scale']
+        return field
+    return field.astype(np.float32, copy=False)
+
+
+def read_mapping(disp, domain_img, codomain_img, prealign=None,
+                 fields="both"):
     """
     Read a syn registration mapping from a nifti file
 
     Parameters
     ----------
     disp : str, Nifti1Image, or ndarray
-        If string, file must of an image or ndarray.
+        If string, file must of an image, a '.npz' file written by
+        :func:`write_mapping`, or ndarray.
         If image, contains the mapping displacement field in each voxel
         Shape (x, y, z, 3, 2)
         If ndarray, contains affine transformation used for mapping
@@ -177,10 +237,23 @@ def read_mapping(disp, domain_img, codomain_img, prealign=None):
 
     codomain_img : str or Nifti1Image
 
+    fields : str, optional
+        Which displacement fields to read from a '.npz' mapping file.
+        One of "both", "forward" or "backward". The mappings read here are
+        inverted, so `transform_inverse` only needs the "forward" field,
+        and `transform` only needs the "backward" field. The field that is
+        not read is left as None. Ignored for other formats.
+        Default: "both"
+
     Returns
     -------
     A :class:`DiffeomorphicMap` object
     """
+    if fields not in ["both", "forward", "backward"]:
+        raise ValueError((
+            "fields should be one of 'both', 'forward', 'backward',"
+            f" you input {fields}"))
+
     if isinstance(disp, str):
         if "nii.gz" in disp:
             disp = nib.load(disp)
@@ -193,7 +266,28 @@ def read_mapping(disp, domain_img, codomain_img, prealign=None):
     if isinstance(codomain_img, str):
         codomain_img = nib.load(codomain_img)
 
-    if isinstance(disp, nib.Nifti1Image):
+    if isinstance(disp, np.lib.npyio.NpzFile):
+        with disp:
+            disp_affine = disp['disp_affine']
+            if fields == "both":
+                directions = ['forward', 'backward']
+            else:
+                directions = [fields]
+            disp_data = {direction: _decode_field(disp, direction)
+                         for direction in directions}
+        disp_shape = next(iter(disp_data.values())).shape[:3]
+
+        mapping = DiffeomorphicMap(3, disp_shape,
+                                   disp_grid2world=np.linalg.inv(disp_affine),
+                                   domain_shape=domain_img.shape[:3],
+                                   domain_grid2world=domain_img.affine,
+                                   codomain_shape=codomain_img.shape,
+                                   codomain_grid2world=codomain_img.affine,
+                                   prealign=prealign)
+        mapping.forward = disp_data.get('forward', None)
+        mapping.backward = disp_data.get('backward', None)
+        mapping.is_inverse = True
+    elif isinstance(disp, nib.Nifti1Image):
         mapping = DiffeomorphicMap(3, disp.shape[:3],
                                    disp_grid2world=np.linalg.inv(disp.affine),
                                    domain_shape=domain_img.shape[:3],
@@ -473,9 +567,123 @@ def reduce_shape(shape):
         return shape
 
 
+def slr_centroids(streamlines, greater_than=50, less_than=250,
+                  qbx_thr=[40, 30, 20, 15], nb_pts=20, rm_small_clusters=50,
+                  select_random=None, rng=None):
+    """
+    Cluster streamlines into the centroids used by whole-brain SLR
+
+    This is the per-tractogram preprocessing done by dipy's
+    `whole_brain_slr`, split out so that the centroids of an atlas can be
+    computed once and reused across subjects.
+
+    Parameters
+    ----------
+    streamlines : Streamlines
+        The streamlines to cluster.
+    greater_than, less_than : int, optional
+        Only streamlines with lengths in between these values are clustered.
+        Default: 50 and 250.
+    qbx_thr : list of int, optional
+        Thresholds for QuickBundlesX. Default: [40, 30, 20, 15].
+    nb_pts : int, optional
+        Number of points each streamline is resampled to before clustering.
+        Default: 20.
+    rm_small_clusters : int, optional
+        Clusters with fewer streamlines than this are removed. Default: 50.
+    select_random : int, optional
+        If given, only a random subsample of this many streamlines is
+        clustered. Default: None, cluster all of them.
+    rng : RandomState, optional
+        Used for subsampling and clustering. If None, a RandomState with a
+        fixed seed is used, so that the centroids are reproducible.
+
+    Returns
+    -------
+    Streamlines : the centroids of the clusters that were kept.
+    """
+    if rng is None:
+        rng = np.random.RandomState(0)
+    lengths = np.asarray(length(streamlines))
+    streamlines = Streamlines(streamlines[np.logical_and(
+        lengths > greater_than, lengths < less_than)])
+    if select_random is not None and select_random < len(streamlines):
+        streamlines = select_random_set_of_streamlines(
+            streamlines, select_random, rng=rng)
+    streamlines = set_number_of_points(streamlines, nb_pts)
+    cluster_map = qbx_and_merge(streamlines, thresholds=qbx_thr, rng=rng,
+                                verbose=False)
+    centroids = Streamlines()
+    for cluster in cluster_map:
+        if len(cluster) >= rm_small_clusters:
+            centroids.append(cluster.centroid)
+    return centroids
+
+
+def centroid_slr(static_centroids, moving, x0='affine', maxiter=100,
+                 progressive=True, num_threads=None, verbose=False,
+                 **kwargs):
+    """
+    Whole-brain SLR of streamlines to precomputed static centroids
+
+    Equivalent to dipy's `whole_brain_slr`, except that the static side has
+    already been clustered with `slr_centroids` (e.g. an atlas, see
+    `AFQ.data.read_slr_centroids`), so that only the moving side is
+    clustered here.
+
+    Parameters
+    ----------
+    static_centroids : Streamlines
+        Centroids of the static (target) streamlines.
+    moving : Streamlines
+        The streamlines to register.
+    x0 : str, optional
+        Initial transformation. Default: 'affine'.
+    maxiter : int, optional
+        Maximum number of iterations, if not `progressive`. Default: 100.
+    progressive : bool, optional
+        Whether to use progressive SLR. Default: True.
+    num_threads : int, optional
+        Number of threads used by the SLR metric. Default: None.
+    verbose : bool, optional
+        Ignored. Accepted for compatibility with dipy's `whole_brain_slr`,
+        which `slr_registration` used to pass its kwargs to.
+        Default: False.
+    **kwargs :
+        Passed to `slr_centroids` for clustering the moving streamlines.
+
+    Returns
+    -------
+    moved : Streamlines
+        All of `moving`, transformed.
+    matrix : ndarray
+        The affine transformation from moving to static.
+    static_centroids, moving_centroids : Streamlines
+    """
+    moving_centroids = slr_centroids(moving, **kwargs)
+    if not len(static_centroids) or not len(moving_centroids):
+        raise ValueError(
+            "No clusters are left for SLR, consider lowering "
+            "rm_small_clusters or greater_than")
+
+    if progressive:
+        slm = progressive_slr(static_centroids, moving_centroids, x0=x0,
+                              metric=None, bounds=DEFAULT_BOUNDS,
+                              num_threads=num_threads)
+    else:
+        slr = StreamlineLinearRegistration(x0=x0,
+                                           options={'maxiter': maxiter},
+                                           num_threads=num_threads)
+        slm = slr.optimize(static_centroids, moving_centroids)
+
+    return (slm.transform(moving), slm.matrix,
+            static_centroids, moving_centroids)
+
+
 def slr_registration(moving_data, static_data,
                      moving_affine=None, static_affine=None,
-                     moving_shape=None, static_shape=None, **kwargs):
+                     moving_shape=None, static_shape=None,
+                     static_centroids=None, **kwargs):
     """Register a source image (moving) to a target image (static).
 
     Parameters
@@ -492,16 +700,24 @@ def slr_registration(moving_data, static_data,
         The affine associated with the static (target) data.
     static_shape : ndarray
         The shape of the space associated with the static (target) data.
+    static_centroids : Streamlines, optional
+        Precomputed `slr_centroids` of the static data. If None, they are
+        computed from `static_data`. Default: None.
 
     **kwargs:
-        kwargs are passed into whole_brain_slr
+        kwargs are passed into centroid_slr
 
     Returns
     -------
     AffineMap
     """
-    _, transform, _, _ = whole_brain_slr(
-        static_data, moving_data, x0='affine', verbose=False, **kwargs)
+    if static_centroids is None:
+        static_centroids = slr_centroids(static_data, **{
+            k: kwargs[k] for k in [
+                "greater_than", "less_than", "qbx_thr", "nb_pts",
+                "rm_small_clusters"] if k in kwargs})
+    _, transform, _, _ = centroid_slr(
+        static_centroids, moving_data, x0='affine', **kwargs)
 
     return ConformedAffineMap(transform,
                               codomain_grid_shape=reduce_shape(static_shape),
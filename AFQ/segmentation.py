@@ -4,7 +4,6 @@ import logging
 
 import numpy as np
 from scipy.spatial.distance import cdist
-from scipy.stats import zscore
 
 import nibabel as nib
 from tqdm.auto import tqdm
@@ -12,9 +11,8 @@ from tqdm.auto import tqdm
 
 import dipy.tracking.streamline as dts
 import dipy.tracking.streamlinespeed as dps
+from dipy.core.interpolation import interpolate_vector_3d
 from dipy.segment.bundles import RecoBundles
-from dipy.align.streamlinear import whole_brain_slr
-from dipy.stats.analysis import gaussian_weights
 import dipy.core.gradients as dpg
 from dipy.io.stateful_tractogram import StatefulTractogram, Space
 from dipy.io.streamline import save_tractogram
@@ -49,6 +47,7 @@ class Segmentation:
                  progressive=True,
                  greater_than=50,
                  rm_small_clusters=50,
+                 select_random=None,
                  model_clust_thr=5,
                  reduction_thr=20,
                  refine=False,
@@ -93,6 +92,12 @@ class Segmentation:
             Remove clusters that have less than this value
                 during whole brain SLR.
             Default: 50
+        select_random : int, optional
+            Using RecoBundles Algorithm.
+            Cluster only a random subsample of this many of the subject's
+                streamlines during whole brain SLR, drawn using `rng`.
+                The atlas is clustered once and cached.
+            Default: None, cluster all of them.
         model_clust_thr : int
             Parameter passed on to recognize for Recobundles.
             See Recobundles documentation.
@@ -176,6 +181,7 @@ class Segmentation:
         self.progressive = progressive
         self.greater_than = greater_than
         self.rm_small_clusters = rm_small_clusters
+        self.select_random = select_random
         self.model_clust_thr = model_clust_thr
         self.reduction_thr = reduction_thr
         self.refine = refine
@@ -353,11 +359,14 @@ class Segmentation:
                                     self.fbval,
                                     self.fbvec,
                                     b0_threshold=self.b0_threshold)
+            # Segmentation only warps with `transform_inverse` and
+            # `mapping.forward`, so the backward field is not needed:
             self.mapping = reg.read_mapping(
                 mapping,
                 self.img,
                 reg_template,
-                prealign=np.linalg.inv(reg_prealign))
+                prealign=np.linalg.inv(reg_prealign),
+                fields="forward")
         else:
             self.mapping = mapping
 
@@ -433,7 +442,7 @@ class Segmentation:
         if not isinstance(prob_map, np.ndarray):
             prob_map = prob_map.get_fdata()
         warped_prob_map = \
-            self.mapping.transform_inverse(prob_map,
+            self.mapping.transform_inverse(prob_map.astype(np.float32),
                                            interpolation='nearest')
         return warped_prob_map, include_rois, exclude_rois
 
@@ -504,14 +513,12 @@ class Segmentation:
             out_idx = np.arange(n_streamlines, dtype=int)
 
         if self.filter_by_endpoints:
-            aal_atlas = afd.read_aal_atlas(self.reg_template)
             if self.save_intermediates is not None:
                 nib.save(
-                    aal_atlas['atlas'],
+                    afd.read_aal_atlas(self.reg_template)['atlas'],
                     op.join(self.save_intermediates,
                             'AAL_registered_to_template.nii.gz'))
 
-            aal_atlas = aal_atlas['atlas'].get_fdata()
             # We need to calculate the size of a voxel, so we can transform
             # from mm to voxel units:
             R = self.img_affine[0:3, 0:3]
@@ -620,15 +627,14 @@ class Segmentation:
 
             if self.filter_by_endpoints:
                 self.logger.info("Filtering by endpoints")
-                # Create binary masks and warp these into subject's DWI space:
-                aal_targets = afd.bundles_to_aal([bundle], atlas=aal_atlas)[0]
+                # Warp the binary target masks into subject's DWI space:
+                aal_targets = afd.read_aal_targets(
+                    [bundle], resample_to=self.reg_template)[0]
                 aal_idx = []
                 for targ in aal_targets:
                     if targ is not None:
-                        aal_roi = np.zeros(aal_atlas.shape[:3])
-                        aal_roi[targ[:, 0], targ[:, 1], targ[:, 2]] = 1
                         warped_roi = self.mapping.transform_inverse(
-                            aal_roi,
+                            targ.astype(np.float32),
                             interpolation='nearest')
                         aal_idx.append(np.array(np.where(warped_roi > 0)).T)
                     else:
@@ -707,21 +713,28 @@ class Segmentation:
 
         if reg_algo == "slr":
             self.logger.info("Registering tractogram with SLR")
-            atlas = self.bundle_dict['whole_brain']
-            self.moved_sl, _, _, _ = whole_brain_slr(
-                atlas, self.tg.streamlines, x0='affine', verbose=False,
+            atlas_centroids = afd.read_slr_centroids(
+                self.bundle_dict['whole_brain'],
+                greater_than=self.greater_than,
+                rm_small_clusters=self.rm_small_clusters)
+            self.moved_sl, _, _, _ = reg.centroid_slr(
+                atlas_centroids, self.tg.streamlines, x0='affine',
                 progressive=self.progressive,
                 greater_than=self.greater_than,
                 rm_small_clusters=self.rm_small_clusters,
+                select_random=self.select_random,
                 rng=self.rng)
         elif reg_algo == "syn":
             self.logger.info("Registering tractogram based on syn")
             self.tg.to_rasmm()
-            delta = dts.values_from_volume(
+            # Interpolate the displacement at all points at once, on the
+            # flat buffer of a (compact) copy of the streamlines, which
+            # keeps their lengths and offsets:
+            self.moved_sl = self.tg.streamlines.copy()
+            delta, _ = interpolate_vector_3d(
                 self.mapping.forward,
-                self.tg.streamlines, np.eye(4))
-            self.moved_sl = dts.Streamlines(
-                [d + s for d, s in zip(delta, self.tg.streamlines)])
+                self.moved_sl._data.astype(np.float64))
+            self.moved_sl._data += delta
             self.tg.to_vox()
 
         if self.save_intermediates is not None:
@@ -796,6 +809,63 @@ class Segmentation:
         return fiber_groups
 
 
+class _NodeStats:
+    """
+    Per-node means and covariances of the coordinates of a bundle of
+    streamlines (resampled to the same number of nodes), kept as running
+    sums, so they can be downdated when streamlines are dropped.
+    """
+
+    def __init__(self, fgarray):
+        # Sums are taken relative to the initial mean, for numerical
+        # stability:
+        self.origin = np.mean(fgarray, 0)
+        self._sums(fgarray)
+
+    def _sums(self, fgarray):
+        delta = fgarray - self.origin
+        self.n = len(fgarray)
+        self.sum = np.sum(delta, 0)
+        self.sum_sq = np.einsum('sni,snj->nij', delta, delta)
+
+    def remove(self, fgarray, drop):
+        """Downdate with the streamlines `fgarray[drop]`"""
+        n_drop = np.sum(drop)
+        if n_drop > self.n - n_drop:
+            # Cheaper to start over from the streamlines that are kept:
+            self._sums(fgarray[~drop])
+            return
+        delta = fgarray[drop] - self.origin
+        self.n -= n_drop
+        self.sum -= np.sum(delta, 0)
+        self.sum_sq -= np.einsum('sni,snj->nij', delta, delta)
+
+    def mahalanobis(self, fgarray, stat=np.mean):
+        """
+        Mahalanobis distance of each node of each streamline in `fgarray`
+        (which are the streamlines that the statistics describe), as in
+        `dipy.stats.analysis.gaussian_weights`.
+        """
+        mean = self.sum / self.n
+        cov = self.sum_sq / self.n - np.einsum('ni,nj->nij', mean, mean)
+        # As in dipy, only the upper triangle of the covariance is used:
+        cov = np.triu(cov)
+        # Where all the streamlines have the exact same coordinate in a
+        # node, each streamline gets a weight equal to the number of
+        # streamlines:
+        degenerate = np.all(np.abs(cov) <= 1e-8, axis=(-2, -1))
+        cov[degenerate] = np.eye(3)
+        if stat is np.mean:
+            center = self.origin + mean
+        else:
+            center = stat(fgarray, 0)
+        delta = fgarray - center
+        w = np.sqrt(np.einsum('sni,nij,snj->sn',
+                              delta, np.linalg.inv(cov), delta))
+        w[:, degenerate] = self.n
+        return w
+
+
 def clean_bundle(tg, n_points=100, clean_rounds=5, distance_threshold=5,
                  length_threshold=4, min_sl=20, stat='mean',
                  return_idx=False):
@@ -847,34 +917,54 @@ def clean_bundle(tg, n_points=100, clean_rounds=5, distance_threshold=5,
 
     # Resample once up-front:
     fgarray = _resample_tg(tg, n_points)
+    # All streamlines now have n_points, so their (contiguous) data can be
+    # viewed as one array:
+    fgarray = np.reshape(
+        getattr(fgarray, "_data", fgarray), (-1, n_points, 3))
 
     # Keep this around, so you can use it for indexing at the very end:
     idx = np.arange(len(fgarray))
     # This calculates the Mahalanobis for each streamline/node:
-    w = gaussian_weights(fgarray, return_mahalnobis=True, stat=stat)
-    lengths = np.array([sl.shape[0] for sl in tg.streamlines])
+    node_stats = _NodeStats(fgarray)
+    w = node_stats.mahalanobis(fgarray, stat=stat)
+    lengths = np.asarray(tg.streamlines._lengths, dtype=float)
+    length_sums = np.array([np.sum(lengths), np.sum(lengths ** 2)])
     # We'll only do this for clean_rounds
     rounds_elapsed = 0
-    while ((np.any(w > distance_threshold)
-            or np.any(zscore(lengths) > length_threshold))
-           and rounds_elapsed < clean_rounds
-           and len(tg.streamlines) > min_sl):
+    while True:
+        n_sl = len(lengths)
+        length_mean = length_sums[0] / n_sl
+        length_std = np.sqrt(max(length_sums[1] / n_sl - length_mean ** 2, 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            length_z = (lengths - length_mean) / length_std
+        if not ((np.any(w > distance_threshold)
+                 or np.any(length_z > length_threshold))
+                and rounds_elapsed < clean_rounds
+                and len(tg.streamlines) > min_sl):
+            break
         # Select the fibers that have Mahalanobis smaller than the
         # threshold for all their nodes:
-        idx_dist = np.where(np.all(w < distance_threshold, axis=-1))[0]
-        idx_len = np.where(zscore(lengths) < length_threshold)[0]
-        idx_belong = np.intersect1d(idx_dist, idx_len)
+        belong = np.all(w < distance_threshold, axis=-1)
+        belong &= length_z < length_threshold
+        idx_belong = np.where(belong)[0]
 
         if len(idx_belong) < min_sl:
             # need to sort and return exactly min_sl:
             idx_belong = np.argsort(np.sum(w, axis=-1))[:min_sl]
+            belong = np.zeros(n_sl, dtype=bool)
+            belong[idx_belong] = True
+
+        # Downdate the statistics with the streamlines that were dropped:
+        node_stats.remove(fgarray, ~belong)
+        length_sums -= [np.sum(lengths[~belong]),
+                        np.sum(lengths[~belong] ** 2)]
 
-        idx = idx[idx_belong.astype(int)]
+        idx = idx[idx_belong]
         # Update by selection:
-        fgarray = fgarray[idx_belong.astype(int)]
-        lengths = lengths[idx_belong.astype(int)]
+        fgarray = fgarray[idx_belong]
+        lengths = lengths[idx_belong]
         # Repeat:
-        w = gaussian_weights(fgarray, return_mahalnobis=True)
+        w = node_stats.mahalanobis(fgarray)
         rounds_elapsed += 1
 
     # Select based on the variable that was keeping track of things for us:
@@ -1,8 +1,12 @@
 import tempfile
 import os
 import os.path as op
+import json
+import logging
 import shutil
 
+import fsspec
+import s3fs
 import toml
 
 import numpy as np
@@ -20,18 +24,25 @@ import nibabel.tmpdirs as nbtmp
 import dipy.tracking.utils as dtu
 import dipy.tracking.streamline as dts
 import dipy.data as dpd
+import dipy.core.gradients as dpg
 from dipy.data import fetcher, get_fnames
+from dipy.reconst import csdeconv
 from dipy.io.streamline import save_tractogram, load_tractogram
 from dipy.io.stateful_tractogram import StatefulTractogram, Space
 from dipy.testing.decorators import xvfb_it
 
+from moto import mock_s3
+
 from AFQ import api
 import AFQ.data as afd
 import AFQ.segmentation as seg
 import AFQ.utils.streamlines as aus
 import AFQ.registration as reg
 import AFQ.utils.bin as afb
+from AFQ.models import csd
 from AFQ.mask import RoiMask, ThresholdedScalarMask, PFTMask, MaskFile
+from AFQ.tests.test_data import s3_setup, TEST_BUCKET, TEST_DATASET
+from AFQ.utils.testing import make_bundle_streamlines
 
 
 def touch(fname, times=None):
@@ -237,6 +248,294 @@ def test_AFQ_fury():
     myafq.viz_bundles()
 
 
+def test_run_s3_study():
+    class FakeSubject:
+        def __init__(self, subject_id):
+            self.subject_id = subject_id
+
+        def download(self, directory, include_derivs, pbar):
+            os.makedirs(op.join(directory, self.subject_id))
+
+    class FakeStudy:
+        subjects = [FakeSubject(f"sub-0{ii}") for ii in range(4)]
+
+        def _download_non_sub_keys(self, directory):
+            os.makedirs(directory, exist_ok=True)
+
+        def _download_derivative_descriptions(self, include_derivs,
+                                              directory):
+            pass
+
+    class FakeAFQ:
+        def __init__(self, bids_path):
+            self.subject_id = op.basename(bids_path)
+            assert op.exists(op.join(bids_path, self.subject_id))
+            self.afq_path = op.join(bids_path, "derivatives", "afq")
+
+        @property
+        def dti(self):
+            os.makedirs(op.join(self.afq_path, self.subject_id))
+            touch(op.join(self.afq_path, self.subject_id, "dti.nii.gz"))
+
+        def export_all(self):
+            touch(op.join(self.afq_path, self.subject_id, "profiles.csv"))
+
+    with nbtmp.InTemporaryDirectory() as remote_path:
+        fs = fsspec.filesystem("file", auto_mkdir=True)
+        processed = api.run_s3_study(
+            FakeStudy(), remote_path, fs=fs, steps=("dti", "export_all"),
+            n_prefetch=2, _afq_class=FakeAFQ)
+        npt.assert_equal(processed, [f"sub-0{ii}" for ii in range(4)])
+        for subject_id in processed:
+            for fname in ["dti.nii.gz", "profiles.csv"]:
+                assert op.exists(op.join(remote_path, subject_id, fname))
+
+
+@mock_s3
+def test_run_s3_study_on_s3():
+    s3_setup()
+    study = afd.S3BIDSStudy(
+        study_id="test",
+        bucket=TEST_BUCKET,
+        s3_prefix=TEST_DATASET,
+        anon=False,
+        random_seed=42,
+        subjects=2,
+    )
+    subject_ids = [sub.subject_id for sub in study.subjects]
+
+    class FakeAFQ:
+        def __init__(self, bids_path):
+            # The subject was downloaded from S3:
+            self.subject_id = op.basename(bids_path)
+            assert op.exists(op.join(
+                bids_path, self.subject_id, "anat",
+                f"{self.subject_id}_T1w.nii.gz"))
+            assert op.exists(op.join(bids_path, "dataset_description.json"))
+            self.afq_path = op.join(bids_path, "derivatives", "afq")
+
+        @property
+        def dti(self):
+            os.makedirs(op.join(self.afq_path, self.subject_id))
+            touch(op.join(self.afq_path, self.subject_id, "dti.nii.gz"))
+
+        def export_all(self):
+            touch(op.join(self.afq_path, self.subject_id, "profiles.csv"))
+
+    remote_prefix = f"{TEST_DATASET}/derivatives/afq"
+    processed = api.run_s3_study(
+        study, f"{TEST_BUCKET}/{remote_prefix}", fs=s3fs.S3FileSystem(),
+        steps=("dti", "export_all"), include_derivs=False,
+        _afq_class=FakeAFQ)
+    npt.assert_equal(processed, subject_ids)
+
+    uploaded = afd._get_matching_s3_keys(
+        bucket=TEST_BUCKET, prefix=remote_prefix, anon=False)
+    npt.assert_equal(
+        sorted(uploaded),
+        sorted(f"{remote_prefix}/{subject_id}/{fname}"
+               for subject_id in subject_ids
+               for fname in ["dti.nii.gz", "profiles.csv"]))
+
+
+def test_clean_bundle_idx():
+    rng = np.random.default_rng(2021)
+    reference = nib.Nifti1Image(np.zeros((50, 50, 50)), np.eye(4))
+    streamlines = dts.Streamlines(
+        make_bundle_streamlines(rng, 60, outlier=8))
+    sl_idx = np.arange(0, 60, 2)
+    clean_params = afb.get_default_args(seg.clean_bundle)
+
+    kept_idx = api._clean_bundle_idx(
+        sl_idx, streamlines, reference, clean_params)
+    _, clean_idx = seg.clean_bundle(
+        StatefulTractogram(streamlines[sl_idx], reference, Space.VOX),
+        return_idx=True)
+    npt.assert_equal(kept_idx, clean_idx)
+    # The outlier, streamline 8, is the fifth of this bundle:
+    npt.assert_(4 not in kept_idx)
+    npt.assert_equal(len(kept_idx), 29)
+
+
+def test_clean_bundles():
+    rng = np.random.default_rng(2021)
+    reference = nib.Nifti1Image(np.zeros((50, 50, 50)), np.eye(4))
+    # Three interleaved bundles, listed out of uid order, and streamlines
+    # that are not in any of them:
+    bundle_dict = {"B": {"uid": 2}, "A": {"uid": 1}, "C": {"uid": 3},
+                   "whole_brain": {"uid": 4}}
+    sl_bundle = np.tile([1, 2, 3, 5], 30)
+    streamlines = make_bundle_streamlines(rng, len(sl_bundle), outlier=8)
+
+    with nbtmp.InTemporaryDirectory() as tmpdir:
+        bundles_file = op.join(tmpdir, "bundles.trk")
+        save_tractogram(
+            StatefulTractogram(streamlines, reference, Space.VOX,
+                               data_per_streamline={"bundle": sl_bundle}),
+            bundles_file, bbox_valid_check=False)
+        seg_idx = {b: (7 * np.arange(30) + uid).tolist()
+                   for b, uid in zip("ABC", [1, 2, 3])}
+        afd.write_json(bundles_file.split('.')[0] + '_idx.json', seg_idx)
+
+        myafq = api.AFQ.__new__(api.AFQ)
+        myafq.logger = logging.getLogger('AFQ.api')
+        myafq.bundle_dict = bundle_dict
+        myafq.clean_params = {**afb.get_default_args(seg.clean_bundle),
+                              'return_idx': True}
+        myafq._segment = lambda row: bundles_file
+        myafq._get_fname = lambda row, suffix, **kwargs: op.join(
+            tmpdir, "bundles" + suffix)
+        row = {'dwi_img': reference, 'dwi_affine': reference.affine,
+               'timing': {'Cleaning': 0}}
+        clean_bundles_file = myafq._clean_bundles(row)
+
+        # The bundles are assembled as they were one bundle at a time:
+        sft = load_tractogram(bundles_file, reference, Space.VOX)
+        tgram = nib.streamlines.Tractogram([], {'bundle': []})
+        return_idx = {}
+        for b in bundle_dict.keys():
+            if b != "whole_brain":
+                idx = np.where(sft.data_per_streamline['bundle']
+                               == bundle_dict[b]['uid'])[0]
+                this_tg, this_idx = seg.clean_bundle(
+                    StatefulTractogram(sft.streamlines[idx], reference,
+                                       Space.VOX),
+                    **myafq.clean_params)
+                return_idx[b] = np.array(seg_idx[b])[this_idx].tolist()
+                tgram = aus.add_bundles(tgram, nib.streamlines.Tractogram(
+                    this_tg.streamlines,
+                    data_per_streamline={
+                        'bundle': np.full((len(this_tg), 1),
+                                          bundle_dict[b]['uid'])},
+                    affine_to_rasmm=row['dwi_affine']))
+
+        clean_sft = load_tractogram(clean_bundles_file, reference, Space.VOX)
+        npt.assert_equal(len(clean_sft), len(tgram))
+        npt.assert_equal(clean_sft.streamlines._lengths,
+                         tgram.streamlines._lengths)
+        npt.assert_almost_equal(clean_sft.streamlines.get_data(),
+                                tgram.streamlines.get_data(), decimal=4)
+        npt.assert_equal(
+            np.asarray(clean_sft.data_per_streamline['bundle']).ravel(),
+            np.asarray(tgram.data_per_streamline['bundle']).ravel())
+        with open(clean_bundles_file.split('.')[0] + '_idx.json') as ff:
+            npt.assert_equal(json.load(ff), return_idx)
+        # The outlier, streamline 8, is the third of bundle A:
+        npt.assert_(seg_idx["A"][2] not in return_idx["A"])
+        npt.assert_equal(len(return_idx["A"]), 29)
+
+
+def test_export_session():
+    myafq = api.AFQ.__new__(api.AFQ)
+    myafq._session = None
+    reads = []
+
+    def read():
+        reads.append(len(reads))
+        return len(reads)
+
+    # Without a session, everything is read every time:
+    npt.assert_equal(myafq._session_get('a', read), 1)
+    npt.assert_equal(myafq._session_get('a', read), 2)
+
+    # Within a session, everything is read once:
+    with myafq._export_session():
+        npt.assert_equal(myafq._session_get('a', read), 3)
+        npt.assert_equal(myafq._session_get('a', read), 3)
+        npt.assert_equal(myafq._session_get('b', read), 4)
+    npt.assert_(myafq._session is None)
+    npt.assert_equal(myafq._session_get('a', read), 5)
+
+
+def test_AFQ_csd_cache(monkeypatch):
+    fdata, fbval, fbvec = dpd.get_fnames('small_64D')
+    img = nib.load(fdata)
+    data = img.get_fdata()
+    gtab = dpg.gradient_table(fbval, fbvec)
+
+    built = []
+    csd_model = csdeconv.ConstrainedSphericalDeconvModel
+    csd_model_init = csd_model.__init__
+
+    def counting_init(self, *args, **kwargs):
+        built.append(1)
+        csd_model_init(self, *args, **kwargs)
+
+    monkeypatch.setattr(csd_model, "__init__", counting_init)
+    csd._model_cache.clear()
+    with nbtmp.InTemporaryDirectory() as tmpdir:
+        myafq = api.AFQ.__new__(api.AFQ)
+        myafq.afq_path = tmpdir
+        myafq.parallel_params = {}
+        myafq.logger = logging.getLogger('AFQ.api')
+        myafq._get_fname = lambda row, suffix, *args, **kwargs: op.join(
+            tmpdir, row['subject'] + suffix)
+        myafq._get_data_gtab = lambda row: (row['data'], gtab, img)
+        myafq._brain_mask_data = lambda row: None
+        rows = [dict(subject=f"sub-0{ii}", data=this_data,
+                     dwi_affine=img.affine)
+                for ii, this_data in enumerate([data, data[::-1]])]
+
+        # The model is built once for subjects with the same acquisition
+        # scheme, and only its response is estimated for each subject:
+        params_files = [myafq._csd(row) for row in rows]
+        npt.assert_equal(len(built), 1)
+
+        # as is the group response:
+        for row in rows:
+            row["subject"] = row["subject"] + "_group"
+            myafq._csd(row, response="group")
+        npt.assert_equal(len(built), 1)
+
+        # The fit is the same as with a model built for the subject:
+        npt.assert_almost_equal(
+            nib.load(params_files[1]).get_fdata(),
+            csd_model(gtab, csd._response(gtab, data[::-1]),
+                      sh_order=8).fit(data[::-1]).shm_coeff)
+
+
+@pytest.mark.nightly2
+def test_export_all_reads_once(monkeypatch):
+    _, bids_path, _ = get_temp_hardi()
+    myafq = api.AFQ(
+        bids_path=bids_path,
+        dmriprep='vistasoft',
+        bundle_info=["SLF", "CST"],
+        tracking_params=dict(odf_model="dti",
+                             n_seeds=100,
+                             random_seeds=True,
+                             rng_seed=42),
+        viz_backend="plotly_no_gif")
+    # Compute the outputs that the exports start from:
+    myafq.tract_profiles
+
+    mapping_reads = []
+    bundle_reads = []
+    read_mapping = reg.read_mapping
+    read_bundle = aus.read_bundle
+
+    def counting_read_mapping(mapping, reference, *args, **kwargs):
+        mapping_reads.append(
+            (mapping, str(reference), kwargs.get('fields')))
+        return read_mapping(mapping, reference, *args, **kwargs)
+
+    def counting_read_bundle(trk_fname, uid, *args, **kwargs):
+        bundle_reads.append((trk_fname, uid))
+        return read_bundle(trk_fname, uid, *args, **kwargs)
+
+    monkeypatch.setattr(reg, "read_mapping", counting_read_mapping)
+    monkeypatch.setattr(aus, "read_bundle", counting_read_bundle)
+    myafq.export_all()
+
+    # Each mapping and each bundle of each bundle file is read once:
+    npt.assert_(len(mapping_reads) > 0)
+    npt.assert_equal(len(set(mapping_reads)), len(mapping_reads))
+    npt.assert_equal(
+        {fname for fname, _ in bundle_reads},
+        {myafq.clean_bundles[0], myafq.bundles[0]})
+    npt.assert_equal(len(set(bundle_reads)), len(bundle_reads))
+
+
 @pytest.mark.nightly3
 def test_AFQ_init():
     """
@@ -355,6 +654,11 @@ def test_API_type_checking():
             match="bundle_info must be None, a list of strings, or a dict"):
         api.AFQ(bids_path, bundle_info=[2, 3])
 
+    with pytest.raises(
+            TypeError,
+            match="csd_params must be None or a dict"):
+        api.AFQ(bids_path, csd_params="group")
+
 
 @pytest.mark.nightly5
 def test_AFQ_slr():
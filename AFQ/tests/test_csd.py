@@ -1,4 +1,5 @@
 import os.path as op
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import numpy.testing as npt
@@ -7,9 +8,12 @@ import nibabel as nib
 import nibabel.tmpdirs as nbtmp
 
 import dipy.data as dpd
-from dipy.reconst.shm import calculate_max_order
+import dipy.core.gradients as dpg
+from dipy.reconst.shm import calculate_max_order, anisotropic_power
+from dipy.direction import peaks_from_model
 
 from AFQ.models import csd
+from AFQ._fixes import solve_qp, _thread_qp_solvers, QP_SOLVER_CACHE_SIZE
 
 
 def test_fit_csd():
@@ -34,3 +38,103 @@ def test_fit_csd():
                 sh_coeffs_img = nib.load(fname)
                 npt.assert_equal(sh_order,
                                  calculate_max_order(sh_coeffs_img.shape[-1]))
+
+
+def test_csd_model_cache():
+    fdata, fbval, fbvec = dpd.get_fnames('small_64D')
+    data = nib.load(fdata).get_fdata()
+    gtab = dpg.gradient_table(fbval, fbvec)
+    bvecs = gtab.bvecs + 1e-7
+    gtab_jitter = dpg.gradient_table(gtab.bvals, bvecs)
+    npt.assert_equal(csd.gtab_fingerprint(gtab),
+                     csd.gtab_fingerprint(gtab_jitter))
+
+    response = (np.array([0.0015, 0.0003, 0.0003]), 100)
+    model = csd._model(gtab, data, response=response, sh_order=4)
+    npt.assert_(csd._model(gtab_jitter, data, response=response,
+                           sh_order=4) is model)
+    npt.assert_(csd._model(gtab, data, response=response,
+                           sh_order=6) is not model)
+
+    with nbtmp.InTemporaryDirectory() as tmpdir:
+        # The group response is estimated from the first subject only:
+        group_model = csd._model(gtab, data, response="group",
+                                 sh_order=4, cache_dir=tmpdir)
+        npt.assert_(csd._model(gtab, data[::-1], response="group",
+                               sh_order=4, cache_dir=tmpdir) is group_model)
+
+        # and is stored on disk, to be read by other processes:
+        csd._model_cache.clear()
+        from_disk = csd._model(gtab, data[::-1], response="group",
+                               sh_order=4, cache_dir=tmpdir)
+        npt.assert_array_equal(from_disk.response[0],
+                               group_model.response[0])
+
+    # Models for a response estimated from one subject are not cached, but
+    # share the parts that do not depend on the response:
+    csd._model_cache.clear()
+    model = csd._model(gtab, data, sh_order=4)
+    other_model = csd._model(gtab, data[::-1], sh_order=4)
+    npt.assert_(model is not other_model)
+    npt.assert_(model.B_dwi is other_model.B_dwi)
+    npt.assert_(model._cache is other_model._cache)
+    npt.assert_equal(len(csd._model_cache), 1)
+
+    # and only the most recently used models are kept in memory:
+    for ii in range(csd.MODEL_CACHE_SIZE + 1):
+        csd._model(gtab, data, sh_order=4,
+                   response=(np.array([0.0015, 0.0003, 0.0003]), 100 + ii))
+    npt.assert_equal(len(csd._model_cache), csd.MODEL_CACHE_SIZE)
+
+    npt.assert_raises(ValueError, csd._model, gtab, data, response="mine")
+
+
+def test_fit_anisotropic_power_map():
+    fdata, fbval, fbvec = dpd.get_fnames('small_64D')
+    img = nib.load(fdata)
+    gtab = dpg.gradient_table(fbval, fbvec)
+    mask = np.zeros(img.shape[:3])
+    mask[2:-2, 2:-2, 2:-2] = 1
+    mask_img = nib.Nifti1Image(mask, img.affine)
+    response = (np.array([0.0015, 0.0003, 0.0003]), 100)
+
+    ap = csd.fit_anisotropic_power_map(img, gtab, mask_img,
+                                       response=response, block_size=10)
+    npt.assert_equal(ap.shape, img.shape[:3])
+    npt.assert_equal(ap[mask == 0], 0)
+
+    # Same as the power of the SH coefficients of peaks_from_model:
+    model = csd._model(gtab, img.get_fdata(), response=response)
+    peaks = peaks_from_model(model, img.get_fdata(),
+                             dpd.get_sphere('symmetric724'),
+                             relative_peak_threshold=.5,
+                             min_separation_angle=25, mask=mask)
+    npt.assert_almost_equal(ap, anisotropic_power(peaks.shm_coeff))
+
+
+def test_solve_qp():
+    # With P = I and the constraint x >= 0, the solution is max(-Q, 0):
+    n = 10
+    P = np.eye(n)
+    G = -np.eye(n)
+    H = np.zeros(n)
+    rng = np.random.RandomState(0)
+    for _ in range(5):
+        Q = rng.randn(n)
+        npt.assert_almost_equal(solve_qp(P, Q, G, H), np.maximum(-Q, 0),
+                                decimal=3)
+    # The problem was only set up once for these P, G and H:
+    npt.assert_equal(
+        sum([s.P is P for s in _thread_qp_solvers().values()]), 1)
+
+    # Threads solving the same problem at the same time do not share a
+    # solver:
+    Qs = rng.randn(40, n)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        solutions = list(executor.map(lambda Q: solve_qp(P, Q, G, H), Qs))
+    npt.assert_almost_equal(solutions, np.maximum(-Qs, 0), decimal=3)
+
+    # Only the solvers of the most recently used problems are kept:
+    for _ in range(QP_SOLVER_CACHE_SIZE + 1):
+        solve_qp(np.eye(n), Q, G, H)
+    npt.assert_equal(len(_thread_qp_solvers()), QP_SOLVER_CACHE_SIZE)
@@ -4,6 +4,7 @@ import numpy as np
 import numpy.testing as npt
 import os
 import os.path as op
+import pickle
 import pytest
 import s3fs
 import shutil
@@ -75,6 +76,66 @@ def test_get_matching_s3_keys():
     assert set(fnames) == set(matching_keys)
 
 
+@mock_s3
+def test_read_s3_key_index(temp_data_dir, monkeypatch):
+    s3_setup()
+    monkeypatch.setattr(afd, "afq_home", temp_data_dir)
+
+    matching_keys = list(
+        afd._get_matching_s3_keys(bucket=TEST_BUCKET, prefix=TEST_DATASET)
+    )
+    index = afd.read_s3_key_index(TEST_BUCKET, TEST_DATASET, anon=False)
+    assert set(index["key"]) == set(matching_keys)
+    assert list(index["key"]) == sorted(index["key"])
+
+    # New subjects, and new objects at the top level of subjects that were
+    # already indexed, are added to the index:
+    client = afd.get_s3_client(anon=False)
+    indexed_subject = [
+        p for p in index["prefix"]
+        if op.basename(p.rstrip("/")).startswith("sub-")
+    ][0]
+    new_keys = {f"{TEST_DATASET}/sub-new/dwi/sub-new_dwi.bval",
+                f"{indexed_subject}new.json",
+                f"{indexed_subject}new/new.json"}
+    for new_key in new_keys:
+        client.put_object(Bucket=TEST_BUCKET, Key=new_key, Body=b"0")
+
+    listed = []
+    list_s3_objects = afd._list_s3_objects
+
+    def counting_list_s3_objects(client, bucket, prefix, delimiter=None):
+        listed.append((prefix, delimiter))
+        return list_s3_objects(client, bucket, prefix, delimiter=delimiter)
+
+    monkeypatch.setattr(afd, "_list_s3_objects", counting_list_s3_objects)
+    index = afd.read_s3_key_index(TEST_BUCKET, TEST_DATASET, anon=False)
+    assert set(index["key"]) == set(matching_keys) | new_keys
+
+    # Only the new or changed subjects are listed fully:
+    fully_listed = {prefix for prefix, delimiter in listed
+                    if delimiter is None}
+    assert fully_listed == {f"{TEST_DATASET}/sub-new/", indexed_subject}
+
+    # Deeper changes are only found when refreshing the whole index:
+    deep_key = f"{indexed_subject}new/deep.json"
+    client.put_object(Bucket=TEST_BUCKET, Key=deep_key, Body=b"0")
+    index = afd.read_s3_key_index(TEST_BUCKET, TEST_DATASET, anon=False)
+    assert deep_key not in set(index["key"])
+    index = afd.read_s3_key_index(
+        TEST_BUCKET, TEST_DATASET, anon=False, refresh=True)
+    new_keys.add(deep_key)
+    assert set(index["key"]) == set(matching_keys) | new_keys
+
+    # The stored index can be used without listing the study again:
+    client.delete_object(Bucket=TEST_BUCKET, Key=deep_key)
+    listed.clear()
+    index = afd.read_s3_key_index(
+        TEST_BUCKET, TEST_DATASET, anon=False, use_stored=True)
+    assert set(index["key"]) == set(matching_keys) | new_keys
+    assert listed == []
+
+
 @mock_s3
 def test_download_from_s3(temp_data_dir):
     s3_setup()
@@ -99,6 +160,57 @@ def test_download_from_s3(temp_data_dir):
     assert op.isfile(op.join(test_dir, "test_file"))
 
 
+@mock_s3
+def test_download_from_s3_multipart(temp_data_dir, monkeypatch):
+    client = afd.get_s3_client(anon=False)
+    client.create_bucket(Bucket=TEST_BUCKET)
+    content = np.random.RandomState(0).bytes(1000)
+    client.put_object(Bucket=TEST_BUCKET, Key="big_file", Body=content)
+    fname = op.join(temp_data_dir, "big_file")
+
+    afd._download_from_s3(fname=fname, bucket=TEST_BUCKET, key="big_file",
+                          anon=False, part_size=64)
+    with open(fname, "rb") as ff:
+        assert ff.read() == content
+    assert not op.exists(fname + ".part")
+    assert not op.exists(fname + ".part.json")
+
+    # Resume an interrupted download, in which only the first part was
+    # completed:
+    os.remove(fname)
+    etag = client.head_object(Bucket=TEST_BUCKET, Key="big_file")["ETag"]
+    with open(fname + ".part", "wb") as ff:
+        ff.write(content[:64] + bytes(len(content) - 64))
+    afd.write_json(fname + ".part.json",
+                   {"etag": etag, "part_size": 64, "done": [0]})
+    afd._download_from_s3(fname=fname, bucket=TEST_BUCKET, key="big_file",
+                          anon=False, part_size=64)
+    with open(fname, "rb") as ff:
+        assert ff.read() == content
+
+    # A local file with a different content is downloaded again:
+    with open(fname, "wb") as ff:
+        ff.write(bytes(len(content)))
+    afd._download_from_s3(fname=fname, bucket=TEST_BUCKET, key="big_file",
+                          anon=False, part_size=64,
+                          size=len(content), etag=etag)
+    with open(fname, "rb") as ff:
+        assert ff.read() == content
+
+    # A downloaded file is skipped, using the size and ETag from the key
+    # index, without hashing it again:
+    assert op.exists(op.join(temp_data_dir, ".big_file.etag"))
+    assert afd._is_downloaded(fname, len(content), etag)
+
+    def md5(*args):
+        raise AssertionError("The downloaded file was hashed again.")
+
+    monkeypatch.setattr(afd.hashlib, "md5", md5)
+    afd._download_from_s3(fname=fname, bucket=TEST_BUCKET, key="big_file",
+                          anon=False, part_size=64,
+                          size=len(content), etag=etag)
+
+
 @mock_s3
 def test_S3BIDSStudy(temp_data_dir):
     s3_setup()
@@ -221,3 +333,103 @@ def test_read_roi():
     roi = nib.Nifti1Image(np.zeros((10, 10, 10)), aff2)
     img = afd.read_resample_roi(roi, resample_to=template)
     npt.assert_equal(img.affine, template.affine)
+
+
+def test_read_template_files(temp_data_dir, monkeypatch):
+    monkeypatch.setattr(afd, "afq_home", temp_data_dir)
+    folder = op.join(temp_data_dir, "templates")
+    os.mkdir(folder)
+    files = ["roi1.nii.gz", "roi2.nii.gz"]
+    for f in files:
+        data = np.zeros((10, 10, 10))
+        data[2:5, 2:5, 2:5] = 1
+        nib.save(nib.Nifti1Image(data, np.eye(4)), op.join(folder, f))
+
+    target = nib.Nifti1Image(np.zeros((5, 5, 5)), np.diag([2, 2, 2, 1]))
+    templates = afd._read_template_files(files, folder, target, "test")
+    npt.assert_equal(sorted(templates.keys()), ["roi1", "roi2"])
+    for img in templates.values():
+        npt.assert_equal(img.shape, target.shape)
+        npt.assert_equal(img.affine, target.affine)
+
+    # The second call reads the resampled templates from the cache:
+    cached = afd._read_template_files(files, folder, target, "test")
+    for k in templates:
+        npt.assert_equal(cached[k].get_filename(),
+                         templates[k].get_filename())
+        npt.assert_equal(cached[k].get_fdata(), templates[k].get_fdata())
+
+
+def test_template_file(temp_data_dir):
+    fname = op.join(temp_data_dir, "roi.nii.gz")
+    data = np.zeros((10, 10, 10))
+    data[2:5, 2:5, 2:5] = 1
+    nib.save(nib.Nifti1Image(data, np.eye(4)), fname)
+
+    template = afd.TemplateFile(fname)
+    npt.assert_equal(template.shape, data.shape)
+    npt.assert_equal(template.affine, np.eye(4))
+    npt.assert_equal(template.get_fdata(), data)
+    npt.assert_(not template.get_fdata().flags.writeable)
+
+    # Only the file name is pickled, and the data is shared between
+    # references to the same file:
+    copied = pickle.loads(pickle.dumps(template))
+    npt.assert_equal(copied.fname, fname)
+    npt.assert_(copied.get_fdata() is template.get_fdata())
+
+    # Only the most recently used templates are kept in memory:
+    npt.assert_equal(afd._read_template_data.cache_info().maxsize,
+                     afd.TEMPLATE_CACHE_SIZE)
+
+    with pytest.raises(TypeError):
+        afd.TemplateFile(1)
+
+
+def test_read_aal_targets(monkeypatch):
+    atlas = np.zeros((20, 20, 20, 5))
+    atlas[0, 0, 0, 0] = 1
+    atlas[0, 0, 1, 0] = 2
+    atlas[1, 1, 1, 1] = 1
+    atlas[2, 2, 2, 2] = 1
+    monkeypatch.setattr(afd, "_aal_atlas", {
+        None: {"atlas": nib.Nifti1Image(atlas, np.eye(4))}})
+    monkeypatch.setattr(afd, "_aal_targets", {})
+
+    bundles = ["ATR_L", "ATR_R", "CST_L", "HCC_L"]
+    targets = afd.read_aal_targets(bundles)
+    for bundle_targets, bundle_idx in zip(
+            targets, afd.bundles_to_aal(bundles, atlas)):
+        for targ, idx in zip(bundle_targets, bundle_idx):
+            if idx is None:
+                npt.assert_equal(targ, None)
+            else:
+                npt.assert_equal(np.array(np.where(targ)).T, idx)
+
+    # Masks are computed once and shared between bundles:
+    npt.assert_(afd.read_aal_targets(["CST_R"])[0][0] is targets[2][0])
+
+
+@mock_s3
+def test_s3fs_nifti_read_write():
+    s3_setup()
+    fs = s3fs.S3FileSystem()
+    data = np.random.RandomState(0).rand(10, 11, 12, 3).astype(np.float32)
+    affine = np.diag([2, 2, 2, 1.])
+    fname = f"{TEST_BUCKET}/test_img.nii.gz"
+    afd.s3fs_nifti_write(nib.Nifti1Image(data, affine), fname, fs=fs)
+
+    img = afd.s3fs_nifti_read(fname, fs=fs)
+    npt.assert_equal(img.shape, data.shape)
+    npt.assert_equal(img.affine, affine)
+    npt.assert_equal(img.get_fdata(), data)
+
+    # Slices along the last axis only read the file up to their end:
+    reads = []
+    read = img.dataobj._read
+    img.dataobj._read = lambda n_last=None: (
+        reads.append(n_last), read(n_last))[1]
+    npt.assert_equal(img.dataobj[..., 0], data[..., 0])
+    npt.assert_equal(img.dataobj[:5, ..., -2:], data[:5, ..., -2:])
+    npt.assert_equal(img.dataobj[..., [0, 2]], data[..., [0, 2]])
+    npt.assert_equal(reads, [1, 3, None])
@@ -1,6 +1,7 @@
 import os
 import os.path as op
 
+import numpy as np
 import numpy.testing as npt
 import pytest
 
@@ -30,6 +31,36 @@ def test_fit_dki():
             op.exists(f)
 
 
+def test_avs_dki_df():
+    with nbtmp.InTemporaryDirectory() as tmpdir:
+        fbval = op.join(tmpdir, 'dki.bval')
+        fbvec = op.join(tmpdir, 'dki.bvec')
+        fdata = op.join(tmpdir, 'dki.nii.gz')
+        make_dki_data(fbval, fbvec, fdata)
+        gtab = dpg.gradient_table(fbval, fbvec)
+        data = nib.load(fdata).get_fdata()
+        mask = np.ones(data.shape[:-1], dtype=bool)
+        mask[0] = False
+
+        params = dki.avs_dki_df(gtab, data, mask=mask)
+        npt.assert_equal(params[0], 0)
+        npt.assert_almost_equal(
+            dki.avs_dki_df(gtab, data, mask=mask, chunk_size=3), params)
+
+        # Compare to a fit of each voxel on its own:
+        b = gtab.bvals.round(-2)
+        uniqueb = np.unique(b)
+        B = np.stack([-uniqueb, uniqueb ** 2 / 6, np.ones(len(uniqueb))], -1)
+        ng = np.sqrt([np.sum(b == ub) for ub in uniqueb])
+        for v in zip(*np.nonzero(mask)):
+            sig = np.array([np.mean(data[v][b == ub]) for ub in uniqueb])
+            BTW = np.dot(B.T, np.diag(ng * sig ** 2))
+            p = np.dot(np.linalg.pinv(np.dot(BTW, B)),
+                       np.dot(BTW, np.log(sig)))
+            npt.assert_almost_equal(
+                params[v], [p[0], p[1] / p[0] ** 2, np.exp(p[2])])
+
+
 def test_predict_dki():
     with nbtmp.InTemporaryDirectory() as tmpdir:
         fbval = op.join(tmpdir, 'dki.bval')
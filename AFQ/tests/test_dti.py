@@ -42,6 +42,15 @@ def test_noise_from_b0():
         noise = dti.noise_from_b0(data, gtab, bvals, mask=mask)
         npt.assert_almost_equal(noise, 0)
 
+        # the result does not depend on how many volumes are gathered at once
+        rng = np.random.RandomState(2)
+        noisy_data = data + rng.randn(*data.shape)
+        npt.assert_almost_equal(
+            dti.noise_from_b0(noisy_data, gtab, bvals, mask=mask,
+                              chunk_size=1),
+            dti.noise_from_b0(noisy_data, gtab, bvals, mask=mask))
+
+
 def test_fit_dti():
     # Let's see whether we can pass a list of files for each one:
     fdata1, fbval1, fbvec1 = dpd.get_fnames('small_101D')
@@ -1,8 +1,12 @@
 import os.path as op
+import pickle
 import numpy as np
 import numpy.testing as npt
 import pytest
 
+import nibabel as nib
+import nibabel.tmpdirs as nbtmp
+
 from bids.layout import BIDSLayout
 
 import AFQ.mask as afm
@@ -77,6 +81,57 @@ def test_resample_mask():
         mask_data.dtype)
 
 
+def test_full_mask():
+    with nbtmp.InTemporaryDirectory() as tmpdir:
+        dwi_file = op.join(tmpdir, "dwi.nii.gz")
+        affine = np.diag([2., 2., 2., 1.])
+        nib.save(nib.Nifti1Image(np.zeros((4, 5, 6, 3)), affine), dwi_file)
+        row = dict(dwi_file=dwi_file, subject="01", ses="01")
+
+        full_mask = afm.FullMask()
+        mask_data, mask_affine, _ = full_mask.get_mask(None, row)
+        npt.assert_equal(mask_data.shape, (4, 5, 6))
+        npt.assert_equal(mask_data.dtype, bool)
+        npt.assert_(np.all(mask_data))
+        npt.assert_array_equal(mask_affine, affine)
+
+        # The resolved mask is kept bit-packed and reused for the same
+        # subject:
+        other_row = dict(dwi_file=dwi_file, subject="02", ses="01")
+        full_mask.get_mask(None, other_row)
+        npt.assert_equal(len(full_mask._resolved_masks), 2)
+        npt.assert_array_equal(full_mask.get_mask(None, row)[0], mask_data)
+        npt.assert_equal(len(full_mask._resolved_masks), 2)
+        packed, shape = list(full_mask._resolved_masks.values())[0][0]
+        npt.assert_equal(packed.nbytes, int(np.ceil(4 * 5 * 6 / 8)))
+
+        # Only the most recently used masks are kept:
+        for ii in range(afm.MASK_CACHE_SIZE + 1):
+            full_mask.get_mask(
+                None, dict(dwi_file=dwi_file, subject=f"1{ii}", ses="01"))
+        npt.assert_equal(len(full_mask._resolved_masks), afm.MASK_CACHE_SIZE)
+
+        # Resolved masks are not pickled with the mask definition:
+        npt.assert_(not hasattr(
+            pickle.loads(pickle.dumps(full_mask)), "_resolved_masks"))
+
+
+def test_combine_mask_mixin():
+    class ThisMask(afm.CombineMaskMixin):
+        pass
+
+    for combine, expected in [("and", [False, False, False, True]),
+                              ("or", [False, True, True, True])]:
+        this_mask = ThisMask(combine)
+        this_mask.reset_mask_draft((4,))
+        draft = this_mask.mask_draft
+        this_mask.mask_draft = this_mask * np.array([0, 0, 1., 1.])
+        this_mask.mask_draft = this_mask * np.array([0, 1, 0, 1])
+        # combined in place:
+        npt.assert_(this_mask.mask_draft is draft)
+        npt.assert_array_equal(this_mask.mask_draft, expected)
+
+
 @pytest.mark.parametrize("subject", ["01", "02"])
 @pytest.mark.parametrize("session", ["01", "02"])
 def test_find_path(subject, session):
@@ -13,11 +13,12 @@ from AFQ.registration import (syn_registration, register_series, register_dwi,
                               c_of_mass, translation, rigid, affine,
                               streamline_registration, write_mapping,
                               read_mapping, syn_register_dwi, DiffeomorphicMap,
-                              slr_registration)
+                              slr_registration, slr_centroids)
 
 import AFQ.data as afd
 
 from dipy.tracking.utils import transform_tracking_output
+from dipy.tracking.streamline import Streamlines
 from dipy.io.streamline import load_trk, save_trk, load_tractogram
 from dipy.io.stateful_tractogram import StatefulTractogram, Space
 
@@ -70,6 +71,90 @@ def test_syn_registration():
                            file_mapping.__getattribute__(k)))
 
 
+def test_write_read_mapping_npz():
+    mapping = DiffeomorphicMap(3, subset_t2.shape,
+                               disp_grid2world=MNI_T2_affine,
+                               domain_shape=subset_b0.shape,
+                               domain_grid2world=hardi_affine,
+                               codomain_shape=subset_t2.shape,
+                               codomain_grid2world=MNI_T2_affine)
+    mapping.forward = np.random.randn(
+        *subset_t2.shape, 3).astype(np.float32)
+    mapping.backward = np.random.randn(
+        *subset_t2.shape, 3).astype(np.float32)
+    mapping.is_inverse = True
+    with nbtmp.InTemporaryDirectory() as tmpdir:
+        mapping_fname = op.join(tmpdir, 'mapping.npz')
+        for dtype, decimal in zip([np.float32, np.float16, np.int16],
+                                  [6, 2, 3]):
+            write_mapping(mapping, mapping_fname, dtype=dtype)
+            file_mapping = read_mapping(mapping_fname,
+                                        subset_b0_img,
+                                        subset_t2_img)
+            npt.assert_equal(file_mapping.forward.dtype, np.float32)
+            npt.assert_almost_equal(file_mapping.forward, mapping.forward,
+                                    decimal=decimal)
+            npt.assert_almost_equal(file_mapping.backward, mapping.backward,
+                                    decimal=decimal)
+
+        # Read only the field that is needed for transform_inverse:
+        file_mapping = read_mapping(mapping_fname,
+                                    subset_b0_img,
+                                    subset_t2_img,
+                                    fields="forward")
+        npt.assert_equal(file_mapping.backward, None)
+        npt.assert_almost_equal(file_mapping.forward, mapping.forward,
+                                decimal=3)
+
+        npt.assert_raises(ValueError, write_mapping, mapping,
+                          mapping_fname, dtype=np.int8)
+        npt.assert_raises(ValueError, read_mapping, mapping_fname,
+                          subset_b0_img, subset_t2_img, fields="both_ways")
+
+
+def test_slr_centroids():
+    file_dict = afd.read_stanford_hardi_tractography()
+    streamlines = file_dict['tractography_subsampled.trk']
+
+    # With the default fixed seed, clustering is reproducible:
+    centroids = slr_centroids(streamlines, greater_than=10,
+                              rm_small_clusters=1)
+    npt.assert_(len(centroids) > 0)
+    npt.assert_equal(centroids[0].shape, (20, 3))
+    npt.assert_array_equal(
+        centroids.get_data(),
+        slr_centroids(streamlines, greater_than=10,
+                      rm_small_clusters=1).get_data())
+
+    subsampled = slr_centroids(streamlines, greater_than=10,
+                               rm_small_clusters=1, select_random=50)
+    npt.assert_(len(subsampled) <= 50)
+
+    # Atlas centroids are computed once, then read from memory or disk:
+    orig_home = afd.afq_home
+    with nbtmp.InTemporaryDirectory() as tmpdir:
+        afd.afq_home = tmpdir
+        try:
+            cached = afd.read_slr_centroids(streamlines, greater_than=10,
+                                            rm_small_clusters=1)
+            npt.assert_array_almost_equal(cached.get_data(),
+                                          centroids.get_data())
+            npt.assert_(afd.read_slr_centroids(
+                streamlines, greater_than=10,
+                rm_small_clusters=1) is cached)
+            # Another object with the same streamlines is read from disk:
+            npt.assert_array_almost_equal(afd.read_slr_centroids(
+                Streamlines(streamlines), greater_than=10,
+                rm_small_clusters=1).get_data(), centroids.get_data())
+            afd._slr_centroids.clear()
+            from_disk = afd.read_slr_centroids(
+                streamlines, greater_than=10, rm_small_clusters=1)
+            npt.assert_array_almost_equal(from_disk.get_data(),
+                                          centroids.get_data())
+        finally:
+            afd.afq_home = orig_home
+
+
 def test_slr_registration():
     # have to import subject sls
     file_dict = afd.read_stanford_hardi_tractography()
@@ -97,6 +182,7 @@ def test_slr_registration():
                                    progressive=False,
                                    greater_than=10,
                                    rm_small_clusters=1,
+                                   verbose=False,
                                    rng=np.random.RandomState(seed=8))
         warped_moving = mapping.transform(subset_b0)
 
@@ -10,7 +10,7 @@ import dipy.data as dpd
 import dipy.data.fetcher as fetcher
 import dipy.tracking.streamline as dts
 import dipy.tracking.utils as dtu
-from dipy.stats.analysis import afq_profile
+from dipy.stats.analysis import afq_profile, gaussian_weights
 from dipy.io.stateful_tractogram import StatefulTractogram, Space
 
 import AFQ.data as afd
@@ -19,6 +19,7 @@ import AFQ.registration as reg
 import AFQ.segmentation as seg
 import AFQ.models.dti as dti
 from AFQ.utils.volume import patch_up_roi
+from AFQ.utils.testing import make_bundle_streamlines
 
 
 dpd.fetch_stanford_hardi()
@@ -225,6 +226,47 @@ def test_clean_by_endpoints():
     npt.assert_equal(list(clean_sl), [sl[0], sl[2], sl[3]])
 
 
+def test_clean_bundle_node_stats():
+    rng = np.random.default_rng(2021)
+    t = np.linspace(0, 1, 20)[:, None]
+    fgarray = np.array([
+        10 + 20 * t * np.array([1, 0.5, 0.2])
+        + rng.normal(0, 1, (1, 3)) * t
+        for _ in range(50)])
+    # All streamlines start at the same coordinate:
+    npt.assert_equal(np.ptp(fgarray[:, 0], axis=0), 0)
+
+    bundle = dts.Streamlines(fgarray)
+    node_stats = seg._NodeStats(fgarray)
+    npt.assert_almost_equal(
+        node_stats.mahalanobis(fgarray),
+        gaussian_weights(bundle, n_points=20, return_mahalnobis=True))
+    npt.assert_almost_equal(
+        node_stats.mahalanobis(fgarray, stat=np.median),
+        gaussian_weights(bundle, n_points=20, return_mahalnobis=True,
+                         stat=np.median))
+
+    # Downdating gives the same as calculating from scratch, both when
+    # removing a few streamlines and when removing most of them:
+    for n_keep in [45, 10]:
+        drop = np.ones(len(fgarray), dtype=bool)
+        drop[:n_keep] = False
+        node_stats = seg._NodeStats(fgarray)
+        node_stats.remove(fgarray, drop)
+        npt.assert_equal(node_stats.n, n_keep)
+        npt.assert_almost_equal(
+            node_stats.mahalanobis(fgarray[:n_keep]),
+            gaussian_weights(bundle[:n_keep], n_points=20,
+                             return_mahalnobis=True))
+
+    # Cleaning drops the outlier:
+    streamlines = make_bundle_streamlines(rng, 50, outlier=7)
+    tg = StatefulTractogram(streamlines, hardi_img, Space.VOX)
+    clean_sl, idx = seg.clean_bundle(tg, n_points=20, return_idx=True)
+    npt.assert_equal(len(clean_sl), 49)
+    npt.assert_(7 not in idx)
+
+
 def test_segment_sampled_streamlines():
 
     # default segmentation
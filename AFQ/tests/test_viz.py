@@ -1,5 +1,10 @@
 import pytest
 
+import numpy as np
+import numpy.testing as npt
+
+import dipy.tracking.streamline as dts
+
 from AFQ.viz.utils import Viz
 
 
@@ -12,3 +17,34 @@ def test_viz_name_errors():
         + " either 'plotly' or 'fury'. "
             + "It is currently set to plotli"):
         Viz("plotli")
+
+
+def test_draw_streamlines(monkeypatch):
+    import AFQ.viz.plotly_backend as plotly_backend
+    # Look at the inputs to the trace, rather than at a plotly object:
+    monkeypatch.setattr(plotly_backend.go, "Scatter3d", dict)
+
+    class Figure:
+        def add_trace(self, trace):
+            self.trace = trace
+
+    streamlines = dts.Streamlines([
+        np.array([[1, 1, 1], [2, 1, 1], [3, 1, 1.]]),
+        np.array([[1, 2, 2], [1, 3, 2.]]),
+        np.array([[4, 4, 4], [5, 5, 5.]])])
+    # Draw a view of two of the streamlines, in reverse order:
+    cbv = np.zeros((10, 10, 10))
+    cbv[1] = 1
+    cbv[5] = 2
+    figure = Figure()
+    plotly_backend._draw_streamlines(
+        figure, streamlines[[2, 0]], (10, 10, 10), (1, 0, 0), "b", cbv=cbv)
+
+    npt.assert_equal(
+        figure.trace['x'], 10 - np.array([4, 5, np.nan, 1, 2, 3, np.nan]))
+    npt.assert_equal(
+        figure.trace['z'], np.array([4, 5, np.nan, 1, 1, 1, np.nan]))
+    npt.assert_equal(
+        figure.trace['hovertext'], [0, 2, 0, 1, 0, 0, 0])
+    npt.assert_almost_equal(
+        figure.trace['line']['color'][:, 0], [0, 1.4, 0, 0.7, 0, 0, 0])
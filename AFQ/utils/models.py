@@ -1,7 +1,13 @@
+import os.path as op
+import multiprocessing
+import tempfile
+
 import numpy as np
 import nibabel as nib
 import dipy.core.gradients as dpg
 
+from AFQ.utils.parallel import parfor
+
 
 def prepare_data(data_files, bval_files, bvec_files, mask=None,
                  b0_threshold=50):
@@ -53,3 +59,115 @@ def prepare_data(data_files, bval_files, bvec_files, mask=None,
     gtab = dpg.gradient_table(bvals, bvecs, b0_threshold=b0_threshold)
 
     return img_array[-1], data, gtab, mask
+
+
+def _fit_block(block, model, data, params_attr, out=None):
+    """
+    Fit `model` to the voxels of one block, reading them from `data`, which
+    can be the file name of a .npy file that is then memory-mapped.
+
+    If `out` is given, the parameters are written into it, at the voxels of
+    the block, instead of being returned. It can also be the file name of a
+    .npy file, that is then memory-mapped.
+    """
+    if isinstance(data, str):
+        data = np.load(data, mmap_mode='r')
+    fit = model.fit(np.asarray(data[block]))
+    params = np.asarray(getattr(fit, params_attr))
+    if out is None:
+        return block, params
+    if isinstance(out, str):
+        out = np.load(out, mmap_mode='r+')
+        out[block] = params
+        out.flush()
+    else:
+        out[block] = params
+
+
+def fit_in_blocks(model, data, mask=None, params_attr="model_params",
+                  block_size=10000, n_jobs=1, engine="joblib",
+                  backend="loky"):
+    """
+    Fit a voxelwise dipy model in blocks of voxels within a mask
+
+    Parameters
+    ----------
+    model : dipy ReconstModel
+        The model to fit. Voxels are fit independently of each other.
+    data : ndarray
+        4D DWI data.
+    mask : ndarray, optional
+        Binary mask, set to True or 1 in voxels to be processed.
+        Default: Process all voxels.
+    params_attr : str, optional
+        The attribute of the fit that holds the model parameters.
+        Default: "model_params"
+    block_size : int, optional
+        Number of voxels fit at once. Default: 10000
+    n_jobs : int, optional
+        Number of blocks fit in parallel. -1 to use all cpus. If 1, blocks
+        are fit serially, in this process. Default: 1
+    engine, backend : str, optional
+        Passed to `AFQ.utils.parallel.parfor`. With a process-based backend,
+        the data is written to a temporary file that each worker
+        memory-maps, so that it is not copied to every worker.
+        Default: "joblib" and "loky"
+
+    Returns
+    -------
+    ndarray of shape data.shape[:-1] + (n_params, ), with zeros outside of
+    the mask.
+    """
+    if mask is None:
+        mask = np.ones(data.shape[:-1], dtype=bool)
+    else:
+        mask = (mask > 0)
+    if mask.shape != data.shape[:-1]:
+        raise ValueError("Mask is not the same shape as data.")
+
+    vox_inds = np.nonzero(mask)
+    blocks = [tuple(ii[start:start + block_size] for ii in vox_inds)
+              for start in range(0, len(vox_inds[0]), block_size)]
+    if not len(blocks):
+        # As with model.fit(data, mask), voxels outside of the mask are all
+        # zeros. One voxel is fit for the number of parameters:
+        _, voxel_params = _fit_block(
+            tuple(np.zeros(1, dtype=int) for _ in mask.shape),
+            model, data, params_attr)
+        return np.zeros(mask.shape + voxel_params.shape[1:],
+                        dtype=voxel_params.dtype)
+
+    if n_jobs == -1:
+        n_jobs = max(multiprocessing.cpu_count() - 1, 1)
+    if n_jobs == 1:
+        engine = "serial"
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # The first block gives the shape and dtype of the parameters:
+        first_block, first_params = _fit_block(
+            blocks[0], model, data, params_attr)
+        params = np.zeros(mask.shape + first_params.shape[1:],
+                          dtype=first_params.dtype)
+        params[first_block] = first_params
+
+        if engine != "serial" and backend in ["loky", "multiprocessing"]:
+            data_fname = op.join(tmpdir, "dwi.npy")
+            np.save(data_fname, data)
+            block_data = data_fname
+            params_fname = op.join(tmpdir, "params.npy")
+            np.save(params_fname, params)
+            out = params_fname
+        else:
+            block_data = data
+            out = params
+
+        # All the other blocks are submitted at once, so that the workers
+        # stay busy, and each worker writes its parameters into the output:
+        if len(blocks) > 1:
+            parfor(_fit_block, blocks[1:], n_jobs=n_jobs, engine=engine,
+                   backend=backend,
+                   func_args=[model, block_data, params_attr, out])
+        if isinstance(out, str):
+            params = np.load(params_fname)
+
+    return params
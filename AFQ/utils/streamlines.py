@@ -1,8 +1,59 @@
+import os
+import os.path as op
+import json
+
 import numpy as np
 import nibabel as nib
+from nibabel.affines import apply_affine
+from nibabel.streamlines.header import Field
+from nibabel.streamlines.trk import get_affine_trackvis_to_rasmm
 from dipy.io.stateful_tractogram import StatefulTractogram, Space
 
 
+def concatenate_streamlines(streamlines_list):
+    """
+    Concatenate groups of streamlines into one ArraySequence, with a single
+    copy of their points into a preallocated buffer.
+
+    Parameters
+    ----------
+    streamlines_list : list
+        Each item is an ArraySequence (possibly a view into a larger one,
+        as returned by fancy indexing) or a list of (N, 3) arrays.
+
+    Returns
+    -------
+    nib.streamlines.ArraySequence
+    """
+    seqs = [sl if isinstance(sl, nib.streamlines.ArraySequence)
+            else nib.streamlines.ArraySequence(sl)
+            for sl in streamlines_list]
+    seqs = [seq for seq in seqs if len(seq)]
+    if not len(seqs):
+        return nib.streamlines.ArraySequence()
+
+    lengths = np.concatenate([seq._lengths for seq in seqs]).astype(int)
+    data = np.empty((np.sum(lengths),) + seqs[0]._data.shape[1:],
+                    dtype=np.result_type(*[seq._data for seq in seqs]))
+    start = 0
+    for seq in seqs:
+        # The points of each streamline of a view need not be contiguous,
+        # or in order, in its buffer, so they are gathered with one index:
+        seq_lengths = seq._lengths.astype(int)
+        n_points = np.sum(seq_lengths)
+        seq_starts = np.cumsum(seq_lengths) - seq_lengths
+        data[start:start + n_points] = seq._data[
+            np.arange(n_points)
+            + np.repeat(seq._offsets.astype(int) - seq_starts, seq_lengths)]
+        start += n_points
+
+    out = nib.streamlines.ArraySequence()
+    out._data = data
+    out._lengths = lengths
+    out._offsets = np.cumsum(lengths) - lengths
+    return out
+
+
 def add_bundles(t1, t2):
     """
     Combine two bundles, using the second bundles' affine and
@@ -11,11 +62,11 @@ def add_bundles(t1, t2):
     ----------
     t1, t2 : nib.streamlines.Tractogram class instances
     """
-    data_per_streamline = {k: (list(t1.data_per_streamline[k])
-                               + list(t2.data_per_streamline[k]))
+    data_per_streamline = {k: np.concatenate([t1.data_per_streamline[k],
+                                              t2.data_per_streamline[k]])
                            for k in t2.data_per_streamline.keys()}
     return nib.streamlines.Tractogram(
-        list(t1.streamlines) + list(t2.streamlines),
+        concatenate_streamlines([t1.streamlines, t2.streamlines]),
         data_per_streamline,
         affine_to_rasmm=t2.affine_to_rasmm)
 
@@ -35,18 +86,12 @@ def bundles_to_tgram(bundles, bundle_dict, reference):
     reference : Nifti
         The affine_to_rasmm input to `nib.streamlines.Tractogram`
     """
-    tgram = nib.streamlines.Tractogram([], {'bundle': []})
-    for b in bundles:
-        this_sl = bundles[b].streamlines
-        this_tgram = nib.streamlines.Tractogram(
-            this_sl,
-            data_per_streamline={
-                'bundle': (len(this_sl)
-                           * [bundle_dict[b]['uid']])},
-                affine_to_rasmm=reference.affine)
-        tgram = add_bundles(tgram, this_tgram)
-    return StatefulTractogram(tgram.streamlines, reference, Space.VOX,
-                              data_per_streamline=tgram.data_per_streamline)
+    streamlines = [bundles[b].streamlines for b in bundles]
+    uids = np.repeat([bundle_dict[b]['uid'] for b in bundles],
+                     [len(sl) for sl in streamlines]).astype(int)
+    return StatefulTractogram(concatenate_streamlines(streamlines),
+                              reference, Space.VOX,
+                              data_per_streamline={'bundle': uids})
 
 
 def tgram_to_bundles(tgram, bundle_dict, reference):
@@ -63,16 +108,291 @@ def tgram_to_bundles(tgram, bundle_dict, reference):
         A bundle specification dictionary. Each item includes in particular a
         `uid` key that is a unique integer for that bundle.
     """
+    bundle_names = [bb for bb in bundle_dict.keys() if bb != 'whole_brain']
+    bundle_idx = group_by_bundle(
+        tgram.data_per_streamline['bundle'],
+        [bundle_dict[bb]['uid'] for bb in bundle_names])
     bundles = {}
-    for bb in bundle_dict.keys():
-        if not bb == 'whole_brain':
-            uid = bundle_dict[bb]['uid']
-            idx = np.where(tgram.data_per_streamline['bundle'] == uid)[0]
-            bundles[bb] = StatefulTractogram(
-                tgram.streamlines[idx].copy(), reference, Space.VOX)
+    for bb, idx in zip(bundle_names, bundle_idx):
+        bundles[bb] = StatefulTractogram(
+            tgram.streamlines[idx].copy(), reference, Space.VOX)
     return bundles
 
 
+def group_by_bundle(bundle, uids):
+    """
+    Find the indices of the streamlines of each bundle, with one sort
+    of the bundle uids of all the streamlines.
+
+    Parameters
+    ----------
+    bundle : array
+        The bundle uid of each streamline (e.g. the `bundle` item of
+        `data_per_streamline`).
+    uids : list of int
+        The uids of the bundles to find.
+
+    Returns
+    -------
+    list of int arrays, one per item of `uids`, with the indices of the
+    streamlines of that bundle, in the order in which they appear.
+    """
+    bundle = np.asarray(bundle).ravel()
+    order = np.argsort(bundle, kind='stable')
+    sorted_bundle = bundle[order]
+    return [order[np.searchsorted(sorted_bundle, uid, side='left'):
+                  np.searchsorted(sorted_bundle, uid, side='right')]
+            for uid in uids]
+
+
+def _tractography_root(fname):
+    """
+    The name of a tractography file without its .trk or .tck extension
+    """
+    root, ext = op.splitext(fname)
+    if ext in ['.trk', '.tck']:
+        return root
+    return fname
+
+
+def bundle_index_fname(trk_fname):
+    """
+    The name of the sidecar file that indexes the bundles of a .trk file
+    """
+    return _tractography_root(trk_fname) + '_bundle_index.npz'
+
+
+def write_bundle_index(trk_fname, sft=None):
+    """
+    Write a sidecar index of the bundles in a .trk file, so that each
+    bundle can be read from the file with `read_bundle`, without reading
+    the other bundles.
+
+    The index records the size and modification time of the .trk file and
+    parts of its header, so that `read_bundle_index` can tell when it no
+    longer describes the file.
+
+    Parameters
+    ----------
+    trk_fname : str
+        The .trk file.
+    sft : StatefulTractogram or Tractogram, optional
+        The tractogram that was saved into `trk_fname`, with a `bundle` key
+        in its `data_per_streamline`. Default: read it from `trk_fname`.
+
+    Returns
+    -------
+    The name of the index file.
+    """
+    header = nib.streamlines.load(trk_fname, lazy_load=True).header
+    if sft is None:
+        sft = nib.streamlines.load(trk_fname).tractogram
+    bundle = np.asarray(sft.data_per_streamline['bundle']).ravel()
+    lengths = np.asarray(sft.streamlines._lengths, dtype=np.int64)
+
+    # The streamlines of each bundle, in the order of the file, do not
+    # need to be contiguous:
+    order = np.argsort(bundle, kind='stable')
+    sorted_bundle = bundle[order]
+    starts = np.flatnonzero(np.concatenate([
+        [True], sorted_bundle[1:] != sorted_bundle[:-1]]))[:len(bundle)]
+    uids = sorted_bundle[starts]
+    counts = np.diff(np.concatenate([starts, [len(bundle)]]))
+
+    # Each streamline is stored as its number of points, followed by its
+    # points (and their scalars) and its properties, all in 4 bytes:
+    n_scalars = header[Field.NB_SCALARS_PER_POINT]
+    n_properties = header[Field.NB_PROPERTIES_PER_STREAMLINE]
+    record_sizes = 4 * (1 + lengths * (3 + n_scalars) + n_properties)
+    offsets = nib.streamlines.TrkFile.HEADER_SIZE + np.concatenate([
+        [0], np.cumsum(record_sizes)[:-1]]).astype(np.int64)[:len(bundle)]
+
+    stat = os.stat(trk_fname)
+    index_fname = bundle_index_fname(trk_fname)
+    # Readers only ever see a complete index:
+    tmp_fname = index_fname.replace('.npz', f'_{os.getpid()}.npz')
+    np.savez(
+        tmp_fname, uids=uids, starts=starts, counts=counts, order=order,
+        offsets=offsets, lengths=lengths.astype(np.int32),
+        n_scalars=n_scalars, n_properties=n_properties,
+        affine_to_rasmm=get_affine_trackvis_to_rasmm(header),
+        vox_to_rasmm=header[Field.VOXEL_TO_RASMM],
+        dimensions=header[Field.DIMENSIONS],
+        endianness=header[Field.ENDIANNESS],
+        nb_streamlines=header[Field.NB_STREAMLINES],
+        trk_size=stat.st_size, trk_mtime_ns=stat.st_mtime_ns)
+    os.replace(tmp_fname, index_fname)
+    return index_fname
+
+
+def _is_current_bundle_index(index, trk_fname):
+    """
+    Check that a bundle index describes the current contents of a .trk file
+    """
+    if not all(k in index for k in (
+            'order', 'endianness', 'nb_streamlines', 'trk_size',
+            'trk_mtime_ns')):
+        return False
+    stat = os.stat(trk_fname)
+    if (index['trk_size'] != stat.st_size
+            or index['trk_mtime_ns'] != stat.st_mtime_ns):
+        return False
+    header = nib.streamlines.load(trk_fname, lazy_load=True).header
+    return (str(index['endianness']) == header[Field.ENDIANNESS]
+            and index['nb_streamlines'] == header[Field.NB_STREAMLINES])
+
+
+def read_bundle_index(trk_fname):
+    """
+    Read the sidecar index of the bundles in a .trk file. The index is
+    created if it does not exist yet, and created again if the file
+    changed since it was written.
+
+    Parameters
+    ----------
+    trk_fname : str
+        The .trk file.
+
+    Returns
+    -------
+    dict with the items of the index. In particular, `uids` and `counts`
+    are the uid of each bundle in the file and its number of streamlines.
+    The indices of the streamlines of bundle `i` in the file are
+    ``order[starts[i]:starts[i] + counts[i]]``.
+    """
+    index_fname = bundle_index_fname(trk_fname)
+    if op.exists(index_fname):
+        with np.load(index_fname) as index:
+            index = dict(index)
+        if _is_current_bundle_index(index, trk_fname):
+            return index
+    write_bundle_index(trk_fname)
+    with np.load(index_fname) as index:
+        return dict(index)
+
+
+def read_bundle(trk_fname, uid, index=None, space=Space.RASMM):
+    """
+    Read the streamlines of one bundle from a .trk file, using the sidecar
+    index of the file to memory-map just that bundle.
+
+    Parameters
+    ----------
+    trk_fname : str
+        The .trk file.
+    uid : int
+        The uid of the bundle.
+    index : dict, optional
+        The index of the file, as returned by `read_bundle_index`.
+        Default: read it.
+    space : dipy Space, optional
+        Either RASMM, the space of `nib.streamlines.load`, or VOX, the voxel
+        space of the image that the tractogram refers to.
+        Default: Space.RASMM
+
+    Returns
+    -------
+    nib.streamlines.ArraySequence with the streamlines of the bundle,
+    which is empty if the bundle is not in the file.
+    """
+    if index is None:
+        index = read_bundle_index(trk_fname)
+    if space == Space.RASMM:
+        affine = index['affine_to_rasmm']
+    elif space == Space.VOX:
+        affine = np.dot(np.linalg.inv(index['vox_to_rasmm']),
+                        index['affine_to_rasmm'])
+    else:
+        raise ValueError(f"space must be RASMM or VOX, not {space}")
+
+    out = nib.streamlines.ArraySequence()
+    which = np.flatnonzero(index['uids'] == uid)
+    if not len(which):
+        return out
+    start = index['starts'][which[0]]
+    sls = index['order'][start:start + index['counts'][which[0]]]
+    lengths = index['lengths'][sls].astype(np.int64)
+
+    # Positions in the file are counted in (4 byte) values, from the first
+    # record of the bundle:
+    point_size = 3 + int(index['n_scalars'])
+    first_offset = int(np.min(index['offsets'][sls]))
+    record_starts = (index['offsets'][sls] - first_offset) // 4
+    last_record = np.argmax(record_starts)
+    buffer = np.memmap(
+        trk_fname, dtype=str(index['endianness']) + 'f4', mode='r',
+        offset=first_offset,
+        shape=(int(record_starts[last_record] + 1
+                   + lengths[last_record] * point_size),))
+
+    # The first value of each point, skipping the number of points that
+    # starts each record:
+    n_points = np.sum(lengths)
+    point_starts = np.cumsum(lengths) - lengths
+    first_values = (
+        np.repeat(record_starts + 1 - point_starts * point_size, lengths)
+        + np.arange(n_points) * point_size)
+    points = buffer[first_values[:, None] + np.arange(3)]
+
+    out._data = apply_affine(affine, points).astype(np.float32)
+    out._lengths = lengths
+    out._offsets = point_starts
+    return out
+
+
+def count_streamlines(fname):
+    """
+    Count the streamlines in a tractography file without reading them.
+
+    The count is taken from the file header, or else from the `Count` field
+    of the tractography's json sidecar. Only if neither has it are the
+    streamlines read.
+
+    Parameters
+    ----------
+    fname : str
+        A tractography file (e.g., .trk or .tck).
+
+    Returns
+    -------
+    int
+    """
+    header = nib.streamlines.load(fname, lazy_load=True).header
+    n_streamlines = int(header.get(Field.NB_STREAMLINES, 0))
+    if n_streamlines > 0:
+        return n_streamlines
+    meta_fname = _tractography_root(fname) + '.json'
+    if op.exists(meta_fname):
+        with open(meta_fname) as ff:
+            meta = json.load(ff)
+        if 'Count' in meta:
+            return int(meta['Count'])
+    return len(nib.streamlines.load(fname).streamlines)
+
+
+def count_bundle_streamlines(trk_fname, uids):
+    """
+    Count the streamlines of each bundle in a .trk file, from the sidecar
+    index of the file (see `write_bundle_index`), without reading the
+    streamlines.
+
+    Parameters
+    ----------
+    trk_fname : str
+        The .trk file.
+    uids : list of int
+        The uids of the bundles to count.
+
+    Returns
+    -------
+    int array with the number of streamlines of each bundle in `uids`,
+    which is 0 for bundles that are not in the file.
+    """
+    index = read_bundle_index(trk_fname)
+    counts = dict(zip(index['uids'].astype(int), index['counts']))
+    return np.array([counts.get(int(uid), 0) for uid in uids], dtype=int)
+
+
 def split_streamline(streamlines, sl_to_split, split_idx):
     """
     Given a Streamlines object, split one of the underlying streamlines
@@ -274,3 +274,32 @@ def make_tracking_data(out_fbval, out_fbvec, out_fdata):
     nib.save(nib.Nifti1Image(nib.load(fimg).get_fdata(), affine), out_fdata)
     np.savetxt(out_fbval, bvals)
     np.savetxt(out_fbvec, bvecs)
+
+
+def make_bundle_streamlines(rng, n_streamlines, outlier=None):
+    """
+    Create a synthetic bundle of straight streamlines, with 20 to 40 nodes
+    each
+
+    rng : np.random.Generator
+        The generator used to choose the number of nodes and the offset of
+        each streamline
+
+    n_streamlines : int
+        Number of streamlines in the bundle
+
+    outlier : int, optional
+        Index of a streamline that is moved away from the rest of the bundle
+
+    Returns
+    -------
+    list of (n_nodes, 3) arrays
+    """
+    streamlines = []
+    for _ in range(n_streamlines):
+        t = np.linspace(0, 1, rng.integers(20, 40))[:, None]
+        streamlines.append(
+            10 + rng.normal(0, 1, 3) + 20 * t * np.array([1, 0.5, 0.2]))
+    if outlier is not None:
+        streamlines[outlier] += 10
+    return streamlines
@@ -0,0 +1,42 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import nibabel as nib
+import dipy.data as dpd
+import dipy.core.gradients as dpg
+from dipy.reconst import dti
+
+import AFQ.utils.models as ut
+
+
+def test_fit_in_blocks(monkeypatch):
+    fdata, fbval, fbvec = dpd.get_fnames('small_64D')
+    data = nib.load(fdata).get_fdata()
+    gtab = dpg.gradient_table(fbval, fbvec)
+    mask = np.zeros(data.shape[:-1], dtype=bool)
+    mask[1:-1, 1:-1, 1:-1] = True
+
+    model = dti.TensorModel(gtab)
+    expected = model.fit(data, mask=mask).model_params
+    for n_jobs, backend in [(1, "loky"), (2, "threading"), (2, "loky")]:
+        params = ut.fit_in_blocks(model, data, mask=mask, block_size=7,
+                                  n_jobs=n_jobs, backend=backend)
+        npt.assert_almost_equal(params, expected)
+
+    # All the blocks are fit in one parallel call:
+    n_calls = []
+    parfor = ut.parfor
+    monkeypatch.setattr(ut, "parfor", lambda *args, **kwargs: (
+        n_calls.append(1), parfor(*args, **kwargs))[1])
+    params = ut.fit_in_blocks(model, data, mask=mask, block_size=7,
+                              n_jobs=2, backend="threading")
+    npt.assert_almost_equal(params, expected)
+    npt.assert_equal(len(n_calls), 1)
+
+    # An empty mask gives all zeros:
+    empty = np.zeros(data.shape[:-1])
+    npt.assert_equal(ut.fit_in_blocks(model, data, mask=empty),
+                     model.fit(data, mask=empty).model_params)
+    with pytest.raises(ValueError):
+        ut.fit_in_blocks(model, data, mask=mask[1:])
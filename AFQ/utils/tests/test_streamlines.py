@@ -1,3 +1,5 @@
+import os
+import json
 import os.path as op
 import numpy as np
 import numpy.testing as npt
@@ -7,6 +9,7 @@ from AFQ.utils import streamlines as aus
 import dipy.tracking.utils as dtu
 import dipy.tracking.streamline as dts
 from dipy.io.stateful_tractogram import StatefulTractogram, Space
+from dipy.io.streamline import save_tractogram
 
 
 def test_bundles_to_tgram():
@@ -89,4 +92,123 @@ def test_add_bundles():
             np.array([[0, 0, 0], [0, 0.5, 0.5], [0, 1, 1]])])
 
     for sl1, sl2 in zip(added.streamlines, test_tgram.streamlines):
-        npt.assert_array_equal(sl1, sl2)
\ No newline at end of file
+        npt.assert_array_equal(sl1, sl2)
+
+
+def test_concatenate_streamlines():
+    streamlines = dts.Streamlines([np.arange(3 * (ii + 2)).reshape(-1, 3)
+                                   for ii in range(5)])
+    # Views into a larger ArraySequence, lists and empty groups can be
+    # concatenated:
+    groups = [streamlines[[3, 1]], [np.ones((2, 3))],
+              dts.Streamlines(), streamlines[4:]]
+    concatenated = aus.concatenate_streamlines(groups)
+    expected = [streamlines[3], streamlines[1], np.ones((2, 3)),
+                streamlines[4]]
+    npt.assert_equal(len(concatenated), len(expected))
+    for sl1, sl2 in zip(concatenated, expected):
+        npt.assert_array_equal(sl1, sl2)
+    npt.assert_equal(concatenated._data.shape, (16, 3))
+    npt.assert_equal(len(aus.concatenate_streamlines([])), 0)
+
+
+def test_bundle_index_fname():
+    # Dots in the folders of the file are not taken for its extension:
+    npt.assert_equal(
+        aus.bundle_index_fname(op.join('study.v2', 'sub-01', 'bundles.trk')),
+        op.join('study.v2', 'sub-01', 'bundles_bundle_index.npz'))
+    npt.assert_equal(aus.bundle_index_fname('bundles.tck'),
+                     'bundles_bundle_index.npz')
+
+
+def test_bundle_index():
+    affine = np.array([[-2., 0., 0., 80.],
+                       [0., 2., 0., -120.],
+                       [0., 0., 2., -60.],
+                       [0., 0., 0., 1.]])
+    img = nib.Nifti1Image(np.ones((40, 50, 40)), affine)
+    rng = np.random.default_rng(2021)
+    bundles = {
+        f'b{ii}': StatefulTractogram(
+            [rng.uniform(1, 30, (rng.integers(2, 10), 3))
+             for _ in range(n_sl)], img, Space.VOX)
+        for ii, n_sl in enumerate([5, 0, 12])}
+    bundle_dict = {'b0': {'uid': 1}, 'b1': {'uid': 2}, 'b2': {'uid': 3}}
+    tgram = aus.bundles_to_tgram(bundles, bundle_dict, img)
+
+    with nbtmp.InTemporaryDirectory() as tmpdir:
+        fname = op.join(tmpdir, 'bundles.trk')
+        save_tractogram(tgram, fname, bbox_valid_check=False)
+        aus.write_bundle_index(fname, tgram)
+        npt.assert_equal(sorted(os.listdir(tmpdir)),
+                         ['bundles.trk', 'bundles_bundle_index.npz'])
+        index = aus.read_bundle_index(fname)
+        npt.assert_equal(index['uids'], [1, 3])
+        npt.assert_equal(index['starts'], [0, 5])
+        npt.assert_equal(index['counts'], [5, 12])
+
+        trk = nib.streamlines.load(fname)
+        for b in bundles:
+            uid = bundle_dict[b]['uid']
+            idx = np.where(
+                trk.tractogram.data_per_streamline['bundle'] == uid)[0]
+            this_sl = aus.read_bundle(fname, uid, index)
+            npt.assert_equal(len(this_sl), len(idx))
+            for sl1, sl2 in zip(this_sl, trk.streamlines[idx]):
+                npt.assert_almost_equal(sl1, sl2, decimal=4)
+            for sl1, sl2 in zip(
+                    aus.read_bundle(fname, uid, index, space=Space.VOX),
+                    bundles[b].streamlines):
+                npt.assert_almost_equal(sl1, sl2, decimal=4)
+
+        # The index is created from the file if it is missing:
+        os.remove(aus.bundle_index_fname(fname))
+        npt.assert_equal(aus.read_bundle_index(fname)['counts'], [5, 12])
+
+        # The index is created again if the file changed:
+        interleaved = StatefulTractogram.from_sft(
+            tgram.streamlines[::-1], tgram,
+            data_per_streamline={'bundle': np.concatenate(
+                [[3, 1] * 5, [3] * 7])[:, None]})
+        save_tractogram(interleaved, fname, bbox_valid_check=False)
+        index = aus.read_bundle_index(fname)
+        npt.assert_equal(index['uids'], [1, 3])
+        npt.assert_equal(index['counts'], [5, 12])
+
+        # The streamlines of each bundle do not need to be contiguous:
+        trk = nib.streamlines.load(fname)
+        for uid in [1, 3]:
+            idx = np.where(
+                trk.tractogram.data_per_streamline['bundle'] == uid)[0]
+            this_sl = aus.read_bundle(fname, uid, index)
+            npt.assert_equal(len(this_sl), len(idx))
+            for sl1, sl2 in zip(this_sl, trk.streamlines[idx]):
+                npt.assert_almost_equal(sl1, sl2, decimal=4)
+
+
+def test_count_streamlines():
+    img = nib.Nifti1Image(np.ones((20, 20, 20)), np.eye(4))
+    streamlines = [np.array([[0, 0, 0], [1, 1, 1.]]) + ii for ii in range(7)]
+    tgram = StatefulTractogram(
+        streamlines, img, Space.VOX,
+        data_per_streamline={'bundle': np.array([1, 1, 1, 3, 3, 3, 3])})
+
+    with nbtmp.InTemporaryDirectory() as tmpdir:
+        fname = op.join(tmpdir, 'bundles.trk')
+        save_tractogram(tgram, fname, bbox_valid_check=False)
+        npt.assert_equal(aus.count_streamlines(fname), 7)
+        npt.assert_equal(
+            aus.count_bundle_streamlines(fname, [3, 2, 1]), [4, 0, 3])
+
+        # Without a count in the header, the count of the json sidecar is
+        # used, also if the folders of the file have dots in their names:
+        fname = op.join(tmpdir, 'study.v2', 'bundles.trk')
+        os.makedirs(op.dirname(fname))
+        save_tractogram(tgram, fname, bbox_valid_check=False)
+        with open(fname, 'r+b') as ff:
+            ff.seek(988)  # The n_count field of the header
+            ff.write(np.int32(0).tobytes())
+        npt.assert_equal(aus.count_streamlines(fname), 7)
+        with open(op.join(tmpdir, 'study.v2', 'bundles.json'), 'w') as ff:
+            json.dump({'Count': 5}, ff)
+        npt.assert_equal(aus.count_streamlines(fname), 5)
@@ -74,52 +74,33 @@ def set_layout(figure, color=None):
 def _draw_streamlines(figure, sls, dimensions, color, name, cbv=None):
     color = np.asarray(color)
 
-    plotting_shape = (sls._data.shape[0] + sls._offsets.shape[0])
-    # dtype object so None can be stored
-    x_pts = np.zeros(plotting_shape)
-    y_pts = np.zeros(plotting_shape)
-    z_pts = np.zeros(plotting_shape)
-
+    lengths = np.asarray(sls._lengths, dtype=int)
+    n_points = np.sum(lengths)
+    # Where each point is in the buffer of sls, and where it goes in the
+    # plotted arrays, which have a NaN after each streamline, so that lines
+    # are not drawn between streamlines:
+    point_starts = np.cumsum(lengths) - lengths
+    data_idx = np.arange(n_points) + np.repeat(
+        np.asarray(sls._offsets, dtype=int) - point_starts, lengths)
+    plot_idx = np.arange(n_points) + np.repeat(
+        np.arange(len(lengths)), lengths)
+    points = sls._data[data_idx]
+
+    plotting_shape = n_points + len(lengths)
+    pts = np.full((plotting_shape, 3), np.nan)
+    pts[plot_idx] = points
+    x_pts, y_pts, z_pts = pts.T
+
+    customdata = np.zeros(plotting_shape)
+    line_color = np.zeros((plotting_shape, 3))
     if cbv is not None:
-        customdata = np.zeros(plotting_shape)
-        line_color = np.zeros((plotting_shape, 3))
         color_constant = (color / color.max()) * (1.4 / cbv.max())
+        brightness = cbv[tuple(points.astype(int).T)]
+        line_color[plot_idx] = brightness[:, None] * color_constant
+        customdata[plot_idx] = brightness
     else:
-        customdata = np.zeros(plotting_shape)
-        line_color = np.zeros((plotting_shape, 3))
-        color_constant = color
-
-    for sl_index, plotting_offset in enumerate(sls._offsets):
-        sl_length = sls._lengths[sl_index]
-        sl = sls._data[plotting_offset:plotting_offset + sl_length]
-
-        # add sl to lines
-        total_offset = plotting_offset + sl_index
-        x_pts[total_offset:total_offset + sl_length] = sl[:, 0]
-        # don't draw between streamlines
-        x_pts[total_offset + sl_length] = np.nan
-        y_pts[total_offset:total_offset + sl_length] = sl[:, 1]
-        y_pts[total_offset + sl_length] = np.nan
-        z_pts[total_offset:total_offset + sl_length] = sl[:, 2]
-        z_pts[total_offset + sl_length] = np.nan
-
-        if cbv is not None:
-            brightness = cbv[
-                sl[:, 0].astype(int),
-                sl[:, 1].astype(int),
-                sl[:, 2].astype(int)
-            ]
-
-            line_color[total_offset:total_offset + sl_length, :] = \
-                np.outer(brightness, color_constant)
-            customdata[total_offset:total_offset + sl_length] = brightness
-        else:
-            line_color[total_offset:total_offset + sl_length, :] = \
-                color_constant
-            customdata[total_offset:total_offset + sl_length] = 1
-
-            line_color[total_offset + sl_length, :] = [0, 0, 0]
-            customdata[total_offset + sl_length] = 0
+        line_color[plot_idx] = color
+        customdata[plot_idx] = 1
 
     figure.add_trace(
         go.Scatter3d(
@@ -21,6 +21,7 @@ import dipy.tracking.streamlinespeed as dps
 from dipy.io.stateful_tractogram import StatefulTractogram, Space
 
 import AFQ.utils.volume as auv
+import AFQ.utils.streamlines as aus
 import AFQ.registration as reg
 from AFQ.utils.stats import contrast_index as calc_contrast_index
 from AFQ.data import BUNDLE_RECO_2_AFQ, BUNDLE_MAT_2_PYTHON
@@ -229,6 +230,27 @@ def tract_generator(sft, affine, bundle, bundle_dict, colors, n_points,
         else:
             colors = gen_color_dict(bundle_dict.keys())
 
+    if isinstance(sft, str) and bundle is not None\
+            and op.exists(aus.bundle_index_fname(sft)):
+        # Read just the selected bundle from the file:
+        if isinstance(bundle, str):
+            uid = bundle_dict[bundle]['uid']
+        else:
+            uid = bundle
+        if bundle_dict is not None:
+            bundle_dict = bundle_dict.copy()
+            bundle_dict.pop('whole_brain', None)
+        viz_logger.info("Loading bundle from Stateful Tractogram...")
+        bundle_index = aus.read_bundle_index(sft)
+        these_sls = aus.read_bundle(sft, uid, bundle_index, space=Space.VOX)
+        if affine is not None:
+            these_sls = transform_tracking_output(these_sls, affine)
+        if n_points is not None:
+            these_sls = dps.set_number_of_points(these_sls, n_points)
+        color, b_name = bundle_selector(bundle_dict, colors, uid)
+        yield these_sls, color, b_name, bundle_index['dimensions'].astype(int)
+        return
+
     if isinstance(sft, str):
         viz_logger.info("Loading Stateful Tractogram...")
         sft = load_tractogram(sft, 'same', Space.VOX, bbox_valid_check=False)